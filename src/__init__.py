@@ -8,5 +8,11 @@ __all__ = [
         'simplicity_estimation',
         'report_printing',
         'search_formulas',
+        'formula_batch',
+        'curve_batch',
+        'estimation_state',
+        'search_cache',
+        'rational_linear_solver',
         'estimate_formulas',
-        'parse_quantity']
+        'parse_quantity',
+        'profiling']
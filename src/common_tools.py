@@ -1,15 +1,32 @@
-import sympy as sp
 import numpy as np
 
+import profiling
+from rational_linear_solver import to_fraction
+
 def power_cost(x):
-    n, d = sp.fraction(sp.Rational(x))
-    return abs(n) + abs(d)
+    x = to_fraction(x)
+    return abs(x.numerator) + abs(x.denominator)
 
 
 def clamp(minimum, maximum, x):
     return min(maximum, max(minimum, x))
 
 
+def make_interpolating_splines(param, curves, k=4):
+    """
+    interpolating splines of many curves (one row per curve) sharing the same parameter points
+    knots are the same as UnivariateSpline(param, curve, k=k, s=0) chooses,
+    so splines are the same as fitted one by one
+    returned spline evaluates to array of shape (len(x), curve count)
+    """
+    # scipy is imported only if splines are fitted (by weighted heuristics)
+    from scipy.interpolate import UnivariateSpline, make_interp_spline
+    profiling.count('spline fits', len(curves))
+    knots = UnivariateSpline(param, param, k=k, s=0).get_knots()
+    full_knots = np.concatenate(([knots[0]]*k, knots, [knots[-1]]*k))
+    return make_interp_spline(param, np.transpose(curves), k=k, t=full_knots, axis=0)
+
+
 def nearly_equal(x, y):
     eps = np.finfo(float).eps
     diff = abs(x-y)
@@ -18,6 +35,16 @@ def nearly_equal(x, y):
     scaled_eps = eps * max(x, y)
     return diff <= scaled_eps
 
+
+def nearly_equal_batch(x, y):
+    """
+    elementwise nearly_equal for arrays
+    """
+    eps = np.finfo(float).eps
+    diff = np.abs(x-y)
+    scaled_eps = eps * np.maximum(np.abs(x), np.abs(y))
+    return diff <= scaled_eps
+
 '''
 def normalize_max(container, key, revert=False):
     elements = [elem[key] for elem in container]
@@ -64,38 +91,46 @@ def normalize_max(container, key, revert=False):
 '''
 
 
-def normalize_80(container, key, revert=False):
+def get_80_bounds(column):
     """
-    normalization based on 80% of elements
+    10% and 90% elements of column (nan elements are not accounted), used by normalize_80_column
     """
-    elements = [elem[key] for elem in container if key in elem]
-    elements.sort()
+    column = np.asarray(column, dtype=float)
+    elements = column[np.logical_not(np.isnan(column))]
     ten_percent_count = int(len(elements) * 0.01 * 10)
     assert ten_percent_count * 2 < len(elements)
-    elements = elements[ten_percent_count:len(elements)-ten_percent_count]
-    maximum = max(elements)
-    minimum = min(elements)
+    minimum_indx, maximum_indx = ten_percent_count, len(elements) - ten_percent_count - 1
+    elements = np.partition(elements, (minimum_indx, maximum_indx))
+    return elements[minimum_indx], elements[maximum_indx]
+
+
+def normalize_80_column(column, revert=False, bounds=None):
+    """
+    normalization based on 80% of elements for the whole column at once
+    nan elements (invalid formulas) are not accounted and stay nan
+    bounds (10% and 90% elements, see get_80_bounds) can be taken from other column, e.g. sample of this one
+    """
+    column = np.asarray(column, dtype=float)
+    minimum, maximum = get_80_bounds(column) if bounds is None else bounds
     clamp_min, clamp_max = -0.2, 1.2
 
     if maximum == minimum:
-        for elem in container:
-            elem[key] = 0.5
-        return
-
-    if not revert:
-        for elem in container:
-            # todo: optional exception?
-            if key not in elem:
-                continue
-            elem[key] = clamp(clamp_min, clamp_max, (elem[key] - minimum) / (maximum - minimum))
-    else:
-        elements = np.ndarray((len(container), 1), dtype=np.float128)
-        for i, elem in enumerate(container):
-            if key not in elem:
-                assert False
-            elements[i] = elem[key]
-        elements = np.clip(1.0 - (elements - minimum) / (maximum-minimum), clamp_min, clamp_max)
-        for i, elem in enumerate(container):
-            if key not in elem:
-                assert False
-            elem[key] = float(elements[i])
+        return np.where(np.isnan(column), np.nan, 0.5)
+
+    normalized = (column - minimum) / (maximum - minimum)
+    if revert:
+        normalized = 1.0 - normalized
+    return np.clip(normalized, clamp_min, clamp_max)
+
+
+def normalize_80(container, key, revert=False):
+    """
+    normalization based on 80% of elements
+    """
+    column = np.array([elem[key] if key in elem else np.nan for elem in container], dtype=float)
+    normalized = normalize_80_column(column, revert)
+    for elem, value in zip(container, normalized):
+        # todo: optional exception?
+        if key not in elem:
+            continue
+        elem[key] = float(value)
@@ -0,0 +1,79 @@
+import numpy as np
+
+import common_tools as ct
+import profiling
+
+
+class CurveBatch(object):
+    """
+    unknown component curves sharing the same parameter points, one row per curve,
+    normalized to [0, 1] (constant curves to zeros)
+    interpolating splines, their derivatives and resamples are computed once, when first needed,
+    so estimators of the same curves (linearity, periodicity, custom ones) share them
+    """
+    __slots__ = ('param', 'domain', 'min_y', 'max_y', 'constant_curves', 'normalized', 'k',
+                 '_splines', '_derivatives', '_resamples', '_curve_splines')
+
+    def __init__(self, param, curves, k=4):
+        self.param = np.asarray(param)
+        curves = np.atleast_2d(curves)
+        self.domain = np.min(self.param), np.max(self.param)
+        self.min_y = np.min(curves, axis=-1)
+        self.max_y = np.max(curves, axis=-1)
+        self.constant_curves = self.min_y == self.max_y
+        ranges = np.where(self.constant_curves, 1.0, self.max_y - self.min_y)
+        self.normalized = (curves - self.min_y[:, np.newaxis]) / ranges[:, np.newaxis]
+        self.k = k
+        self._splines = None
+        self._derivatives = {}
+        self._resamples = {}
+        self._curve_splines = {}
+
+    def __len__(self):
+        return len(self.normalized)
+
+    def splines(self):
+        """
+        interpolating splines of normalized curves (see common_tools.make_interpolating_splines)
+        """
+        if self._splines is None:
+            self._splines = ct.make_interpolating_splines(self.param, self.normalized, k=self.k)
+        return self._splines
+
+    def derivative(self, order=1):
+        """
+        derivative splines of normalized curves
+        """
+        if order == 0:
+            return self.splines()
+        if order not in self._derivatives:
+            self._derivatives[order] = self.splines().derivative(order)
+        return self._derivatives[order]
+
+    def evaluate(self, xs, order=0):
+        """
+        splines (or their derivatives) of normalized curves at xs, one contiguous row per curve
+        (so reductions along rows don't depend on curve count)
+        """
+        return np.ascontiguousarray(np.transpose(self.derivative(order)(xs)))
+
+    def resample(self, count):
+        """
+        uniform grid of count points over domain and splines of normalized curves on it
+        """
+        if count not in self._resamples:
+            xs = np.linspace(self.domain[0], self.domain[1], count)
+            self._resamples[count] = xs, self.evaluate(xs)
+        return self._resamples[count]
+
+    def curve_spline(self, curve_indx):
+        """
+        UnivariateSpline of one normalized curve, for estimators evaluating curves one by one
+        (it is fitted by fitpack, so it may differ from splines() in last bits,
+        which matters for estimators comparing values with thresholds)
+        """
+        if curve_indx not in self._curve_splines:
+            from scipy.interpolate import UnivariateSpline
+            profiling.count('spline fits')
+            self._curve_splines[curve_indx] = UnivariateSpline(self.param, self.normalized[curve_indx], k=self.k, s=0)
+        return self._curve_splines[curve_indx]
@@ -0,0 +1,7 @@
+#!/usr/bin/python3
+
+# headless entry point: python -m dim <arguments of dim_cli>
+from dim_cli import DimensionalFormulaSearchCli
+
+if __name__ == '__main__':
+    DimensionalFormulaSearchCli.main_headless()
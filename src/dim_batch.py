@@ -0,0 +1,168 @@
+#!/usr/bin/python3
+
+import argparse
+import csv
+import glob
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import search_cache
+from dim_cli import DimensionalFormulaSearchCli
+
+MANIFEST_REQUIRED_COLUMNS = ('input_csv', 'searched_quantity', 'out_file')
+SUMMARY_COLUMNS = ('input_csv', 'searched_quantity', 'out_file', 'status', 'seconds', 'error')
+
+# argument parser of dim, made once per worker process
+worker_parser = None
+
+
+def make_dim_parser():
+    parser = argparse.ArgumentParser(prog='dim')
+    DimensionalFormulaSearchCli.add_arguments(parser)
+    return parser
+
+
+def init_batch_worker():
+    global worker_parser
+    worker_parser = make_dim_parser()
+    # the same searches are often repeated by jobs of batch
+    search_cache.enable_memory_cache()
+    # heavy modules are imported once per worker, not once per job
+    import estimate_formulas
+    import search_formulas
+
+
+def make_job_argv(input_csv, searched_quantity, out_file, options, common_argv):
+    """
+    dim command line of one job: common options, then job options (so they take precedence)
+    options is dict of long option names (without leading dashes) and values, empty values are skipped
+    """
+    job_argv = list(common_argv)
+    for option_name, option_value in options.items():
+        if option_value is None or option_value == '':
+            continue
+        job_argv += ['--' + option_name, option_value]
+    return job_argv + ['--', input_csv, searched_quantity, out_file]
+
+
+def read_manifest_jobs(manifest_path, common_argv):
+    """
+    manifest is csv with input_csv, searched_quantity and out_file columns,
+    other columns are dim options (e.g. simplicity-weight), empty cells use common options
+    """
+    jobs = []
+    with open(manifest_path, 'r', newline='') as manifest_file:
+        manifest = csv.DictReader(manifest_file, dialect='excel')
+        missing_columns = [column for column in MANIFEST_REQUIRED_COLUMNS if column not in (manifest.fieldnames or [])]
+        if len(missing_columns) != 0:
+            raise ValueError('Manifest "{}" has no columns: {}'.format(manifest_path, ', '.join(missing_columns)))
+        for row in manifest:
+            options = {column: value for column, value in row.items() if column not in MANIFEST_REQUIRED_COLUMNS}
+            jobs.append(make_job_argv(row['input_csv'], row['searched_quantity'], row['out_file'],
+                                      options, common_argv))
+    return jobs
+
+
+def make_glob_jobs(csv_pattern, searched_quantity, out_dir, out_ext, common_argv):
+    """
+    one job per csv matching pattern, reports are named after input files
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    jobs = []
+    for input_csv in sorted(glob.glob(csv_pattern)):
+        out_name = os.path.splitext(os.path.basename(input_csv))[0] + out_ext
+        jobs.append(make_job_argv(input_csv, searched_quantity, os.path.join(out_dir, out_name), {}, common_argv))
+    return jobs
+
+
+def run_batch_job(job_argv):
+    """
+    runs one dim job, returns summary row (errors are reported, not raised)
+    """
+    parser = worker_parser if worker_parser is not None else make_dim_parser()
+    summary = {'input_csv': job_argv[-3], 'searched_quantity': job_argv[-2], 'out_file': job_argv[-1],
+               'status': 'ok', 'error': ''}
+    start_time = time.perf_counter()
+    try:
+        try:
+            args = parser.parse_args(job_argv)
+        except SystemExit:
+            raise ValueError('Invalid arguments: {}'.format(' '.join(job_argv)))
+        DimensionalFormulaSearchCli.run(args)
+    except Exception as e:
+        summary['status'] = 'error'
+        summary['error'] = '{}: {}'.format(type(e).__name__, e)
+    summary['seconds'] = '{:.3f}'.format(time.perf_counter() - start_time)
+    return summary
+
+
+def run_batch(jobs, summary_path, process_count=1):
+    """
+    runs dim jobs (lists of dim arguments) by process pool,
+    summary rows are written in jobs order as soon as jobs are finished
+    returns number of failed jobs
+    """
+    global worker_parser
+    failed_count = 0
+    with open(summary_path, 'w', newline='') as summary_file:
+        writer = csv.DictWriter(summary_file, SUMMARY_COLUMNS, dialect='excel')
+        writer.writeheader()
+        summary_file.flush()
+        if process_count > 1:
+            with ProcessPoolExecutor(process_count, initializer=init_batch_worker) as executor:
+                summaries = executor.map(run_batch_job, jobs)
+                for summary in summaries:
+                    writer.writerow(summary)
+                    summary_file.flush()
+                    failed_count += summary['status'] != 'ok'
+        else:
+            # jobs run in caller process, its worker state and memory cache are restored afterwards
+            previous_parser, previous_max_cache_entries = worker_parser, search_cache.max_memory_cache_entries
+            init_batch_worker()
+            try:
+                for summary in map(run_batch_job, jobs):
+                    writer.writerow(summary)
+                    summary_file.flush()
+                    failed_count += summary['status'] != 'ok'
+            finally:
+                worker_parser = previous_parser
+                search_cache.enable_memory_cache(previous_max_cache_entries)
+    return failed_count
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='dim_batch',
+        description='Runs dim for many experiments in one process pool, '
+                    'options not listed here are passed to every dim job')
+    jobs_source = parser.add_mutually_exclusive_group(required=True)
+    jobs_source.add_argument('--manifest', type=str,
+                             help='csv with input_csv, searched_quantity, out_file columns '
+                                  'and optional columns of dim options (e.g. simplicity-weight)')
+    jobs_source.add_argument('--glob', type=str,
+                             help='Pattern of input csv files (requires --searched-quantity)')
+    parser.add_argument('--searched-quantity', type=str,
+                        help='Searched quantity name for --glob jobs')
+    parser.add_argument('--out-dir', type=str, default='.',
+                        help='Directory of reports for --glob jobs')
+    parser.add_argument('--out-ext', type=str, default='.csv',
+                        help='Report extension (format) for --glob jobs')
+    parser.add_argument('-P', '--processes', type=int, default=1,
+                        help='Number of worker processes')
+    parser.add_argument('summary_file', type=str,
+                        help='Path to csv summary of job statuses and timings')
+    args, common_argv = parser.parse_known_args(argv)
+
+    if args.manifest is not None:
+        jobs = read_manifest_jobs(args.manifest, common_argv)
+    else:
+        if args.searched_quantity is None:
+            parser.error('--glob requires --searched-quantity')
+        jobs = make_glob_jobs(args.glob, args.searched_quantity, args.out_dir, args.out_ext, common_argv)
+    return run_batch(jobs, args.summary_file, args.processes)
+
+
+if __name__ == '__main__':
+    sys.exit(1 if main() > 0 else 0)
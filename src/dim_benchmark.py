@@ -0,0 +1,386 @@
+#!/usr/bin/python3
+
+import argparse
+import csv
+import io
+import json
+import math
+import os
+import platform
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+
+import numpy as np
+import scipy
+import sympy as sp
+
+import common_tools as common
+import estimate_formulas
+import increase_estimation
+import linearity_estimation
+import magnitude_estimation
+import monotonicity_estimation
+import periodicity_estimation
+import report_printing
+import simplicity_estimation
+import dim_batch
+from dim_cli import DimensionalFormulaSearchCli
+from search_formulas import DimensionalFormulaSearch
+
+BENCHMARK_FORMAT_VERSION = 1
+TEST_DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'test_data')
+# test data files and their searched (not measured) quantities
+TEST_DATA_WORKLOADS = (('fake_sun_gravity.csv', 'F_s'),
+                       ('jump.csv', 'p'),
+                       ('small.csv', 'S'),
+                       ('test_air_resistance.csv', 'k'),
+                       ('test_velocity.csv', 'v'))
+# (quantity count, base unit count, independent power count, row count):
+# rows scaling and independent powers scaling
+DEFAULT_SYNTHETIC_WORKLOADS = ((4, 3, 1, 100),
+                               (4, 3, 1, 1000),
+                               (4, 3, 1, 10000),
+                               (5, 3, 2, 1000),
+                               (6, 3, 3, 1000))
+SYNTHETIC_SEARCHED_QUANTITY = 'y'
+# rows of synthetic csv files loaded by loader workloads (csv loading scaling)
+DEFAULT_LOADER_WORKLOADS = (1000000, )
+# stages faster than that are too noisy to be compared
+MIN_COMPARED_SECONDS = 0.001
+DEFAULT_REGRESSION_RATIO = 1.25
+
+
+def make_synthetic_units(quantity_count, base_unit_count, independent_power_count, rng):
+    """
+    units vectors of influencing quantities with exactly independent_power_count independent powers
+    (rank of units matrix is quantity_count - independent_power_count) and derivable units of searched quantity
+    """
+    rank = quantity_count - independent_power_count
+    if not (0 < rank <= base_unit_count):
+        raise ValueError('Independent power count should be less than quantity count '
+                         'and at least quantity count minus base unit count')
+    # identity block keeps vectors linearly independent
+    independent_units = np.zeros((rank, base_unit_count), dtype=int)
+    independent_units[:, :rank] = np.eye(rank, dtype=int)
+    independent_units[:, rank:] = rng.integers(-1, 2, (rank, base_unit_count - rank))
+    dependent_units = []
+    for _ in range(independent_power_count):
+        coefficients = np.zeros(rank, dtype=int)
+        while not np.any(coefficients):
+            coefficients = rng.integers(-1, 2, rank)
+        dependent_units.append(coefficients @ independent_units)
+    searched_coefficients = np.zeros(rank, dtype=int)
+    while not np.any(searched_coefficients):
+        searched_coefficients = rng.integers(-2, 3, rank)
+    quantities_units = np.concatenate((independent_units, np.array(dependent_units, dtype=int)
+                                       .reshape(-1, base_unit_count)))
+    return quantities_units[rng.permutation(quantity_count)], searched_coefficients @ independent_units
+
+
+def format_quantity(name, units_vector):
+    """
+    quantity header of dim csv, e.g. q[u0^2//u1*u2]
+    """
+    def format_units(unit_powers):
+        return '*'.join('u{}'.format(unit_indx) if power == 1 else 'u{}^{}'.format(unit_indx, power)
+                        for unit_indx, power in unit_powers)
+
+    numerator = format_units((unit_indx, power) for unit_indx, power in enumerate(units_vector) if power > 0)
+    denominator = format_units((unit_indx, -power) for unit_indx, power in enumerate(units_vector) if power < 0)
+    if numerator == '' and denominator == '':
+        return name
+    return '{}[{}]'.format(name, numerator if denominator == '' else numerator + '//' + denominator)
+
+
+def make_synthetic_csv(quantity_count, base_unit_count, independent_power_count, row_count, seed=0):
+    """
+    text of dim csv with quantity_count measured smooth positive quantities (q0, q1, ...)
+    and not measured searched quantity y
+    """
+    rng = np.random.default_rng(seed)
+    quantities_units, searched_units = make_synthetic_units(quantity_count, base_unit_count,
+                                                            independent_power_count, rng)
+    x = np.linspace(0.0, 1.0, row_count)[:, np.newaxis]
+    amplitudes = rng.uniform(0.1, 1.0, quantity_count)
+    frequencies = rng.uniform(0.5, 10.0, quantity_count)
+    phases = rng.uniform(0.0, 2.0*np.pi, quantity_count)
+    scales = 10.0 ** rng.uniform(-3.0, 3.0, quantity_count)
+    measurements = scales * np.exp(amplitudes * np.sin(frequencies * x + phases))
+
+    csv_file = io.StringIO()
+    csv_file.write(','.join([format_quantity('q{}'.format(quantity_indx), units_vector)
+                             for quantity_indx, units_vector in enumerate(quantities_units)]
+                            + [format_quantity(SYNTHETIC_SEARCHED_QUANTITY, searched_units)]) + '\n')
+    # searched quantity is the last (empty) column
+    np.savetxt(csv_file, measurements, fmt='%.17g', delimiter=',', newline=',\n')
+    return csv_file.getvalue()
+
+
+def time_stage(stages, stage_name, function, repeat):
+    """
+    calls function repeat times, stores the best time (seconds) to stages and returns function result
+    """
+    best_seconds = np.inf
+    result = None
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        result = function()
+        best_seconds = min(best_seconds, time.perf_counter() - start_time)
+    stages[stage_name] = best_seconds
+    return result
+
+
+def run_workload(csv_text, searched_quantity, repeat=3, max_formulas=20, max_downcycles=40):
+    """
+    times every stage of dim pipeline on measurements given as csv text
+    returns workload dict with formula counts and stage timings (seconds)
+    """
+    stages = OrderedDict()
+    quantities_table = time_stage(
+        stages, 'load_measurements_csv',
+        lambda: DimensionalFormulaSearchCli.parse_measurements_csv(io.StringIO(csv_text), 'benchmark'), repeat)
+    influencing_names = sorted(set(quantities_table.keys()) - {searched_quantity})
+    quantities_units_by_name, _ = DimensionalFormulaSearchCli.make_quantities_base_units_vectors(quantities_table)
+    required_units = quantities_units_by_name[searched_quantity]
+    quantities_units = [quantities_units_by_name[name] for name in influencing_names]
+
+    for solver in DimensionalFormulaSearch.SOLVERS:
+        time_stage(stages, 'find_powers_equations ({})'.format(solver),
+                   lambda: DimensionalFormulaSearch.find_powers_equations(required_units, quantities_units, solver),
+                   repeat)
+    formulas = time_stage(
+        stages, 'power enumeration',
+        lambda: DimensionalFormulaSearch.generate_quantities_powers_multiplies(
+            max_formulas, max_downcycles, required_units, quantities_units), repeat)
+
+    # the same table as make_formulas_estimation_table makes
+    quantity_names_ordered = tuple(influencing_names) + (searched_quantity, )
+    all_formulas = formulas.append_power(-1)
+    knowns_mask = ['measurements' in quantities_table[name] for name in quantity_names_ordered]
+    row_count = next(len(quantity_data['measurements']) for quantity_data in quantities_table.values()
+                     if 'measurements' in quantity_data)
+    table = np.transpose(np.array([quantities_table[name]['measurements'] if known else np.ones(row_count)
+                                   for name, known in zip(quantity_names_ordered, knowns_mask)]))
+    param = np.arange(0.0, 1.0, 1.0/row_count)
+    unknown_components_points, invalid_formulas_mask = time_stage(
+        stages, 'eval_unknown_component_points',
+        lambda: estimate_formulas.eval_unknown_components_points_batch(all_formulas, table, knowns_mask), repeat)
+    valid_formulas_mask = np.logical_not(invalid_formulas_mask)
+    points = unknown_components_points[valid_formulas_mask]
+
+    raw_valid_estims = OrderedDict()
+    estimators = OrderedDict((
+        ('simplicity', lambda: simplicity_estimation.make_simplicity_estimation_batch(
+            all_formulas[valid_formulas_mask])),
+        ('magnitude', lambda: magnitude_estimation.make_magnitude_penalty_batch(points)),
+        ('change magnitude', lambda: magnitude_estimation.make_avg_derivative_magnitude_estimation_batch(
+            param, points)),
+        ('linearity', lambda: linearity_estimation.make_linearity_estimation_batch(param, points)),
+        ('periodicity', lambda: np.array([periodicity_estimation.make_periodicity_estimation(param, curve)
+                                          for curve in points])),
+        ('periodicity (autocorrelation)', lambda: periodicity_estimation.make_periodicity_estimation_batch(
+            param, points)),
+        ('monotonicity', lambda: monotonicity_estimation.make_non_monothonicity_estimation_batch(param, points)),
+        ('change sign', lambda: increase_estimation.make_increase_estimation_batch(points))))
+    for heuristic, estimator in estimators.items():
+        raw_valid_estims[heuristic] = time_stage(stages, 'estimator: ' + heuristic, estimator, repeat)
+    raw_estims = dict()
+    for heuristic in estimate_formulas.HEURISTICS:
+        raw_estims[heuristic] = np.full(len(all_formulas), np.nan)
+        raw_estims[heuristic][valid_formulas_mask] = raw_valid_estims[heuristic]
+
+    time_stage(stages, 'normalize_80',
+               lambda: [common.normalize_80_column(raw_estims[heuristic])
+                        for heuristic in estimate_formulas.HEURISTICS],
+               repeat)
+    estimation_table = estimate_formulas.make_normalized_formulas_estimation(
+        valid_formulas_mask, param, unknown_components_points, raw_estims, True, True, True)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for report_ext in ('.csv', '.ndjson'):
+            report_path = os.path.join(temp_dir, 'report' + report_ext)
+            time_stage(stages, 'report ({})'.format(report_ext[1:]),
+                       lambda: report_printing.print_report(
+                           DimensionalFormulaSearchCli.iterate_report_table(
+                               formulas, estimation_table, *([1.0] * len(estimate_formulas.HEURISTICS))),
+                           DimensionalFormulaSearchCli.get_report_columns(), influencing_names, report_path),
+                       repeat)
+
+        # whole cli run without search cache
+        input_path = os.path.join(temp_dir, 'input.csv')
+        with open(input_path, 'w') as input_file:
+            input_file.write(csv_text)
+        # every heuristic is weighted, so every heuristic is estimated
+        args = dim_batch.make_dim_parser().parse_args(
+            ['--search-cache-size', '0', '-f', str(max_formulas), '--max-downcycles', str(max_downcycles),
+             '-s', '1', '-m', '1', '-l', '1', '-p', '1', '-n', '1', '-c', '1', '-g', '1',
+             '--', input_path, searched_quantity, os.path.join(temp_dir, 'report.csv')])
+        time_stage(stages, 'total', lambda: DimensionalFormulaSearchCli.run(args), repeat)
+
+    return OrderedDict((
+        ('rows', row_count),
+        ('formulas', len(formulas)),
+        ('valid formulas', int(np.count_nonzero(valid_formulas_mask))),
+        ('stages', stages)))
+
+
+def load_measurements_csv_by_cells(csv_path):
+    """
+    reference loader converting csv cells one by one (as dim did before bulk parsing),
+    returns rows of measurements
+    """
+    with open(csv_path, 'r', newline='') as csv_file:
+        csv_table = csv.reader(csv_file, dialect='excel')
+        next(csv_table, None)
+        return [[float(cell) if len(cell) != 0 else math.nan for cell in row] for row in csv_table if len(row) != 0]
+
+
+def run_loader_workload(row_count, repeat=3):
+    """
+    times loading of synthetic csv file with row_count rows by dim and by reference loader
+    returns workload dict with file size and stage timings (seconds)
+    """
+    stages = OrderedDict()
+    with tempfile.TemporaryDirectory() as temp_dir:
+        input_path = os.path.join(temp_dir, 'input.csv')
+        with open(input_path, 'w') as input_file:
+            input_file.write(make_synthetic_csv(5, 3, 2, row_count))
+        time_stage(stages, 'load_measurements_csv',
+                   lambda: DimensionalFormulaSearchCli.load_measurements_csv(input_path), repeat)
+        time_stage(stages, 'load_measurements_csv (cell by cell)',
+                   lambda: load_measurements_csv_by_cells(input_path), repeat)
+        file_size = os.path.getsize(input_path)
+    return OrderedDict((
+        ('rows', row_count),
+        ('file megabytes', file_size / (1024 * 1024)),
+        ('stages', stages)))
+
+
+def run_benchmarks(synthetic_workloads=DEFAULT_SYNTHETIC_WORKLOADS, test_data=True, repeat=3, max_formulas=20,
+                   log_file=None, loader_workloads=DEFAULT_LOADER_WORKLOADS):
+    """
+    runs test data and synthetic workloads, returns json-serializable results
+    """
+    workloads = []
+
+    def run_logged(name, parameters, run):
+        if log_file is not None:
+            log_file.write('{}...\n'.format(name))
+            log_file.flush()
+        workload = OrderedDict((('name', name), ('parameters', parameters)))
+        workload.update(run())
+        workloads.append(workload)
+
+    if test_data:
+        for file_name, searched_quantity in TEST_DATA_WORKLOADS:
+            with open(os.path.join(TEST_DATA_DIR, file_name)) as csv_file:
+                csv_text = csv_file.read()
+            run_logged(file_name, None,
+                       lambda: run_workload(csv_text, searched_quantity, repeat, max_formulas))
+    for quantity_count, base_unit_count, independent_power_count, row_count in synthetic_workloads:
+        parameters = OrderedDict((('quantities', quantity_count),
+                                  ('base units', base_unit_count),
+                                  ('independent powers', independent_power_count),
+                                  ('rows', row_count)))
+        csv_text = make_synthetic_csv(quantity_count, base_unit_count, independent_power_count, row_count)
+        run_logged('synthetic q{}_u{}_i{}_r{}'.format(quantity_count, base_unit_count, independent_power_count,
+                                                      row_count),
+                   parameters,
+                   lambda: run_workload(csv_text, SYNTHETIC_SEARCHED_QUANTITY, repeat, max_formulas))
+    for row_count in loader_workloads:
+        run_logged('loader r{}'.format(row_count), OrderedDict((('rows', row_count), )),
+                   lambda: run_loader_workload(row_count, repeat))
+
+    return OrderedDict((
+        ('version', BENCHMARK_FORMAT_VERSION),
+        ('created', time.strftime('%Y-%m-%dT%H:%M:%S')),
+        ('environment', OrderedDict((('python', platform.python_version()),
+                                     ('numpy', np.__version__),
+                                     ('scipy', scipy.__version__),
+                                     ('sympy', sp.__version__),
+                                     ('platform', platform.platform())))),
+        ('repeat', repeat),
+        ('max formulas', max_formulas),
+        ('workloads', workloads)))
+
+
+def compare_results(baseline, current, regression_ratio=DEFAULT_REGRESSION_RATIO):
+    """
+    compares stage timings of workloads present in both results
+    returns list of (workload name, stage, baseline seconds, current seconds, ratio, is regression)
+    """
+    baseline_workloads = {workload['name']: workload for workload in baseline['workloads']}
+    comparison = []
+    for workload in current['workloads']:
+        if workload['name'] not in baseline_workloads:
+            continue
+        baseline_stages = baseline_workloads[workload['name']]['stages']
+        for stage_name, seconds in workload['stages'].items():
+            if stage_name not in baseline_stages:
+                continue
+            baseline_seconds = baseline_stages[stage_name]
+            ratio = seconds / baseline_seconds if baseline_seconds > 0 else np.inf
+            is_regression = ratio > regression_ratio and seconds >= MIN_COMPARED_SECONDS
+            comparison.append((workload['name'], stage_name, baseline_seconds, seconds, ratio, is_regression))
+    return comparison
+
+
+def parse_synthetic_workload(workload_str):
+    try:
+        workload = tuple(int(value) for value in workload_str.split(','))
+    except ValueError:
+        workload = ()
+    if len(workload) != 4:
+        raise argparse.ArgumentTypeError(
+            'Synthetic workload should be "quantities,base_units,independent_powers,rows"')
+    return workload
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='dim_benchmark',
+        description='Times dim stages on test data and synthetic workloads, writes json results')
+    parser.add_argument('--synthetic', type=parse_synthetic_workload, action='append',
+                        help='Synthetic workload "quantities,base_units,independent_powers,rows" '
+                             '(can be repeated, default is rows and independent powers scaling series)')
+    parser.add_argument('--loader-rows', type=int, action='append',
+                        help='Rows of synthetic csv file loaded by loader workload (can be repeated, '
+                             'default is {})'.format(', '.join(map(str, DEFAULT_LOADER_WORKLOADS))))
+    parser.add_argument('--no-test-data', action='store_true',
+                        help='Skip test_data files')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='Runs per stage, the best time is reported')
+    parser.add_argument('-f', '--max-formulas', type=int, default=20,
+                        help='Max formula count to search')
+    parser.add_argument('--compare', type=str, default=None,
+                        help='Json results of previous benchmark run to compare with')
+    parser.add_argument('--regression-ratio', type=float, default=DEFAULT_REGRESSION_RATIO,
+                        help='Stages slower than baseline by this ratio are reported as regressions')
+    parser.add_argument('out_file', type=str,
+                        help='Path to json results')
+    args = parser.parse_args(argv)
+
+    synthetic_workloads = args.synthetic if args.synthetic is not None else DEFAULT_SYNTHETIC_WORKLOADS
+    loader_workloads = args.loader_rows if args.loader_rows is not None else DEFAULT_LOADER_WORKLOADS
+    results = run_benchmarks(synthetic_workloads, not args.no_test_data, args.repeat, args.max_formulas,
+                             sys.stderr, loader_workloads)
+    with open(args.out_file, 'w') as out_file:
+        json.dump(results, out_file, indent=2)
+
+    if args.compare is None:
+        return 0
+    with open(args.compare) as baseline_file:
+        baseline = json.load(baseline_file)
+    regression_count = 0
+    for workload_name, stage_name, baseline_seconds, seconds, ratio, is_regression \
+            in compare_results(baseline, results, args.regression_ratio):
+        print('{:<40} {:<40} {:>10.4f} {:>10.4f} {:>7.2f}{}'.format(
+            workload_name, stage_name, baseline_seconds, seconds, ratio, '  REGRESSION' if is_regression else ''))
+        regression_count += is_regression
+    return regression_count
+
+
+if __name__ == '__main__':
+    sys.exit(1 if main() > 0 else 0)
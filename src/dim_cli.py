@@ -2,76 +2,219 @@
 
 import argparse
 import csv
-from copy import deepcopy
+import importlib
+import importlib.util
+import io
+import math
+import os
+import sys
+import tempfile
 from collections import OrderedDict
+from fractions import Fraction
+from itertools import chain, islice
+
+import numpy as np
 
 import parse_quantity
-from search_formulas import DimensionalFormulaSearch
+from formula_batch import FormulaBatch
 import estimate_formulas
+import profiling
+import search_cache
 import report_printing
-import gooey
+
+# same as DimensionalFormulaSearch.SOLVERS (search_formulas imports sympy, so it is imported lazily)
+SOLVERS = ('exact', 'sympy')
+# characters of measurements csv parsed at once by numpy (memory of parsing doesn't depend on file size)
+MEASUREMENTS_BLOCK_CHARS = 16 * 1024 * 1024
+# rows of measurements csv converted at once when it is read by csv reader
+MEASUREMENTS_BLOCK_ROWS = 65536
 
 class DimensionalFormulaSearchCli(object):
+    REPORT_COLUMNS = ('formula',
+                      'simplicity',
+                      'magnitude',
+                      'change magnitude',
+                      'change sign',
+                      'linearity',
+                      'periodicity',
+                      'monotonicity')
+
     @staticmethod
-    def load_measurements_csv(csv_path):
-        quantities = OrderedDict()
-        quantities_by_column_indices = OrderedDict()
-        not_measured_quantities = list()
+    def load_measurements_csv(csv_path, out_of_core=False):
+        """
+        if out_of_core, measurements are kept in temporary file (see parse_measurements_csv)
+        """
         with open(csv_path, 'r', newline='') as csv_file:
-            csv_table = csv.reader(csv_file, dialect='excel') # libreoffice allows to choose dialect
-            # TODO: fix
-            #if len(csv_table) < 2:
-            #    raise ValueError('Specified csv table has no required data')
-            csv_table = list(csv_table)
-            quantities_row = csv_table[0]
-            for col_indx, quantity_str in enumerate(quantities_row):
-                quantity_parser = parse_quantity.QuantityParser(quantity_str)
-                quantity_name = quantity_parser.get_quantity_name()
-                if quantity_name in quantities.keys():
-                    raise ValueError('Quantity named "{}" specified twice in file "{}"'
-                                     .format(quantity_name, csv_path))
-                quantity_data = OrderedDict()
-                quantity_units = quantity_parser.get_units_and_powers()
-                if quantity_units is not None:
-                    quantity_data['units'] = quantity_units
-                quantities[quantity_name] = quantity_data
-                quantities_by_column_indices[col_indx] = quantity_name
-
-            first_measurements_row = csv_table[1]
-            for col_indx, csv_col in enumerate(first_measurements_row):
-                if col_indx not in quantities_by_column_indices.keys():
-                    raise ValueError('Unable to parse "{}" file: different number of columns in rows'
-                                     .format(csv_file))
-                if len(csv_col) == 0:
-                    not_measured_quantities.append(col_indx)
+            if not out_of_core:
+                return DimensionalFormulaSearchCli.parse_measurements_csv(csv_file, csv_path)
+            # memory map stays valid after file is closed (and deleted)
+            with tempfile.TemporaryFile() as spill_file:
+                return DimensionalFormulaSearchCli.parse_measurements_csv(csv_file, csv_path, spill_file)
+
+    @staticmethod
+    def parse_measurements_csv(csv_file, csv_path, spill_file=None):
+        """
+        parses measurements from text file object, csv_path is used in error messages only
+        if spill_file (binary file object) is given, parsed blocks of rows are written to it
+        and measurements are read-only columns of its memory map, so they are never loaded whole
+        (evaluation by blocks of rows reads them block by block)
+        """
+        quantities = OrderedDict()
+        # libreoffice allows to choose dialect
+        quantities_row = next(csv.reader([csv_file.readline()], dialect='excel'), [])
+        for quantity_str in quantities_row:
+            quantity_parser = parse_quantity.QuantityParser(quantity_str)
+            quantity_name = quantity_parser.get_quantity_name()
+            if quantity_name in quantities.keys():
+                raise ValueError('Quantity named "{}" specified twice in file "{}"'
+                                 .format(quantity_name, csv_path))
+            quantity_data = OrderedDict()
+            quantity_units = quantity_parser.get_units_and_powers()
+            if quantity_units is not None:
+                quantity_data['units'] = quantity_units
+            quantities[quantity_name] = quantity_data
+        if len(quantities) == 0:
+            raise ValueError('Specified csv table "{}" has no required data'.format(csv_path))
+
+        column_count = len(quantities)
+        specified_columns = np.zeros(column_count, dtype=bool)
+        unspecified_columns = np.zeros(column_count, dtype=bool)
+        measurements_blocks = []
+        row_count = 0
+        for block in DimensionalFormulaSearchCli.iterate_measurements_blocks(csv_file, csv_path, column_count):
+            block_unspecified = np.isnan(block)
+            # rows of empty cells only are skipped like blank lines
+            specified_rows = np.logical_not(np.all(block_unspecified, axis=-1))
+            if not np.all(specified_rows):
+                block, block_unspecified = block[specified_rows], block_unspecified[specified_rows]
+            specified_columns |= np.any(np.logical_not(block_unspecified), axis=0)
+            unspecified_columns |= np.any(block_unspecified, axis=0)
+            row_count += len(block)
+            if spill_file is not None:
+                spill_file.write(np.ascontiguousarray(block).tobytes())
+            else:
+                measurements_blocks.append(block)
+        if row_count == 0:
+            raise ValueError('Specified csv table "{}" has no required data'.format(csv_path))
+        if np.any(specified_columns & unspecified_columns):
+            raise ValueError(
+                'Unable to parse "{}" file: quantity measurements'
+                ' are expected to be fully specified or fully unspecified'
+                .format(csv_path))
+
+        if spill_file is not None:
+            spill_file.flush()
+            # columns of rows stored one by one
+            measurements_columns = np.transpose(np.memmap(spill_file, dtype=np.float64, mode='r',
+                                                          shape=(row_count, column_count)))
+        else:
+            measurements_table = np.concatenate(measurements_blocks)
+            del measurements_blocks[:]
+            # one contiguous row per quantity
+            measurements_columns = np.ascontiguousarray(np.transpose(measurements_table))
+        for quantity_data, measurements, measured in zip(quantities.values(),
+                                                         measurements_columns,
+                                                         specified_columns):
+            if measured:
+                quantity_data['measurements'] = measurements
+        return quantities
+
+    @staticmethod
+    def iterate_measurements_blocks(csv_file, csv_path, column_count):
+        """
+        yields float64 blocks of measurements rows of the rest of csv file (nan for empty cells),
+        text without quotes is parsed by numpy in bulk, rest of file after the first quote is read by csv reader
+        (quoted cells may contain delimiters and line breaks)
+        """
+        text_tail = ''
+        while True:
+            text = csv_file.read(MEASUREMENTS_BLOCK_CHARS)
+            if len(text) == 0:
+                # the last line may have no line break
+                if len(text_tail) == 0:
+                    return
+                text, text_tail = text_tail, ''
+            else:
+                text = text_tail + text
+                block_end = text.rfind('\n') + 1
+                if block_end == 0:
+                    text_tail = text
                     continue
-                quantities[quantities_by_column_indices[col_indx]]['measurements'] = []
-
-            for row_indx, csv_row in zip(range(2, len(csv_table) - 2), csv_table[2:]):
-                for col_indx, csv_col in enumerate(csv_row):
-                    if col_indx not in quantities_by_column_indices.keys():
-                        raise ValueError('Unable to parse "{}" file: different number of '
-                                         'columns in rows'.format(csv_file))
-                    if len(csv_col) == 0:
-                        if col_indx not in not_measured_quantities:
-                            raise ValueError(
-                                'Unable to parse "{}" file: quantity measurements'
-                                ' are expected to be fully specified or fully unspecified'
-                                .format(csv_path))
+                text, text_tail = text[:block_end], text[block_end:]
+            if '"' in text:
+                # tail is completed to whole line, csv reader reads the rest of file line by line
+                yield from DimensionalFormulaSearchCli.iterate_csv_measurements_blocks(
+                    chain(io.StringIO(text + text_tail + csv_file.readline()), csv_file), csv_path, column_count)
+                return
+            block = DimensionalFormulaSearchCli.load_unquoted_measurements(text, csv_path, column_count)
+            if block is None:
+                yield from DimensionalFormulaSearchCli.iterate_csv_measurements_blocks(
+                    io.StringIO(text), csv_path, column_count)
+            else:
+                yield block
+
+    @staticmethod
+    def load_unquoted_measurements(text, csv_path, column_count):
+        """
+        parses unquoted measurements rows by np.loadtxt,
+        returns None if rows should be parsed by csv reader: if they have letters of literal nan or inf
+        (which are not unspecified measurements), whitespace-only cells, different number of cells or wrong values
+        """
+        if len(text) == 0 or text.isspace():
+            return np.zeros((0, column_count))
+        if any(letter in text for letter in 'nNiI'):
+            return None
+        if '\r' in text:
+            text = text.replace('\r\n', '\n')
+        # plain replaces are much faster than regular expression on large files
+        # (second replace handles runs of empty cells)
+        text = '\n{}\n'.format(text)\
+            .replace(',,', ',nan,').replace(',,', ',nan,')\
+            .replace('\n,', '\nnan,').replace(',\n', ',nan\n')
+        try:
+            block = np.loadtxt(io.StringIO(text), delimiter=',', dtype=np.float64, ndmin=2)
+        except ValueError:
+            return None
+        if block.shape[1] > column_count:
+            raise ValueError('Unable to parse "{}" file: different number of columns in rows'
+                             .format(csv_path))
+        if np.any(np.isinf(block)):
+            raise ValueError('Unable to parse "{}" file: measurements are expected to be finite numbers'
+                             .format(csv_path))
+        # trailing columns may be omitted in measurement rows
+        return np.pad(block, ((0, 0), (0, column_count - block.shape[1])), mode='constant', constant_values=np.nan)
+
+    @staticmethod
+    def iterate_csv_measurements_blocks(lines, csv_path, column_count):
+        """
+        yields float64 blocks of measurements rows read by csv reader (which unquotes cells),
+        empty and whitespace-only cells are nan
+        """
+        csv_table = csv.reader(lines, dialect='excel')
+        while True:
+            rows = list(islice(csv_table, MEASUREMENTS_BLOCK_ROWS))
+            if len(rows) == 0:
+                return
+            block = np.full((len(rows), column_count), np.nan)
+            for row_indx, row in enumerate(rows):
+                if len(row) > column_count:
+                    raise ValueError('Unable to parse "{}" file: different number of columns in rows'
+                                     .format(csv_path))
+                for col_indx, cell in enumerate(row):
+                    if len(cell) == 0 or cell.isspace():
                         continue
-                    if col_indx in not_measured_quantities:
-                        raise ValueError(
-                            'Unable to parse "{}" file: quantity measurements '
-                            'are expected to be fully specified or fully unspecified'
-                            .format(csv_path))
-                    quantities[quantities_by_column_indices[col_indx]]['measurements']\
-                        .append(float(csv_col))
-            return quantities
+                    try:
+                        value = float(cell)
+                    except ValueError as e:
+                        raise ValueError('Unable to parse "{}" file: {}'.format(csv_path, e))
+                    if not math.isfinite(value):
+                        raise ValueError('Unable to parse "{}" file: measurements are expected to be finite numbers'
+                                         .format(csv_path))
+                    block[row_indx, col_indx] = value
+            yield block
 
     @staticmethod
     def make_quantities_base_units_vectors(quantities_table):
-        from sympy import Rational
-
         all_base_unit_names = set()
         for quantity_data in quantities_table.values():
             if 'units' not in quantity_data.keys():
@@ -88,7 +231,7 @@ class DimensionalFormulaSearchCli(object):
             units_vector = []
             for unit_name in all_base_unit_names:
                 if unit_name not in quantity_data['units']:
-                    units_vector.append(Rational(0))
+                    units_vector.append(Fraction(0))
                 else:
                     units_vector.append(quantity_data['units'][unit_name])
             quantities_base_unit_vectors[quantity_name] = tuple(units_vector)
@@ -96,60 +239,177 @@ class DimensionalFormulaSearchCli(object):
         return quantities_base_unit_vectors, all_base_unit_names
 
     @staticmethod
-    def prepare_report_table(
+    def prepare_report_table(*args):
+        return list(DimensionalFormulaSearchCli.iterate_report_table(*args))
+
+    @staticmethod
+    def iterate_report_table(
             formulas,
-            formula_estims,
+            estimation_table,
             simplicity_weight,
             magnitude_weight,
             linearity_weight,
             periodicity_weight,
             monotonicity_weight,
             change_magnitude_weight,
-            change_sign_weight):
-        report_table = list()
-        for formula, estim_row in zip(formulas, formula_estims):
-            if 'invalid' in estim_row:
+            change_sign_weight,
+            custom_weights=None):
+        """
+        yields report rows in order of weighted sums of normalized heuristics
+        custom_weights is dict of weights of registered custom heuristics (0 by default),
+        heuristics with zero weights may be not estimated
+        """
+        weights = OrderedDict((
+            ('simplicity', simplicity_weight),
+            ('magnitude', magnitude_weight),
+            ('linearity', linearity_weight),
+            ('periodicity', periodicity_weight),
+            ('monotonicity', monotonicity_weight),
+            ('change magnitude', change_magnitude_weight),
+            ('change sign', change_sign_weight)))
+        for heuristic in estimate_formulas.ESTIMATORS:
+            weights.setdefault(heuristic, 0.0)
+        if custom_weights is not None:
+            weights.update(custom_weights)
+        normalized_estims = estimation_table['normalized']
+        for heuristic, weight in weights.items():
+            if weight != 0.0 and heuristic not in normalized_estims:
+                raise ValueError('Heuristic "{}" has weight, but it was not estimated'.format(heuristic))
+        formulas = FormulaBatch.from_formulas(formulas)
+        ranked_mask = estimation_table['valid']
+        if 'pruned' in estimation_table:
+            # pruned formulas can't get into top, their expensive heuristics are not estimated
+            ranked_mask = ranked_mask & np.logical_not(estimation_table['pruned'])
+        valid_indices = np.flatnonzero(ranked_mask)
+        # not estimated heuristics have zero weights, so they are represented by zeros
+        normalized_matrix = np.column_stack([normalized_estims[heuristic][valid_indices]
+                                             if heuristic in normalized_estims else np.zeros(len(valid_indices))
+                                             for heuristic in weights.keys()])
+        weights_vector = np.array(list(weights.values()), dtype=float)
+        totals = normalized_matrix @ weights_vector
+        weighted_matrix = normalized_matrix * weights_vector
+
+        # stable sort keeps formulas with equal totals in search order
+        for row_indx in np.argsort(-totals, kind='stable'):
+            formula_indx = valid_indices[row_indx]
+            report_row = {heuristic: float(weighted_value)
+                          for heuristic, weighted_value in zip(weights.keys(), weighted_matrix[row_indx])}
+            report_row['total'] = float(totals[row_indx])
+            report_row['formula'] = formulas.get_power_fractions(formula_indx)
+            report_row['parameter_points'] = estimation_table['parameter_points']
+            report_row['unknowns_points'] = estimation_table['unknowns_points'][formula_indx]
+            yield report_row
+
+    @staticmethod
+    def get_report_columns():
+        """
+        report columns: built-in ones and registered custom heuristics
+        """
+        return DimensionalFormulaSearchCli.REPORT_COLUMNS + tuple(
+            heuristic for heuristic in estimate_formulas.ESTIMATORS
+            if heuristic not in DimensionalFormulaSearchCli.REPORT_COLUMNS)
+
+    @staticmethod
+    def load_estimators_modules(module_names):
+        """
+        imports modules (names or paths to .py files) registering custom heuristics
+        by estimate_formulas.register_estimator, every module is imported once per process
+        """
+        for module_name in module_names or []:
+            if not module_name.endswith('.py'):
+                importlib.import_module(module_name)
                 continue
-            report_row = deepcopy(estim_row)
-            report_row['simplicity'] = simplicity_weight * report_row['simplicity']
-            report_row['magnitude'] = magnitude_weight * report_row['magnitude']
-            report_row['linearity'] = linearity_weight * report_row['linearity']
-            report_row['periodicity'] = periodicity_weight * report_row['periodicity']
-            report_row['monotonicity'] = monotonicity_weight * report_row['monotonicity']
-            report_row['change magnitude'] = change_magnitude_weight * report_row['change magnitude']
-            report_row['change sign'] = change_sign_weight * report_row['change sign']
-            report_row['total'] = report_row['simplicity'] \
-                                  + report_row['magnitude'] \
-                                  + report_row['linearity'] \
-                                  + report_row['periodicity'] \
-                                  + report_row['monotonicity'] \
-                                  + report_row['change magnitude'] \
-                                  + report_row['change sign']
-            report_row['formula'] = formula
-            report_table.append(report_row)
-        report_table.sort(key=lambda formula_row: formula_row['total'], reverse=True)
-        return report_table
-
-    @staticmethod
-    @gooey.Gooey(program_name='Dim',
-                 program_description='Tries to guess right equation by using dimentional analysis, available measurements and some unknown component heuristics',
-                 tabbed_groups=True)
-    def main():
+            module_key = 'dim_estimators_' + os.path.splitext(os.path.basename(module_name))[0]
+            if module_key in sys.modules:
+                continue
+            module_spec = importlib.util.spec_from_file_location(module_key, module_name)
+            if module_spec is None:
+                raise ValueError('Unable to import estimators module "{}"'.format(module_name))
+            module = importlib.util.module_from_spec(module_spec)
+            module_spec.loader.exec_module(module)
+            sys.modules[module_key] = module
+
+    @staticmethod
+    def parse_heuristic_weight(weight_str):
+        name, separator, weight = weight_str.rpartition('=')
+        try:
+            if separator == '' or name.strip() == '':
+                raise ValueError()
+            return name.strip(), float(weight)
+        except ValueError:
+            raise argparse.ArgumentTypeError('Heuristic weight should be "name=weight"')
+
+    @staticmethod
+    def parse_positive_int(value_str):
+        try:
+            value = int(value_str)
+        except ValueError:
+            raise argparse.ArgumentTypeError('"{}" is not an integer'.format(value_str))
+        if value < 1:
+            raise argparse.ArgumentTypeError('Value should be positive, got {}'.format(value))
+        return value
+
+    @staticmethod
+    def add_arguments(parser, widgets=False):
+        """
+        adds dim arguments to argparse.ArgumentParser or gooey.GooeyParser
+        (widgets are passed only to the latter)
+        """
         DEFAULT_MAX_FORMULAS = 20
         DEFAULT_MAX_CYCLES = 40
 
-        parser = gooey.GooeyParser()
+        def widget(widget_name):
+            return {'widget': widget_name} if widgets else {}
+
         equations_search = parser.add_argument_group('Search equations parameters')
         equations_search.add_argument('-f', '--max-formulas', type=int, default=DEFAULT_MAX_FORMULAS,
                             help='Max formula count to search')
         equations_search.add_argument('--max-downcycles', type=int, default=DEFAULT_MAX_CYCLES,
                             help='Max number of cycles performed to '
                                  'search new formula without success')
+        equations_search.add_argument('--search-mode', choices=['sweep', 'best-first'],
+                            default='sweep',
+                            help='Sweep weights until max formula count or max downcycles is reached, '
+                                 'or take exactly max formula count cheapest formulas')
+        equations_search.add_argument('-j', '--search-jobs', type=int, default=1,
+                            help='Number of processes used to enumerate formulas')
+        equations_search.add_argument('--solver', choices=SOLVERS,
+                            default='exact',
+                            help='Linear equation system solver used to find quantity powers')
+        equations_search.add_argument('--search-cache-dir', type=str, default=None,
+                            help='Directory of found formulas cache, e.g. ~/.cache/dim (formulas depend only on units '
+                                 'and search parameters), found formulas are not cached on disk by default',
+                            **widget('DirChooser'))
+        equations_search.add_argument('--search-cache-size', type=float,
+                            default=search_cache.DEFAULT_MAX_CACHE_BYTES / (1024 * 1024),
+                            help='Max size of found formulas cache in megabytes (0 disables cache)')
         equations = parser.add_argument_group('Equation heuristics')
         equations.add_argument('-s', '--simplicity-weight', type=float, default=0.0,
                             help='Weight of formula simplicity '
                                  'during prioritization')
         unknown_heuristics = parser.add_argument_group('Unknown component heuristics')
+        unknown_heuristics.add_argument('-J', '--estimation-jobs', type=int, default=1,
+                            help='Number of processes used to estimate formulas')
+        unknown_heuristics.add_argument('--chunk-rows', type=DimensionalFormulaSearchCli.parse_positive_int,
+                            default=None,
+                            help='Evaluate formulas by blocks of this many measurement rows, so curves of all '
+                                 'formulas over all rows are never kept in memory (single process)')
+        unknown_heuristics.add_argument('--resample-points', type=int,
+                            default=estimate_formulas.DEFAULT_RESAMPLE_COUNT,
+                            help='Curve points used by linearity and periodicity heuristics '
+                                 'when evaluating by blocks of rows')
+        unknown_heuristics.add_argument('--incremental-state', type=str, default=None,
+                            help='File keeping evaluated formulas between runs, so only rows appended '
+                                 'to measurements since previous run are evaluated (file keeps curves of all '
+                                 'formulas over all rows, so it grows with every row and is fully rewritten '
+                                 'when rows are appended)')
+        unknown_heuristics.add_argument('--top-formulas', type=DimensionalFormulaSearchCli.parse_positive_int,
+                            default=None,
+                            help='Report only this many best formulas, expensive heuristics '
+                                 '(linearity, periodicity) are estimated only for formulas which can get into them. '
+                                 'If there are more than {} valid formulas, expensive heuristics are normalized '
+                                 'by a sample of them, so ranking is approximate'.format(
+                                     estimate_formulas.NORMALIZATION_SAMPLE_COUNT))
         magnitude = unknown_heuristics.add_argument_group('Unknown component magnitude heuristics')
         magnitude.add_argument('-m', '--magnitude-weight', type=float, default=0.0,
                             help='Weight of formula magnitude during prioritization')
@@ -160,6 +420,10 @@ class DimensionalFormulaSearchCli(object):
                             help='Weight of formula linearity during prioritization')
         unknown_heuristics.add_argument('-p', '--periodicity-weight', type=float, default=0.0,
                             help='Weight of formula periodicity during prioritization')
+        unknown_heuristics.add_argument('--periodicity-mode', choices=estimate_formulas.PERIODICITY_MODES,
+                            default='spline',
+                            help='Search periods by comparing spline segments or by autocorrelation '
+                                 '(much faster, needs at least two periods in measurements)')
         derivative = unknown_heuristics.add_argument_group('Unknown component derivative heuristics')
         derivative.add_argument('-g', '--change-sign-weight', type=float, default=0.0,
                             help='Weight of the fact of increasing or decreasing')
@@ -174,28 +438,110 @@ class DimensionalFormulaSearchCli(object):
                             help='Treat greater change magnitude as better')
         unknown_heuristics.add_argument('-n', '--monotonicity-weight', type=float, default=0.0,
                             help='Weight of monotonicity during prioritization')
+        custom_heuristics = parser.add_argument_group('Custom heuristics')
+        custom_heuristics.add_argument('--estimators-module', type=str, action='append', default=None,
+                            help='Python module (name or path to .py file) registering custom heuristics '
+                                 'by estimate_formulas.register_estimator (can be repeated)',
+                            **widget('FileChooser'))
+        custom_heuristics.add_argument('--heuristic-weight', action='append', default=None, metavar='NAME=WEIGHT',
+                            type=DimensionalFormulaSearchCli.parse_heuristic_weight,
+                            help='Weight of custom heuristic during prioritization (can be repeated)')
+        diagnostics = parser.add_argument_group('Diagnostics')
+        diagnostics.add_argument('--profile', type=str, default=None,
+                            help='Path to json summary of stage timings and counters, '
+                                 'chrome trace is written next to it (<name>.trace.json)',
+                            **widget('FileSaver'))
         parser.add_argument('input_csv', type=str,
-                            help='Path to input csv file', widget='FileChooser')
+                            help='Path to input csv file', **widget('FileChooser'))
         parser.add_argument('searched_quantity', type=str,
                             help='Searched quantity name '
                                  '(should correspond to quantity name in csv)')
         parser.add_argument('out_file', type=str,
-                            help='Path to output file', widget='FileSaver')
+                            help='Path to output file, format is chosen by extension '
+                                 '(.pdf, .csv, .ndjson, .jsonl, .parquet)', **widget('FileSaver'))
+
+    @staticmethod
+    def main():
+        import gooey
 
-        args = parser.parse_args()
+        @gooey.Gooey(program_name='Dim',
+                     program_description='Tries to guess right equation by using dimentional analysis, available measurements and some unknown component heuristics',
+                     tabbed_groups=True)
+        def gui_main():
+            parser = gooey.GooeyParser()
+            DimensionalFormulaSearchCli.add_arguments(parser, widgets=True)
+            DimensionalFormulaSearchCli.run(parser.parse_args())
 
-        quantities_table = DimensionalFormulaSearchCli.load_measurements_csv(args.input_csv)
+        gui_main()
+
+    @staticmethod
+    def main_headless(argv=None):
+        """
+        the same as main, but without gui (gooey is never imported)
+        """
+        parser = argparse.ArgumentParser(
+            prog='dim',
+            description='Tries to guess right equation by using dimentional analysis, '
+                        'available measurements and some unknown component heuristics')
+        DimensionalFormulaSearchCli.add_arguments(parser)
+        DimensionalFormulaSearchCli.run(parser.parse_args(argv))
+
+    @staticmethod
+    def run(args):
+        # fail before search if report format is not supported
+        report_printing.get_report_writer(args.out_file)
+        profiler = profiling.enable() if args.profile is not None else None
+        try:
+            with profiling.stage('dim', 'run'):
+                with profiling.stage('load_measurements_csv', 'run'):
+                    quantities_table = DimensionalFormulaSearchCli.load_measurements_csv(
+                        args.input_csv, out_of_core=args.chunk_rows is not None)
+
+                # rows are written to report as they are ranked
+                report_table, influencing_quantity_names_ordered = DimensionalFormulaSearchCli.rank_formulas(
+                    quantities_table, args.searched_quantity, args, args.input_csv)
+
+                with profiling.stage('report', 'run'):
+                    report_printing.print_report(report_table,
+                                                 DimensionalFormulaSearchCli.get_report_columns(),
+                                                 influencing_quantity_names_ordered,
+                                                 args.out_file)
+        finally:
+            if profiler is not None:
+                profiling.disable()
+                profiler.write(args.profile)
+
+    @staticmethod
+    def rank_formulas(quantities_table, required_quantity_name, args, table_name):
+        """
+        searches and estimates formulas of required quantity with parameters of parsed dim arguments
+        returns iterator of ranked report rows and influencing quantity names (in order of formula powers)
+        only heuristics with non-zero weights are estimated
+        """
+        if args.incremental_state is not None and args.chunk_rows is not None:
+            raise ValueError('Incremental estimation keeps whole curves, they can\'t be evaluated by blocks of rows')
+        DimensionalFormulaSearchCli.load_estimators_modules(args.estimators_module)
+        custom_weights = OrderedDict(args.heuristic_weight or [])
+        weights = OrderedDict((
+            ('simplicity', args.simplicity_weight),
+            ('magnitude', args.magnitude_weight),
+            ('linearity', args.linearity_weight),
+            ('periodicity', args.periodicity_weight),
+            ('monotonicity', args.monotonicity_weight),
+            ('change magnitude', args.change_magnitude_weight),
+            ('change sign', args.change_sign_weight)))
+        weights.update(custom_weights)
+        heuristics = estimate_formulas.plan_heuristics(weights)
 
-        required_quantity_name = args.searched_quantity
         all_quantity_names = sorted(list(set(quantities_table.keys())))
         if required_quantity_name not in all_quantity_names:
             raise ValueError('Searched quantity "{}" is not present in "{}" table'.format(
                 required_quantity_name,
-                args.input_csv))
+                table_name))
         influencing_quantity_names_ordered = \
             sorted(list(set(all_quantity_names) - {required_quantity_name}))
         if len(influencing_quantity_names_ordered) == 0:
-            raise ValueError('There should be more quantities in "{}"'.format(args.input_csv))
+            raise ValueError('There should be more quantities in "{}"'.format(table_name))
 
         quantities_base_unit_vectors, all_unit_names = \
             DimensionalFormulaSearchCli.make_quantities_base_units_vectors(quantities_table)
@@ -204,21 +550,84 @@ class DimensionalFormulaSearchCli(object):
                                              for quantity_name
                                              in influencing_quantity_names_ordered]
 
-        formulas_represented_by_powers = \
-            DimensionalFormulaSearch.generate_quantities_powers_multiplies(
-                args.max_formulas,
-                args.max_downcycles,
-                required_quantity_units_vec,
-                influencing_quantities_units_matr)
-
-        formulas_estimations = estimate_formulas.make_formulas_estimation(
-            formulas_represented_by_powers, quantities_table,
-            required_quantity_name, influencing_quantity_names_ordered,
-            args.magnitude_greater_better == 'yes',
-            args.increase_is_better == 'yes',
-            args.change_greater_better == 'yes')
-
-        report_table = DimensionalFormulaSearchCli.prepare_report_table(
+        if args.search_mode == 'best-first':
+            search_params = {'mode': args.search_mode, 'max_formulas': args.max_formulas}
+
+            def search():
+                # sympy is imported only if formulas are not cached
+                from search_formulas import DimensionalFormulaSearch
+                return DimensionalFormulaSearch.iterate_quantities_powers_multiplies(
+                    required_quantity_units_vec,
+                    influencing_quantities_units_matr,
+                    args.solver,
+                    args.max_formulas,
+                    args.search_jobs)
+        else:
+            search_params = {'mode': args.search_mode,
+                             'max_formulas': args.max_formulas,
+                             'max_downcycles': args.max_downcycles}
+
+            def search():
+                from search_formulas import DimensionalFormulaSearch
+                return DimensionalFormulaSearch.generate_quantities_powers_multiplies(
+                    args.max_formulas,
+                    args.max_downcycles,
+                    required_quantity_units_vec,
+                    influencing_quantities_units_matr,
+                    args.solver,
+                    args.search_jobs)
+
+        with profiling.stage('search', 'run'):
+            cache_dir = args.search_cache_dir if args.search_cache_size > 0 else None
+            if cache_dir is not None or search_cache.max_memory_cache_entries > 0:
+                formulas_represented_by_powers = search_cache.search_formulas_cached(
+                    search,
+                    required_quantity_units_vec,
+                    influencing_quantities_units_matr,
+                    search_params,
+                    cache_dir,
+                    int(args.search_cache_size * 1024 * 1024))
+            else:
+                formulas_represented_by_powers = FormulaBatch.from_formulas(
+                    list(search()), len(influencing_quantities_units_matr))
+
+        with profiling.stage('estimation', 'run'):
+            if args.incremental_state is not None:
+                formulas_estimations = estimate_formulas.make_incremental_formulas_estimation_table(
+                    formulas_represented_by_powers, quantities_table,
+                    required_quantity_name, influencing_quantity_names_ordered,
+                    args.magnitude_greater_better == 'yes',
+                    args.increase_is_better == 'yes',
+                    args.change_greater_better == 'yes',
+                    args.incremental_state,
+                    args.periodicity_mode,
+                    heuristics,
+                    args.estimation_jobs)
+            elif args.top_formulas is not None and args.chunk_rows is None:
+                formulas_estimations = estimate_formulas.make_top_formulas_estimation_table(
+                    formulas_represented_by_powers, quantities_table,
+                    required_quantity_name, influencing_quantity_names_ordered,
+                    args.magnitude_greater_better == 'yes',
+                    args.increase_is_better == 'yes',
+                    args.change_greater_better == 'yes',
+                    weights,
+                    args.top_formulas,
+                    args.periodicity_mode,
+                    args.estimation_jobs)
+            else:
+                formulas_estimations = estimate_formulas.make_formulas_estimation_table(
+                    formulas_represented_by_powers, quantities_table,
+                    required_quantity_name, influencing_quantity_names_ordered,
+                    args.magnitude_greater_better == 'yes',
+                    args.increase_is_better == 'yes',
+                    args.change_greater_better == 'yes',
+                    args.periodicity_mode,
+                    args.estimation_jobs,
+                    args.chunk_rows,
+                    args.resample_points,
+                    heuristics)
+
+        report_table = DimensionalFormulaSearchCli.iterate_report_table(
             formulas_represented_by_powers,
             formulas_estimations,
             args.simplicity_weight,
@@ -227,19 +636,11 @@ class DimensionalFormulaSearchCli(object):
             args.periodicity_weight,
             args.monotonicity_weight,
             args.change_magnitude_weight,
-            args.change_sign_weight)
-
-        report_printing.print_report(report_table,
-                                     ('formula',
-                                      'simplicity',
-                                      'magnitude',
-                                      'change magnitude',
-                                      'change sign',
-                                      'linearity',
-                                      'periodicity',
-                                      'monotonicity'),
-                                     influencing_quantity_names_ordered,
-                                     args.out_file)
+            args.change_sign_weight,
+            custom_weights)
+        if args.top_formulas is not None:
+            report_table = islice(report_table, args.top_formulas)
+        return report_table, influencing_quantity_names_ordered
 
 
 if __name__ == '__main__':
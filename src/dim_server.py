@@ -0,0 +1,238 @@
+#!/usr/bin/python3
+
+import argparse
+import asyncio
+import hashlib
+import io
+import json
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from http import HTTPStatus
+from itertools import islice
+
+import dim_batch
+import report_printing
+import search_cache
+from dim_cli import DimensionalFormulaSearchCli
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+MAX_REQUEST_BYTES = 256 * 1024 * 1024
+# parsed tables kept by every worker
+MAX_CACHED_TABLES = 32
+# dim options clients can pass, the rest (file paths, custom estimators code, processes)
+# are server settings given in server command line
+ALLOWED_OPTIONS = (
+    'max-formulas', 'max-downcycles', 'search-mode', 'solver',
+    'simplicity-weight', 'magnitude-weight', 'magnitude-greater-better', 'linearity-weight',
+    'periodicity-weight', 'periodicity-mode', 'change-sign-weight', 'increase-is-better',
+    'change-magnitude-weight', 'change-greater-better', 'monotonicity-weight', 'heuristic-weight',
+    'top-formulas')
+
+# state of worker process, kept between requests
+worker_parser = None
+# dim options of server command line, passed to every request
+worker_common_argv = []
+# sha256 of csv text -> parsed quantities table, least recently used first
+tables_cache = OrderedDict()
+
+
+def init_server_worker(estimators_modules=(), common_argv=()):
+    """
+    estimators_modules are modules registering custom heuristics (given in server command line),
+    they are available to all requests
+    common_argv are dim options of server command line (e.g. search cache)
+    """
+    global worker_parser, worker_common_argv
+    worker_parser = dim_batch.make_dim_parser()
+    worker_common_argv = list(common_argv)
+    DimensionalFormulaSearchCli.load_estimators_modules(estimators_modules)
+    search_cache.enable_memory_cache()
+    # sympy and scipy are imported once per worker, not once per request
+    import estimate_formulas
+    import search_formulas
+
+
+def get_quantities_table(csv_text):
+    key = hashlib.sha256(csv_text.encode('utf-8')).hexdigest()
+    if key in tables_cache:
+        tables_cache.move_to_end(key)
+        return tables_cache[key]
+    quantities_table = DimensionalFormulaSearchCli.parse_measurements_csv(io.StringIO(csv_text, newline=None),
+                                                                          'request')
+    tables_cache[key] = quantities_table
+    if len(tables_cache) > MAX_CACHED_TABLES:
+        tables_cache.popitem(last=False)
+    return quantities_table
+
+
+def rank_request(request):
+    """
+    request is dict with
+        'csv': measurements table (text of dim csv)
+        'searched_quantity': quantity name
+        'options' (optional): dict of dim options (long names without dashes, e.g. simplicity-weight)
+        'max_rows' (optional): number of best formulas to return
+    returns dict with 'columns' and 'rows' (records of machine-readable report)
+    raises ValueError if request is wrong
+    """
+    if not isinstance(request, dict) or 'csv' not in request or 'searched_quantity' not in request:
+        raise ValueError('Request should be object with "csv" and "searched_quantity" fields')
+    options = request.get('options', {})
+    if not isinstance(options, dict):
+        raise ValueError('Request "options" should be object')
+    rejected_options = [str(option_name) for option_name in options if option_name not in ALLOWED_OPTIONS]
+    if len(rejected_options) != 0:
+        raise ValueError('Options are not allowed in requests: {}'.format(', '.join(rejected_options)))
+    parser = worker_parser if worker_parser is not None else dim_batch.make_dim_parser()
+    job_argv = dim_batch.make_job_argv('request', str(request['searched_quantity']), 'report.ndjson',
+                                       {name: str(value) for name, value in options.items()}, worker_common_argv)
+    try:
+        args = parser.parse_args(job_argv)
+    except SystemExit:
+        raise ValueError('Invalid options: {}'.format(' '.join(job_argv[:-4])))
+
+    quantities_table = get_quantities_table(request['csv'])
+    report_table, influencing_quantity_names_ordered = DimensionalFormulaSearchCli.rank_formulas(
+        quantities_table, args.searched_quantity, args, 'request')
+    report_columns = DimensionalFormulaSearchCli.get_report_columns()
+    records = report_printing.iterate_report_records(report_table, report_columns,
+                                                     influencing_quantity_names_ordered)
+    return {
+        'columns': report_printing.make_report_record_columns(report_columns, influencing_quantity_names_ordered),
+        'rows': list(islice(records, request.get('max_rows')))}
+
+
+async def write_response(writer, status, response):
+    body = json.dumps(response).encode('utf-8')
+    writer.write('HTTP/1.1 {} {}\r\n'
+                 'Content-Type: application/json\r\n'
+                 'Content-Length: {}\r\n'
+                 'Connection: close\r\n\r\n'.format(status.value, status.phrase, len(body)).encode('ascii'))
+    writer.write(body)
+    await writer.drain()
+
+
+async def read_request(reader):
+    """
+    reads http request, returns method, path and body
+    """
+    request_line = (await reader.readline()).decode('latin-1').split()
+    if len(request_line) != 3:
+        raise ValueError('Malformed request line')
+    method, path, _ = request_line
+    content_length = 0
+    while True:
+        header_line = (await reader.readline()).decode('latin-1').strip()
+        if header_line == '':
+            break
+        header_name, _, header_value = header_line.partition(':')
+        if header_name.strip().lower() == 'content-length':
+            content_length = int(header_value)
+    if content_length > MAX_REQUEST_BYTES:
+        raise OverflowError('Request is too large')
+    body = await reader.readexactly(content_length) if content_length > 0 else b''
+    return method, path, body
+
+
+def make_connection_handler(executor, max_pending):
+    """
+    returns asyncio connection handler, cpu work is done by executor,
+    no more than max_pending requests are accepted at once (the rest get 503)
+    """
+    pending_requests = asyncio.Semaphore(max_pending)
+
+    async def handle_connection(reader, writer):
+        try:
+            try:
+                method, path, body = await read_request(reader)
+            except OverflowError as e:
+                await write_response(writer, HTTPStatus.REQUEST_ENTITY_TOO_LARGE, {'error': str(e)})
+                return
+            except (ValueError, asyncio.IncompleteReadError) as e:
+                await write_response(writer, HTTPStatus.BAD_REQUEST, {'error': str(e)})
+                return
+
+            if method == 'GET' and path == '/health':
+                await write_response(writer, HTTPStatus.OK, {'status': 'ok'})
+            elif method == 'POST' and path == '/rank':
+                if pending_requests.locked():
+                    await write_response(writer, HTTPStatus.SERVICE_UNAVAILABLE, {'error': 'Server is busy'})
+                    return
+                async with pending_requests:
+                    try:
+                        request = json.loads(body.decode('utf-8'))
+                        response = await asyncio.get_running_loop().run_in_executor(executor, rank_request,
+                                                                                    request)
+                    except ValueError as e:
+                        await write_response(writer, HTTPStatus.BAD_REQUEST, {'error': str(e)})
+                        return
+                    except Exception as e:
+                        await write_response(writer, HTTPStatus.INTERNAL_SERVER_ERROR,
+                                             {'error': '{}: {}'.format(type(e).__name__, e)})
+                        return
+                await write_response(writer, HTTPStatus.OK, response)
+            else:
+                await write_response(writer, HTTPStatus.NOT_FOUND, {'error': 'Unknown endpoint'})
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    return handle_connection
+
+
+async def start_server(executor, host=DEFAULT_HOST, port=DEFAULT_PORT, unix_socket=None, max_pending=16):
+    handle_connection = make_connection_handler(executor, max_pending)
+    if unix_socket is not None:
+        return await asyncio.start_unix_server(handle_connection, path=unix_socket, limit=MAX_REQUEST_BYTES)
+    return await asyncio.start_server(handle_connection, host, port, limit=MAX_REQUEST_BYTES)
+
+
+def make_server_executor(process_count, estimators_modules=(), common_argv=()):
+    """
+    process pool of server workers (see init_server_worker)
+    """
+    executor = ProcessPoolExecutor(process_count, initializer=init_server_worker,
+                                   initargs=(tuple(estimators_modules), tuple(common_argv)))
+    # workers are started before server opens sockets,
+    # worker forked during request would keep client connections open after response
+    list(executor.map(abs, range(process_count)))
+    return executor
+
+
+async def serve(host, port, unix_socket, process_count, max_pending, estimators_modules=(), common_argv=()):
+    with make_server_executor(process_count, estimators_modules, common_argv) as executor:
+        server = await start_server(executor, host, port, unix_socket, max_pending)
+        async with server:
+            await server.serve_forever()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='dim_server',
+        description='Serves dim ranking over local http json api: '
+                    'POST /rank {"csv": ..., "searched_quantity": ..., "options": {...}}, GET /health')
+    parser.add_argument('--host', type=str, default=DEFAULT_HOST,
+                        help='Address to listen')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT,
+                        help='Port to listen')
+    parser.add_argument('--unix-socket', type=str, default=None,
+                        help='Listen unix socket instead of tcp port')
+    parser.add_argument('-P', '--processes', type=int, default=1,
+                        help='Number of worker processes doing search and estimation')
+    parser.add_argument('--max-pending', type=int, default=16,
+                        help='Max number of requests processed or waiting for worker at once')
+    parser.add_argument('--estimators-module', type=str, action='append', default=[],
+                        help='Module name or path to .py file registering custom heuristics '
+                             '(can be repeated), requests can weight them by heuristic-weight option')
+    parser.add_argument('--search-cache-dir', type=str, default=None,
+                        help='Directory of found formulas cache shared by requests')
+    args = parser.parse_args(argv)
+    common_argv = [] if args.search_cache_dir is None else ['--search-cache-dir', args.search_cache_dir]
+    asyncio.run(serve(args.host, args.port, args.unix_socket, args.processes, args.max_pending,
+                      args.estimators_module, common_argv))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,9 @@
 #!/usr/bin/python3
 
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
 import numpy as np
 
 import linearity_estimation
@@ -9,6 +13,136 @@ import periodicity_estimation
 import monotonicity_estimation
 import increase_estimation
 import common_tools as common
+import profiling
+from formula_batch import FormulaBatch
+from curve_batch import CurveBatch
+import estimation_state
+
+PERIODICITY_MODES = ('spline', 'autocorrelation')
+# formula chunks per estimation process (for better load balancing)
+ESTIMATION_CHUNKS_PER_JOB = 4
+# curve points kept per formula for spline based heuristics in chunked mode
+DEFAULT_RESAMPLE_COUNT = 1000
+# built-in heuristics
+HEURISTICS = ('simplicity',
+              'magnitude',
+              'linearity',
+              'periodicity',
+              'monotonicity',
+              'change magnitude',
+              'change sign')
+# heuristics computed from accumulated block statistics (not from resampled curves) in chunked mode
+ACCUMULATED_HEURISTICS = ('magnitude', 'monotonicity', 'change magnitude', 'change sign')
+# heuristics at least this costly are estimated only for formulas which can get into top (see
+# make_top_formulas_estimation_table), cheaper ones are estimated for all formulas
+PRUNED_HEURISTIC_MIN_COST = 10.0
+# normalized heuristics are clamped to this range
+NORMALIZED_RANGE = (-0.2, 1.2)
+# totals are compared with this tolerance, so rounding never prunes formulas of equal totals
+PRUNING_TOLERANCE = 1e-9
+# number of valid formulas estimated by expensive heuristics before pruning to fix their normalization
+NORMALIZATION_SAMPLE_COUNT = 256
+
+
+class Estimator(object):
+    """
+    heuristic of formulas:
+        estimate(param, unknown_components_points, formulas, settings) returns raw estimation of every formula,
+            points and formulas (FormulaBatch, powers of all quantities) contain valid formulas only,
+            settings is dict of estimation options (e.g. 'periodicity_mode')
+            and 'curves': CurveBatch of points, sharing splines between estimators
+        greater_is_better: normalization direction (may be overridden by user preferences)
+        cost: relative cost of estimation of one formula (magnitude costs 1)
+    """
+    __slots__ = ('name', 'estimate', 'greater_is_better', 'cost')
+
+    def __init__(self, name, estimate, greater_is_better, cost):
+        self.name = name
+        self.estimate = estimate
+        self.greater_is_better = greater_is_better
+        self.cost = cost
+
+
+# registered estimators by heuristic name, built-in ones first
+ESTIMATORS = OrderedDict()
+
+
+def register_estimator(name, estimate, greater_is_better=True, cost=1.0):
+    """
+    adds heuristic (or replaces registered one with the same name)
+    estimators registered before process pool is created are available to its workers (fork)
+    """
+    ESTIMATORS[name] = Estimator(name, estimate, greater_is_better, cost)
+
+
+def plan_heuristics(weights, requested_heuristics=()):
+    """
+    heuristics to compute: ones with non-zero weight and explicitly requested ones
+    (in order of registration), weights is dict of heuristic weights
+    """
+    for heuristic in list(weights.keys()) + list(requested_heuristics):
+        if heuristic not in ESTIMATORS:
+            raise ValueError('Unknown heuristic "{}"'.format(heuristic))
+    return tuple(heuristic for heuristic in ESTIMATORS
+                 if weights.get(heuristic, 0.0) != 0.0 or heuristic in requested_heuristics)
+
+
+def get_planned_estimators(heuristics):
+    """
+    estimators of heuristics (None means all registered), cheap ones first
+    """
+    if heuristics is None:
+        heuristics = tuple(ESTIMATORS.keys())
+    for heuristic in heuristics:
+        if heuristic not in ESTIMATORS:
+            raise ValueError('Unknown heuristic "{}"'.format(heuristic))
+    return sorted((ESTIMATORS[heuristic] for heuristic in heuristics), key=lambda estimator: estimator.cost)
+
+
+def estimate_simplicity(param, unknown_components_points, formulas, settings):
+    return simplicity_estimation.make_simplicity_estimation_batch(formulas)
+
+
+def estimate_magnitude(param, unknown_components_points, formulas, settings):
+    return magnitude_estimation.make_magnitude_penalty_batch(unknown_components_points)
+
+
+def estimate_linearity(param, unknown_components_points, formulas, settings):
+    return linearity_estimation.make_linearity_estimation_batch(param, unknown_components_points,
+                                                                settings['curves'])
+
+
+def estimate_periodicity(param, unknown_components_points, formulas, settings):
+    curves = settings['curves']
+    if settings['periodicity_mode'] == 'autocorrelation':
+        return periodicity_estimation.make_periodicity_estimation_batch(param, unknown_components_points,
+                                                                        curves=curves)
+    return np.array([1.0 if curves.constant_curves[curve_indx] else
+                     periodicity_estimation.make_periodicity_estimation(param, evaluated_unknown_component_points,
+                                                                        spline=curves.curve_spline(curve_indx))
+                     for curve_indx, evaluated_unknown_component_points in enumerate(unknown_components_points)])
+
+
+def estimate_monotonicity(param, unknown_components_points, formulas, settings):
+    return monotonicity_estimation.make_non_monothonicity_estimation_batch(param, unknown_components_points)
+
+
+def estimate_change_magnitude(param, unknown_components_points, formulas, settings):
+    return magnitude_estimation.make_avg_derivative_magnitude_estimation_batch(param, unknown_components_points)
+
+
+def estimate_change_sign(param, unknown_components_points, formulas, settings):
+    return increase_estimation.make_increase_estimation_batch(unknown_components_points)
+
+
+# costs are rough per formula timings of dim_benchmark relative to magnitude
+register_estimator('simplicity', estimate_simplicity, greater_is_better=False, cost=1.0)
+register_estimator('magnitude', estimate_magnitude, greater_is_better=True, cost=1.0)
+register_estimator('linearity', estimate_linearity, greater_is_better=True, cost=50.0)
+register_estimator('periodicity', estimate_periodicity, greater_is_better=True, cost=1000.0)
+register_estimator('monotonicity', estimate_monotonicity, greater_is_better=False, cost=5.0)
+register_estimator('change magnitude', estimate_change_magnitude, greater_is_better=True, cost=1.0)
+register_estimator('change sign', estimate_change_sign, greater_is_better=True, cost=1.0)
 
 
 def make_formulas_estimation(formulas_list,
@@ -17,84 +151,540 @@ def make_formulas_estimation(formulas_list,
                              influencing_quantity_names_ordered,
                              magnitude_greater_is_better,
                              increase_is_better,
-                             greater_change_is_better):
+                             greater_change_is_better,
+                             periodicity_mode='spline',
+                             jobs=1,
+                             chunk_rows=None,
+                             resample_count=DEFAULT_RESAMPLE_COUNT,
+                             heuristics=None):
+    """
+    same as make_formulas_estimation_table, but returns list of dicts (one per formula)
+    with normalized heuristics, invalid formulas are represented by dicts with 'invalid' key
     """
+    estimation_table = make_formulas_estimation_table(formulas_list,
+                                                      quantities_table,
+                                                      required_quantity_name,
+                                                      influencing_quantity_names_ordered,
+                                                      magnitude_greater_is_better,
+                                                      increase_is_better,
+                                                      greater_change_is_better,
+                                                      periodicity_mode,
+                                                      jobs,
+                                                      chunk_rows,
+                                                      resample_count,
+                                                      heuristics)
+    normalized_estimations = []
+    for formula_indx, valid in enumerate(estimation_table['valid']):
+        if not valid:
+            normalized_estimations.append({'invalid': 'invalid in given measurements'})
+            continue
+        normalized_estimation = {heuristic: float(normalized_column[formula_indx])
+                                 for heuristic, normalized_column in estimation_table['normalized'].items()}
+        normalized_estimation['parameter_points'] = estimation_table['parameter_points']
+        normalized_estimation['unknowns_points'] = estimation_table['unknowns_points'][formula_indx]
+        normalized_estimations.append(normalized_estimation)
+    return normalized_estimations
 
+
+def make_formulas_estimation_table(formulas_list,
+                                   quantities_table,
+                                   required_quantity_name,
+                                   influencing_quantity_names_ordered,
+                                   magnitude_greater_is_better,
+                                   increase_is_better,
+                                   greater_change_is_better,
+                                   periodicity_mode='spline',
+                                   jobs=1,
+                                   chunk_rows=None,
+                                   resample_count=DEFAULT_RESAMPLE_COUNT,
+                                   heuristics=None):
     """
-    # todo: make more convenient
-    # find one quantity with measurements to determine table height
-    table_height = None
-    for quantity_data in quantities_table.values():
-        if 'measurements' in quantity_data:
-            table_height = len(quantity_data['measurements'])
-            break
-    assert table_height is not None
+    columnar estimation of formulas, returns dict with
+        'valid': mask of formulas valid in given measurements
+        'parameter_points', 'unknowns_points': curves of unknown component (one row per formula)
+        'raw', 'normalized': dicts of heuristic columns (nan for invalid formulas)
+    only given heuristics are computed (see plan_heuristics), None means all registered ones
+    if chunk_rows is specified, measurements are evaluated by blocks of rows, so curves of all formulas
+    are never kept whole (see make_raw_formulas_estimation_chunked, jobs are not used then),
+    returned curves are resampled to at most resample_count points
+    """
+    if periodicity_mode not in PERIODICITY_MODES:
+        raise ValueError('Unknown periodicity mode "{}"'.format(periodicity_mode))
+    if chunk_rows is not None and chunk_rows < 1:
+        raise ValueError('Number of rows in block should be positive')
+    table_height = get_table_height(quantities_table)
 
     #  move all quantities to one side of equations
     quantity_names_ordered = tuple(influencing_quantity_names_ordered) + (required_quantity_name, )
-    formulas_list = [formula + (-1,) for formula in formulas_list]
+    formulas_list = FormulaBatch.from_formulas(formulas_list, len(influencing_quantity_names_ordered)).append_power(-1)
 
     known_quantities_mask = ['measurements' in quantities_table[formula_name] for formula_name in quantity_names_ordered]
-    measurements_only_table = np.transpose(np.array([quantities_table[quantity_name]['measurements']
-                                        if 'measurements' in quantities_table[quantity_name]
-                                        else [1.0]*table_height
-                                        for quantity_name in quantity_names_ordered]))
     # todo: optionally load from csv?
     todo_param = np.arange(0.0, 1.0, 1.0/table_height)
-    raw_formulas_estimations = []
-    for formula in formulas_list:
-        evaluated_unknown_component_points = eval_unknown_component_points(
-            formula=formula,
-            table=measurements_only_table,
-            knowns_mask=known_quantities_mask)
-
-        for i in range(len(evaluated_unknown_component_points)):
-            if (np.isnan(evaluated_unknown_component_points[i])
-                    or np.isinf(evaluated_unknown_component_points[i])
-                    or np.isneginf(evaluated_unknown_component_points[i])):
-                raw_formulas_estimations.append({'invalid': 'invalid in given measurements'})
-                continue
-
-        dbg_filename = [str(power).replace('/', '_') for power in formula]
-        dbg_filename = '__'.join(dbg_filename)
-
-        raw_simplicity_estim = simplicity_estimation.make_simplicity_estimation(formula)
-        raw_magnitude_estim = magnitude_estimation.make_magnitude_penalty(evaluated_unknown_component_points)
-        raw_change_estim = magnitude_estimation.make_avg_derivative_magnitude_estimation(
-            todo_param,
-            evaluated_unknown_component_points)
-        raw_linearity_estim = linearity_estimation.make_linearity_estimation(
-            todo_param,
-            evaluated_unknown_component_points)
-        raw_periodicity_estim = periodicity_estimation.make_periodicity_estimation(
-            todo_param,
-            evaluated_unknown_component_points)
-        raw_monotonicity_estim = monotonicity_estimation.make_non_monothonicity_estimation(
-            todo_param,
-            evaluated_unknown_component_points)
-        raw_increase_estim = increase_estimation.make_increase_estimation(evaluated_unknown_component_points)
-        raw_formulas_estimations.append({
-            'simplicity': raw_simplicity_estim,
-            'magnitude': raw_magnitude_estim,
-            'linearity': raw_linearity_estim,
-            'periodicity': raw_periodicity_estim,
-            'monotonicity': raw_monotonicity_estim,
-            'change magnitude': raw_change_estim,
-            'change sign': raw_increase_estim,
-            'parameter_points': todo_param,
-            'unknowns_points': evaluated_unknown_component_points}
-        )
-
-    normalized_estimations = raw_formulas_estimations
-    common.normalize_80(normalized_estimations, 'simplicity', revert=True)
-    common.normalize_80(normalized_estimations, 'magnitude', revert=not magnitude_greater_is_better)
-    common.normalize_80(normalized_estimations, 'linearity', revert=False)
-    common.normalize_80(normalized_estimations, 'periodicity', revert=False)
-    common.normalize_80(normalized_estimations, 'monotonicity', revert=True)
-    common.normalize_80(normalized_estimations, 'change magnitude', revert=not greater_change_is_better)
-    common.normalize_80(normalized_estimations, 'change sign', revert=not increase_is_better)
+    if chunk_rows is not None:
+        # measurements may be kept out of core, so table is made block by block of rows
+        measurements_rows = MeasurementsRows(quantities_table, quantity_names_ordered, table_height)
+        todo_param, unknown_components_points, invalid_formulas_mask, raw_estims = \
+            make_raw_formulas_estimation_chunked(formulas_list, measurements_rows, known_quantities_mask,
+                                                 todo_param, periodicity_mode, chunk_rows, resample_count,
+                                                 heuristics)
+        valid_formulas_mask = np.logical_not(invalid_formulas_mask)
+        return make_normalized_formulas_estimation(valid_formulas_mask, todo_param, unknown_components_points,
+                                                   raw_estims, magnitude_greater_is_better, increase_is_better,
+                                                   greater_change_is_better)
+
+    # measurements are small (rows by quantities) unlike curves of formulas (rows by formulas)
+    measurements_only_table = make_measurements_table(quantities_table, quantity_names_ordered, table_height)
+    unknown_components_points, invalid_formulas_mask, raw_estims = make_raw_formulas_estimation_jobs(
+        formulas_list, measurements_only_table, known_quantities_mask, todo_param, periodicity_mode, jobs,
+        heuristics)
+    valid_formulas_mask = np.logical_not(invalid_formulas_mask)
+    return make_normalized_formulas_estimation(valid_formulas_mask, todo_param, unknown_components_points,
+                                               raw_estims, magnitude_greater_is_better, increase_is_better,
+                                               greater_change_is_better)
 
-    return normalized_estimations
+
+def make_top_formulas_estimation_table(formulas_list,
+                                       quantities_table,
+                                       required_quantity_name,
+                                       influencing_quantity_names_ordered,
+                                       magnitude_greater_is_better,
+                                       increase_is_better,
+                                       greater_change_is_better,
+                                       weights,
+                                       top_count,
+                                       periodicity_mode='spline',
+                                       jobs=1,
+                                       sample_count=NORMALIZATION_SAMPLE_COUNT):
+    """
+    same as make_formulas_estimation_table, but only formulas which can get into top_count best ones
+    (by weighted sum of normalized heuristics) are estimated by all expensive heuristics,
+    weights is dict of heuristic weights (heuristics with zero weights are not estimated)
+    cheap heuristics are estimated and normalized for all formulas first,
+    expensive ones are estimated for evenly spaced sample of sample_count valid formulas,
+    their normalization bounds (10% and 90% elements) are taken from the sample,
+    then expensive heuristics are estimated one by one (cheapest first): total of every formula is bounded by
+    its known part and normalized range of not yet estimated heuristics, formulas whose upper bound is less
+    than top_count-th best lower bound are pruned, the rest are estimated by the next heuristic
+    if there are no more than sample_count valid formulas, normalization and top formulas
+    are the same as make_formulas_estimation_table gives, otherwise normalization of expensive heuristics
+    (and so ranking) is approximate
+    returned dict has also 'pruned' mask (pruned formulas out of sample have nan expensive heuristics)
+    """
+    if periodicity_mode not in PERIODICITY_MODES:
+        raise ValueError('Unknown periodicity mode "{}"'.format(periodicity_mode))
+    if top_count < 1:
+        raise ValueError('Number of top formulas should be positive')
+    heuristics = plan_heuristics(weights)
+    expensive_heuristics = [estimator.name for estimator in get_planned_estimators(heuristics)
+                            if estimator.cost >= PRUNED_HEURISTIC_MIN_COST]
+    cheap_heuristics = tuple(heuristic for heuristic in heuristics if heuristic not in expensive_heuristics)
+
+    table_height = get_table_height(quantities_table)
+    quantity_names_ordered = tuple(influencing_quantity_names_ordered) + (required_quantity_name, )
+    formulas_list = FormulaBatch.from_formulas(formulas_list, len(influencing_quantity_names_ordered)).append_power(-1)
+    known_quantities_mask = ['measurements' in quantities_table[formula_name] for formula_name in quantity_names_ordered]
+    todo_param = np.arange(0.0, 1.0, 1.0/table_height)
+    measurements_only_table = make_measurements_table(quantities_table, quantity_names_ordered, table_height)
+
+    unknown_components_points, invalid_formulas_mask, raw_estims = make_raw_formulas_estimation_jobs(
+        formulas_list, measurements_only_table, known_quantities_mask, todo_param, periodicity_mode, jobs,
+        cheap_heuristics)
+    valid_formulas_mask = np.logical_not(invalid_formulas_mask)
+    estimation_table = make_normalized_formulas_estimation(valid_formulas_mask, todo_param,
+                                                           unknown_components_points, raw_estims,
+                                                           magnitude_greater_is_better, increase_is_better,
+                                                           greater_change_is_better)
+    known_totals = np.zeros(len(formulas_list))
+    for heuristic in cheap_heuristics:
+        known_totals += weights[heuristic] * estimation_table['normalized'][heuristic]
+
+    # expensive heuristics of sample fix their normalization, so it doesn't depend on pruning
+    valid_indices = np.flatnonzero(valid_formulas_mask)
+    sample_mask = np.zeros(len(formulas_list), dtype=bool)
+    sample_mask[valid_indices[np.unique(np.linspace(0, len(valid_indices) - 1,
+                                                    min(len(valid_indices), sample_count)).astype(int))]] = True
+    raw_sample_estims = dict()
+    if len(expensive_heuristics) != 0 and len(valid_indices) != 0:
+        _, _, raw_sample_estims = make_raw_formulas_estimation_jobs(
+            formulas_list[sample_mask], measurements_only_table, known_quantities_mask, todo_param,
+            periodicity_mode, jobs, expensive_heuristics)
+
+    candidates_mask = valid_formulas_mask.copy()
+    for heuristic_indx, heuristic in enumerate(expensive_heuristics):
+        # contributions of not estimated heuristics are bounded by normalized range
+        unknown_weights = np.array([weights[unknown_heuristic]
+                                    for unknown_heuristic in expensive_heuristics[heuristic_indx:]])
+        upper_totals = known_totals + np.sum(np.maximum(unknown_weights * NORMALIZED_RANGE[0],
+                                                        unknown_weights * NORMALIZED_RANGE[1]))
+        lower_totals = known_totals + np.sum(np.minimum(unknown_weights * NORMALIZED_RANGE[0],
+                                                        unknown_weights * NORMALIZED_RANGE[1]))
+        candidate_count = np.count_nonzero(candidates_mask)
+        if candidate_count > top_count:
+            candidates_lower_totals = lower_totals[candidates_mask]
+            top_lower_total = np.partition(candidates_lower_totals,
+                                           candidate_count - top_count)[candidate_count - top_count]
+            candidates_mask &= upper_totals >= top_lower_total - PRUNING_TOLERANCE
+            profiling.count('formulas pruned', candidate_count - np.count_nonzero(candidates_mask))
+
+        raw_column = np.full(len(formulas_list), np.nan)
+        if len(valid_indices) == 0:
+            estimation_table['raw'][heuristic] = raw_column
+            estimation_table['normalized'][heuristic] = raw_column
+            continue
+        raw_column[sample_mask] = raw_sample_estims[heuristic]
+        estimated_mask = candidates_mask & np.logical_not(sample_mask)
+        if np.any(estimated_mask):
+            _, _, candidates_raw_estims = make_raw_formulas_estimation_jobs(
+                formulas_list[estimated_mask], measurements_only_table, known_quantities_mask, todo_param,
+                periodicity_mode, jobs, (heuristic, ))
+            raw_column[estimated_mask] = candidates_raw_estims[heuristic]
+        normalized_column = make_normalized_formulas_estimation(
+            valid_formulas_mask, todo_param, unknown_components_points, {heuristic: raw_column},
+            magnitude_greater_is_better, increase_is_better, greater_change_is_better,
+            {heuristic: common.get_80_bounds(raw_sample_estims[heuristic])})['normalized'][heuristic]
+        estimation_table['raw'][heuristic] = raw_column
+        estimation_table['normalized'][heuristic] = normalized_column
+        known_totals[candidates_mask] += weights[heuristic] * normalized_column[candidates_mask]
+
+    # registration order, the same as make_formulas_estimation_table returns
+    for estims in (estimation_table['raw'], estimation_table['normalized']):
+        for heuristic in ESTIMATORS:
+            if heuristic in estims:
+                estims.move_to_end(heuristic)
+    estimation_table['pruned'] = valid_formulas_mask & np.logical_not(candidates_mask)
+    return estimation_table
+
+
+def make_incremental_formulas_estimation_table(formulas_list,
+                                               quantities_table,
+                                               required_quantity_name,
+                                               influencing_quantity_names_ordered,
+                                               magnitude_greater_is_better,
+                                               increase_is_better,
+                                               greater_change_is_better,
+                                               state_path,
+                                               periodicity_mode='spline',
+                                               heuristics=None,
+                                               jobs=1):
+    """
+    same as make_formulas_estimation_table, but evaluated curves of formulas and their statistics
+    (magnitude, first and last points, derivatives sums) are kept in state_path between runs:
+    if measurements of previous run are beginning of current ones (rows were appended) and formulas are the same,
+    only appended rows are evaluated, accumulated heuristics are updated from statistics
+    and other ones (only given heuristics, e.g. linearity, periodicity) are computed from kept curves
+    (by jobs processes), otherwise all rows are evaluated and state is replaced
+    state keeps curves over all rows, so it grows with every appended row and is rewritten when rows are appended
+    """
+    if periodicity_mode not in PERIODICITY_MODES:
+        raise ValueError('Unknown periodicity mode "{}"'.format(periodicity_mode))
+    estimators = get_planned_estimators(heuristics)
+    table_height = get_table_height(quantities_table)
+    quantity_names_ordered = tuple(influencing_quantity_names_ordered) + (required_quantity_name, )
+    formulas_list = FormulaBatch.from_formulas(formulas_list, len(influencing_quantity_names_ordered)).append_power(-1)
+    known_quantities_mask = ['measurements' in quantities_table[formula_name] for formula_name in quantity_names_ordered]
+    todo_param = np.arange(0.0, 1.0, 1.0/table_height)
+    measurements_only_table = make_measurements_table(quantities_table, quantity_names_ordered, table_height)
+
+    state = estimation_state.load_state(state_path)
+    if state is None or not state.matches(formulas_list, known_quantities_mask, measurements_only_table):
+        state = estimation_state.EstimationState(formulas_list, known_quantities_mask)
+    evaluated_row_count = state.statistics.row_count
+    if evaluated_row_count < table_height:
+        with profiling.stage('eval_unknown_component_points', 'estimation'):
+            block_points, block_invalid = eval_unknown_components_points_batch(
+                formulas=formulas_list,
+                table=measurements_only_table[evaluated_row_count:],
+                knowns_mask=known_quantities_mask)
+        state.append_rows(block_points, block_invalid, measurements_only_table)
+        estimation_state.store_state(state_path, state)
+    profiling.count('rows evaluated', table_height - evaluated_row_count)
+
+    invalid_formulas_mask = state.statistics.invalid
+    profiling.count('formulas marked invalid', np.count_nonzero(invalid_formulas_mask))
+    # statistics are accumulated with unit parameter step, curves parameter step is 1/table_height
+    raw_estims = make_accumulated_raw_estimation(estimators, formulas_list, state.statistics, todo_param,
+                                                 state.curves, todo_param[[0, -1]], periodicity_mode,
+                                                 derivative_scale=table_height, jobs=jobs)
+    return make_normalized_formulas_estimation(np.logical_not(invalid_formulas_mask), todo_param, state.curves,
+                                               raw_estims, magnitude_greater_is_better, increase_is_better,
+                                               greater_change_is_better)
+
+
+def get_table_height(quantities_table):
+    # todo: make more convenient
+    # find one quantity with measurements to determine table height
+    for quantity_data in quantities_table.values():
+        if 'measurements' in quantity_data:
+            return len(quantity_data['measurements'])
+    assert False, 'No measurements in table'
+
+
+def make_measurements_table(quantities_table, quantity_names_ordered, table_height, rows=slice(None)):
+    """
+    measurements (one column per quantity, ones for not measured quantities) of given rows
+    """
+    return np.transpose(np.array([quantities_table[quantity_name]['measurements'][rows]
+                                  if 'measurements' in quantities_table[quantity_name]
+                                  else np.ones(len(range(table_height)[rows]))
+                                  for quantity_name in quantity_names_ordered]))
+
+
+class MeasurementsRows(object):
+    """
+    measurements table made by blocks of rows when sliced (see make_measurements_table),
+    so measurements kept out of core (see DimensionalFormulaSearchCli.parse_measurements_csv) are never read whole
+    """
+    __slots__ = ('quantities_table', 'quantity_names_ordered', 'table_height')
+
+    def __init__(self, quantities_table, quantity_names_ordered, table_height):
+        self.quantities_table = quantities_table
+        self.quantity_names_ordered = quantity_names_ordered
+        self.table_height = table_height
+
+    def __len__(self):
+        return self.table_height
+
+    def __getitem__(self, rows):
+        return make_measurements_table(self.quantities_table, self.quantity_names_ordered, self.table_height, rows)
+
+
+def make_raw_formulas_estimation_jobs(formulas_list, table, knowns_mask, param, periodicity_mode, jobs,
+                                      heuristics=None):
+    if jobs > 1:
+        return make_raw_formulas_estimation_parallel(formulas_list, table, knowns_mask, param, periodicity_mode,
+                                                     jobs, heuristics)
+    return make_raw_formulas_estimation(formulas_list, table, knowns_mask, param, periodicity_mode, heuristics)
+
+
+def make_normalized_formulas_estimation(valid_formulas_mask,
+                                        parameter_points,
+                                        unknown_components_points,
+                                        raw_estims,
+                                        magnitude_greater_is_better,
+                                        increase_is_better,
+                                        greater_change_is_better,
+                                        normalization_bounds=None):
+    """
+    normalization_bounds is dict of bounds of heuristics normalized by bounds of other columns
+    (see common_tools.normalize_80_column)
+    """
+    normalization_bounds = normalization_bounds or dict()
+    # user preferences override directions of registered estimators
+    greater_is_better = {
+        'magnitude': magnitude_greater_is_better,
+        'change magnitude': greater_change_is_better,
+        'change sign': increase_is_better}
+    with profiling.stage('normalize_80', 'estimation'):
+        normalized_estims = OrderedDict(
+            (heuristic, common.normalize_80_column(
+                raw_column,
+                revert=not greater_is_better.get(heuristic, ESTIMATORS[heuristic].greater_is_better),
+                bounds=normalization_bounds.get(heuristic)))
+            for heuristic, raw_column in raw_estims.items())
+
+    return {
+        'valid': valid_formulas_mask,
+        'parameter_points': parameter_points,
+        'unknowns_points': unknown_components_points,
+        'raw': raw_estims,
+        'normalized': normalized_estims}
+
+
+def make_raw_formulas_estimation(formulas_list, table, knowns_mask, param, periodicity_mode, heuristics=None):
+    """
+    evaluates unknown component curves and raw heuristics of formulas
+    (powers of all quantities including searched one)
+    returns curves (one row per formula), mask of invalid formulas and
+    dict of heuristic columns (nan for invalid formulas, in order of registration)
+    """
+    estimators = get_planned_estimators(heuristics)
+    formulas_list = FormulaBatch.from_formulas(formulas_list)
+    with profiling.stage('eval_unknown_component_points', 'estimation'):
+        unknown_components_points, invalid_formulas_mask = eval_unknown_components_points_batch(
+            formulas=formulas_list,
+            table=table,
+            knowns_mask=knowns_mask)
+    profiling.count('formulas marked invalid', np.count_nonzero(invalid_formulas_mask))
+    valid_formulas_mask = np.logical_not(invalid_formulas_mask)
+    valid_unknown_components_points = unknown_components_points[valid_formulas_mask]
+
+    # heuristics of valid formulas, one row per valid formula
+    raw_valid_estims = dict()
+    if len(valid_unknown_components_points) > 0:
+        valid_formulas = formulas_list[valid_formulas_mask]
+        settings = {'periodicity_mode': periodicity_mode,
+                    'curves': CurveBatch(param, valid_unknown_components_points)}
+        for estimator in estimators:
+            with profiling.stage('estimator: ' + estimator.name, 'estimator'):
+                raw_valid_estims[estimator.name] = estimator.estimate(param, valid_unknown_components_points,
+                                                                      valid_formulas, settings)
+
+    return unknown_components_points, invalid_formulas_mask, \
+        make_raw_estims_columns(estimators, raw_valid_estims, valid_formulas_mask)
+
+
+def make_raw_estims_columns(estimators, raw_valid_estims, valid_formulas_mask):
+    """
+    heuristic columns of all formulas (nan for invalid ones) in order of registration
+    """
+    planned_heuristics = {estimator.name for estimator in estimators}
+    raw_estims = OrderedDict()
+    for heuristic in ESTIMATORS:
+        if heuristic not in planned_heuristics:
+            continue
+        raw_estims[heuristic] = np.full(len(valid_formulas_mask), np.nan)
+        if heuristic in raw_valid_estims:
+            raw_estims[heuristic][valid_formulas_mask] = raw_valid_estims[heuristic]
+    return raw_estims
+
+
+# measurements table shared with estimation workers
+worker_measurements_memory = None
+worker_measurements_table = None
+
+
+def init_estimation_worker(memory_name, table_shape, table_dtype):
+    global worker_measurements_memory, worker_measurements_table
+    worker_measurements_memory = shared_memory.SharedMemory(name=memory_name)
+    worker_measurements_table = np.ndarray(table_shape, dtype=table_dtype, buffer=worker_measurements_memory.buf)
+
+
+def make_raw_formulas_estimation_worker(formulas_chunk, knowns_mask, param, periodicity_mode, heuristics):
+    return make_raw_formulas_estimation(formulas_chunk, worker_measurements_table, knowns_mask, param,
+                                        periodicity_mode, heuristics)
+
+
+def make_raw_formulas_estimation_parallel(formulas_list, table, knowns_mask, param, periodicity_mode, jobs,
+                                          heuristics=None):
+    """
+    same as make_raw_formulas_estimation, but formula chunks are estimated by process pool,
+    measurements table is placed in shared memory once
+    results are gathered in original order, so they are the same as serial ones
+    """
+    chunk_count = min(len(formulas_list), jobs * ESTIMATION_CHUNKS_PER_JOB)
+    if chunk_count <= 1:
+        return make_raw_formulas_estimation(formulas_list, table, knowns_mask, param, periodicity_mode, heuristics)
+    chunk_bounds = np.linspace(0, len(formulas_list), chunk_count + 1).astype(int)
+    formulas_chunks = [formulas_list[begin:end] for begin, end in zip(chunk_bounds[:-1], chunk_bounds[1:])]
+
+    table = np.ascontiguousarray(table, dtype=float)
+    measurements_memory = shared_memory.SharedMemory(create=True, size=table.nbytes)
+    try:
+        np.ndarray(table.shape, dtype=table.dtype, buffer=measurements_memory.buf)[:] = table
+        # stages of workers are not profiled
+        with profiling.stage('parallel estimation', 'estimation'), \
+                ProcessPoolExecutor(jobs,
+                                    initializer=init_estimation_worker,
+                                    initargs=(measurements_memory.name, table.shape, table.dtype)) as executor:
+            chunks_estimations = list(executor.map(make_raw_formulas_estimation_worker,
+                                                   formulas_chunks,
+                                                   [knowns_mask]*len(formulas_chunks),
+                                                   [param]*len(formulas_chunks),
+                                                   [periodicity_mode]*len(formulas_chunks),
+                                                   [heuristics]*len(formulas_chunks)))
+    finally:
+        measurements_memory.close()
+        measurements_memory.unlink()
+
+    unknown_components_points = np.concatenate([chunk[0] for chunk in chunks_estimations])
+    invalid_formulas_mask = np.concatenate([chunk[1] for chunk in chunks_estimations])
+    profiling.count('formulas marked invalid', np.count_nonzero(invalid_formulas_mask))
+    raw_estims = OrderedDict((heuristic, np.concatenate([chunk[2][heuristic] for chunk in chunks_estimations]))
+                             for heuristic in chunks_estimations[0][2])
+    return unknown_components_points, invalid_formulas_mask, raw_estims
+
+
+def make_raw_formulas_estimation_chunked(formulas_list, table, knowns_mask, param, periodicity_mode,
+                                         chunk_rows, resample_count=DEFAULT_RESAMPLE_COUNT, heuristics=None):
+    """
+    same as make_raw_formulas_estimation, but table is evaluated by blocks of chunk_rows rows,
+    so whole curves are never kept in memory:
+    magnitude, endpoints and monotonicity sums are accumulated block by block,
+    other heuristics (linearity, periodicity, custom ones) use curves resampled to at most resample_count points
+    (same as make_raw_formulas_estimation if table has no more rows)
+    returns resample parameter points, resampled curves, mask of invalid formulas and dict of heuristic columns
+    """
+    estimators = get_planned_estimators(heuristics)
+    formulas_list = FormulaBatch.from_formulas(formulas_list)
+    table_height = len(table)
+    sample_indices = np.unique(np.round(np.linspace(0, table_height - 1, min(table_height, resample_count)))
+                               .astype(int))
+    sample_param = param[sample_indices]
+    formula_count = len(formulas_list)
+
+    sampled_points = np.empty((formula_count, len(sample_indices)))
+    statistics = estimation_state.CurveStatistics(formula_count)
+    for block_begin in range(0, table_height, chunk_rows):
+        block_end = min(block_begin + chunk_rows, table_height)
+        with profiling.stage('eval_unknown_component_points', 'estimation'):
+            block_points, block_invalid = eval_unknown_components_points_batch(
+                formulas=formulas_list,
+                table=np.asarray(table[block_begin:block_end]),
+                knowns_mask=knowns_mask)
+        block_samples = (sample_indices >= block_begin) & (sample_indices < block_end)
+        sampled_points[:, block_samples] = block_points[:, sample_indices[block_samples] - block_begin]
+        statistics.update(block_points, param[block_begin:block_end], block_invalid)
+
+    invalid_formulas_mask = statistics.invalid
+    profiling.count('formulas marked invalid', np.count_nonzero(invalid_formulas_mask))
+    raw_estims = make_accumulated_raw_estimation(estimators, formulas_list, statistics, sample_param,
+                                                 sampled_points, param[[0, -1]], periodicity_mode)
+    return sample_param, sampled_points, invalid_formulas_mask, raw_estims
+
+
+def make_accumulated_raw_estimation(estimators, formulas_list, statistics, param, points, param_endpoints,
+                                    periodicity_mode, derivative_scale=1.0, jobs=1):
+    """
+    raw heuristic columns of formulas: accumulated heuristics from statistics (see CurveStatistics.make_raw_estims),
+    other planned ones (linearity, periodicity, custom ones) from curves points (by jobs processes)
+    """
+    valid_formulas_mask = np.logical_not(statistics.invalid)
+    valid_points = points[valid_formulas_mask]
+    raw_valid_estims = dict()
+    if len(valid_points) > 0:
+        raw_valid_estims.update(statistics.make_raw_estims(valid_formulas_mask, param_endpoints, derivative_scale))
+        curves_heuristics = [estimator.name for estimator in estimators
+                             if estimator.name not in ACCUMULATED_HEURISTICS]
+        raw_valid_estims.update(make_curves_raw_estimation_jobs(curves_heuristics, param, valid_points,
+                                                                formulas_list[valid_formulas_mask],
+                                                                periodicity_mode, jobs))
+    return make_raw_estims_columns(estimators, raw_valid_estims, valid_formulas_mask)
+
+
+def make_curves_raw_estimation(heuristics, param, points, formulas_list, periodicity_mode):
+    """
+    raw heuristics of already evaluated curves of valid formulas (one row per formula)
+    """
+    settings = {'periodicity_mode': periodicity_mode,
+                'curves': CurveBatch(param, points)}
+    raw_estims = dict()
+    for estimator in get_planned_estimators(heuristics):
+        with profiling.stage('estimator: ' + estimator.name, 'estimator'):
+            raw_estims[estimator.name] = estimator.estimate(param, points, formulas_list, settings)
+    return raw_estims
+
+
+def make_curves_raw_estimation_jobs(heuristics, param, points, formulas_list, periodicity_mode, jobs):
+    """
+    same as make_curves_raw_estimation, but curve chunks are estimated by process pool if jobs > 1
+    (splines of curves don't depend on chunks, so results are the same as serial ones)
+    """
+    chunk_count = min(len(points), jobs * ESTIMATION_CHUNKS_PER_JOB)
+    if jobs <= 1 or chunk_count <= 1 or len(heuristics) == 0:
+        return make_curves_raw_estimation(heuristics, param, points, formulas_list, periodicity_mode)
+    chunk_bounds = np.linspace(0, len(points), chunk_count + 1).astype(int)
+    chunk_slices = [slice(begin, end) for begin, end in zip(chunk_bounds[:-1], chunk_bounds[1:])]
+    # stages of workers are not profiled
+    with profiling.stage('parallel estimation', 'estimation'), ProcessPoolExecutor(jobs) as executor:
+        chunks_estimations = list(executor.map(make_curves_raw_estimation,
+                                               [heuristics]*chunk_count,
+                                               [param]*chunk_count,
+                                               [points[chunk_slice] for chunk_slice in chunk_slices],
+                                               [formulas_list[chunk_slice] for chunk_slice in chunk_slices],
+                                               [periodicity_mode]*chunk_count))
+    return {heuristic: np.concatenate([chunk[heuristic] for chunk in chunks_estimations])
+            for heuristic in chunks_estimations[0]}
 
 
 def eval_unknown_component_points(formula,
@@ -117,3 +707,50 @@ def eval_unknown_component_points(formula,
     powed = np.power(table, knowns_powers_inverse)
     unknown_component_points = np.prod(powed, axis=-1)
     return unknown_component_points
+
+
+def eval_unknown_components_points_batch(formulas,
+                                         table,
+                                         knowns_mask):
+    """
+    evaluates unknown component points of all formulas at once in log domain:
+    exp(log|table| * powers^T) with separately tracked sign
+    returns points (one row per formula) and mask of formulas invalid in given measurements
+    (negative measurements in non-integer power, zero in negative power, overflow)
+    """
+    formulas_powers = FormulaBatch.from_formulas(formulas).to_floats()
+    # same power inversion as in eval_unknown_component_points
+    unknowns_powers = formulas_powers[:, np.logical_not(knowns_mask)]
+    all_unknowns_in_denominator = np.all(unknowns_powers <= 0, axis=-1)
+    power_inverters = np.where(all_unknowns_in_denominator, 1.0, -1.0)
+    knowns_powers_inverse = formulas_powers * power_inverters[:, np.newaxis] * np.array(knowns_mask, dtype=float)
+
+    zero_mask = table == 0
+    negative_mask = table < 0
+    log_abs_table = np.log(np.abs(np.where(zero_mask, 1.0, table)))
+
+    # summed quantity by quantity (unlike BLAS matmul or einsum) so every point is computed
+    # the same way regardless of batch size: constant curves stay constant and
+    # formula chunks give the same results as whole list
+    log_abs_points = np.zeros((len(formulas_powers), len(table)))
+    for log_abs_column, powers_column in zip(log_abs_table.T, knowns_powers_inverse.T):
+        log_abs_points += powers_column[:, np.newaxis] * log_abs_column[np.newaxis, :]
+    unknown_components_points = np.exp(log_abs_points)
+
+    is_integer_power = np.mod(knowns_powers_inverse, 1.0) == 0.0
+    is_odd_power = np.logical_and(is_integer_power, np.mod(knowns_powers_inverse, 2.0) == 1.0)
+    negative_factors = np.einsum('nq,fq->fn', negative_mask.astype(float), is_odd_power.astype(float))
+    unknown_components_points[np.mod(negative_factors, 2.0) == 1.0] *= -1.0
+    zeros_in_positive_power = np.einsum('nq,fq->fn', zero_mask.astype(float),
+                                        (knowns_powers_inverse > 0).astype(float))
+    unknown_components_points[zeros_in_positive_power > 0] = 0.0
+    zeros_in_negative_power = np.einsum('nq,fq->fn', zero_mask.astype(float),
+                                        (knowns_powers_inverse < 0).astype(float))
+    unknown_components_points[zeros_in_negative_power > 0] = np.inf
+    # after zeros, so zero factors don't hide negative measurements in non-integer power (as in np.power)
+    negative_in_fraction_power = np.einsum('nq,fq->fn', negative_mask.astype(float),
+                                           np.logical_not(is_integer_power).astype(float))
+    unknown_components_points[negative_in_fraction_power > 0] = np.nan
+
+    invalid_formulas_mask = np.logical_not(np.all(np.isfinite(unknown_components_points), axis=-1))
+    return unknown_components_points, invalid_formulas_mask
@@ -0,0 +1,176 @@
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+
+import increase_estimation
+import magnitude_estimation
+from formula_batch import FormulaBatch
+
+# state of incremental estimation is stored in npz file,
+# it is valid while formulas are the same and previous measurements rows are not changed
+STATE_FORMAT_VERSION = 1
+
+
+class CurveStatistics(object):
+    """
+    statistics of unknown component curves (one per formula) accumulated block by block of rows:
+    invalid formulas, max magnitude, range, first and last points and sums of positive and negative derivatives
+    """
+    __slots__ = ('invalid', 'max_abs_y', 'min_y', 'max_y', 'sum_positive', 'sum_negative',
+                 'first_y', 'last_y', 'last_x', 'row_count')
+
+    def __init__(self, formula_count):
+        self.invalid = np.zeros(formula_count, dtype=bool)
+        self.max_abs_y = np.zeros(formula_count)
+        self.min_y = np.full(formula_count, np.inf)
+        self.max_y = np.full(formula_count, -np.inf)
+        # derivatives sums are normalized by curve range when all blocks are evaluated
+        self.sum_positive = np.zeros(formula_count)
+        self.sum_negative = np.zeros(formula_count)
+        self.first_y = np.zeros(formula_count)
+        self.last_y = np.zeros(formula_count)
+        self.last_x = 0.0
+        self.row_count = 0
+
+    def update(self, block_points, block_param, block_invalid):
+        """
+        adds block of curve points (one row per formula) following already added ones
+        """
+        block_row_count = block_points.shape[-1]
+        if block_row_count == 0:
+            return
+        self.invalid |= block_invalid
+        np.maximum(self.max_abs_y, np.max(np.abs(block_points), axis=-1), out=self.max_abs_y)
+        np.minimum(self.min_y, np.min(block_points, axis=-1), out=self.min_y)
+        np.maximum(self.max_y, np.max(block_points, axis=-1), out=self.max_y)
+
+        if self.row_count > 0:
+            # derivative between previous and current block
+            block_points = np.concatenate((self.last_y[:, np.newaxis], block_points), axis=-1)
+            block_param = np.concatenate(([self.last_x], block_param))
+        else:
+            self.first_y = block_points[:, 0].copy()
+        dx = np.diff(block_param)
+        assert np.all(dx != 0)
+        derivatives = np.diff(block_points, axis=-1) / dx
+        self.sum_positive += np.sum(np.where(derivatives > 0, derivatives, 0.0), axis=-1)
+        self.sum_negative += np.sum(np.where(derivatives < 0, derivatives, 0.0), axis=-1)
+        self.last_y, self.last_x = block_points[:, -1].copy(), block_param[-1]
+        self.row_count += block_row_count
+
+    def make_raw_estims(self, valid_formulas_mask, param_endpoints, derivative_scale=1.0):
+        """
+        magnitude, change magnitude, change sign and monotonicity of valid formulas,
+        param_endpoints are first and last parameter points of curves,
+        derivatives sums are multiplied by derivative_scale (if they were accumulated with other parameter step)
+        """
+        raw_valid_estims = dict()
+        raw_valid_estims['magnitude'] = self.max_abs_y[valid_formulas_mask]
+        # same as make_avg_derivative_magnitude_estimation_batch and make_increase_estimation_batch
+        # with first and last points of curves
+        endpoints = np.transpose([self.first_y[valid_formulas_mask], self.last_y[valid_formulas_mask]])
+        raw_valid_estims['change magnitude'] = magnitude_estimation.make_avg_derivative_magnitude_estimation_batch(
+            param_endpoints,
+            endpoints)
+        raw_valid_estims['change sign'] = increase_estimation.make_increase_estimation_batch(endpoints)
+        # derivatives of normalized curve are derivatives of curve divided by its range,
+        # constant curves have no derivatives
+        ranges = (self.max_y - self.min_y)[valid_formulas_mask]
+        ranges = np.where(ranges == 0.0, np.inf, ranges)
+        sum_negative = self.sum_negative[valid_formulas_mask] * derivative_scale
+        sum_positive = self.sum_positive[valid_formulas_mask] * derivative_scale
+        raw_valid_estims['monotonicity'] = np.abs(np.minimum(sum_negative / ranges, sum_positive / ranges))
+        return raw_valid_estims
+
+
+class EstimationState(object):
+    """
+    evaluated curves of formulas and their statistics for measurements rows evaluated so far,
+    statistics are accumulated with row indices as parameter points (so they don't depend on table height)
+    """
+    __slots__ = ('formulas', 'knowns_mask', 'rows_digest', 'statistics', 'curves')
+
+    def __init__(self, formulas, knowns_mask):
+        self.formulas = formulas
+        self.knowns_mask = np.asarray(knowns_mask, dtype=bool)
+        self.rows_digest = hash_rows(np.zeros((0, len(knowns_mask))))
+        self.statistics = CurveStatistics(len(formulas))
+        self.curves = np.zeros((len(formulas), 0))
+
+    def append_rows(self, block_points, block_invalid, rows):
+        """
+        adds evaluated curves of block of measurements rows following already evaluated ones,
+        rows are all evaluated measurements rows (including block ones)
+        """
+        row_count = self.statistics.row_count
+        block_param = np.arange(row_count, row_count + block_points.shape[-1], dtype=np.float64)
+        self.statistics.update(block_points, block_param, block_invalid)
+        self.curves = np.concatenate((self.curves, block_points), axis=-1)
+        self.rows_digest = hash_rows(rows)
+
+    def matches(self, formulas, knowns_mask, table):
+        """
+        true if state was made for the same formulas and its rows are beginning of table
+        """
+        row_count = self.statistics.row_count
+        return np.array_equal(self.formulas.numerators, formulas.numerators) and \
+            np.array_equal(self.formulas.denominators, formulas.denominators) and \
+            np.array_equal(self.knowns_mask, np.asarray(knowns_mask, dtype=bool)) and \
+            len(table) >= row_count and table.shape[-1] == len(self.knowns_mask) and \
+            self.rows_digest == hash_rows(table[:row_count])
+
+
+def hash_rows(rows):
+    """
+    sha256 of measurements rows (hashing is much cheaper than evaluation of formulas)
+    """
+    return hashlib.sha256(np.ascontiguousarray(rows, dtype=np.float64).tobytes()).hexdigest()
+
+
+def load_state(state_path):
+    """
+    returns EstimationState stored in state_path or None if there is no one (or it is broken)
+    """
+    try:
+        with np.load(state_path, allow_pickle=False) as stored:
+            if int(stored['version']) != STATE_FORMAT_VERSION:
+                return None
+            state = EstimationState(FormulaBatch(stored['numerators'], stored['denominators']),
+                                    stored['knowns_mask'])
+            state.rows_digest = str(stored['rows_digest'])
+            state.curves = stored['curves']
+            for field in CurveStatistics.__slots__:
+                setattr(state.statistics, field, stored['statistics_' + field])
+            state.statistics.last_x = float(state.statistics.last_x)
+            state.statistics.row_count = int(state.statistics.row_count)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, KeyError):
+        # broken state, it will be rewritten
+        return None
+    return state
+
+
+def store_state(state_path, state):
+    """
+    writes state to temporary file first, so broken state is never read
+    """
+    state_dir = os.path.dirname(os.path.abspath(state_path))
+    file_descriptor, temp_file_path = tempfile.mkstemp(dir=state_dir, suffix='.tmp')
+    try:
+        with os.fdopen(file_descriptor, 'wb') as temp_file:
+            np.savez(temp_file,
+                     version=STATE_FORMAT_VERSION,
+                     numerators=state.formulas.numerators,
+                     denominators=state.formulas.denominators,
+                     knowns_mask=state.knowns_mask,
+                     rows_digest=state.rows_digest,
+                     curves=state.curves,
+                     **{'statistics_' + field: getattr(state.statistics, field)
+                        for field in CurveStatistics.__slots__})
+        os.replace(temp_file_path, state_path)
+    except BaseException:
+        os.remove(temp_file_path)
+        raise
@@ -0,0 +1,134 @@
+from fractions import Fraction
+
+import numpy as np
+
+from rational_linear_solver import to_fraction
+
+
+class FormulaBatch(object):
+    """
+    formulas represented by rational powers of quantities, one row per formula:
+    int32 numerators and positive denominators of reduced fractions
+    (a few dozen bytes per formula instead of tuples of sympy.Rational)
+    indexing by int gives tuple of sympy.Rational (same as formulas found by search),
+    indexing by slice, mask or index array gives FormulaBatch
+    """
+    __slots__ = ('numerators', 'denominators', '_costs')
+
+    def __init__(self, numerators, denominators):
+        numerators = np.asarray(numerators, dtype=np.int64)
+        denominators = np.asarray(denominators, dtype=np.int64)
+        assert numerators.ndim == 2 and numerators.shape == denominators.shape
+        assert np.all(denominators != 0)
+        # keep fractions reduced with positive denominators, so equal powers are stored equally
+        divisors = np.gcd(numerators, denominators) * np.sign(denominators)
+        self.numerators = (numerators // divisors).astype(np.int32)
+        self.denominators = (denominators // divisors).astype(np.int32)
+        self._costs = None
+
+    @staticmethod
+    def from_power_fractions(power_fractions_list, quantity_count=None):
+        """
+        makes batch from formulas represented by (numerator, denominator) pairs
+        """
+        power_fractions = np.array(power_fractions_list, dtype=np.int64)
+        if len(power_fractions) == 0:
+            power_fractions = np.ones((0, quantity_count or 0, 2), dtype=np.int64)
+        return FormulaBatch(power_fractions[:, :, 0], power_fractions[:, :, 1])
+
+    @staticmethod
+    def from_formulas(formulas, quantity_count=None):
+        """
+        makes batch from formulas represented by powers (sympy.Rational, Fraction or int),
+        batches are returned as is
+        """
+        if isinstance(formulas, FormulaBatch):
+            return formulas
+        power_fractions_list = []
+        for formula in formulas:
+            power_fractions = []
+            for power in formula:
+                power = to_fraction(power)
+                power_fractions.append((power.numerator, power.denominator))
+            power_fractions_list.append(power_fractions)
+        return FormulaBatch.from_power_fractions(power_fractions_list, quantity_count)
+
+    @staticmethod
+    def concatenate(batches):
+        return FormulaBatch(np.concatenate([batch.numerators for batch in batches]),
+                            np.concatenate([batch.denominators for batch in batches]))
+
+    @property
+    def quantity_count(self):
+        return self.numerators.shape[1]
+
+    @property
+    def nbytes(self):
+        return self.numerators.nbytes + self.denominators.nbytes
+
+    def costs(self):
+        """
+        formula costs (sums of |numerator| + |denominator| of powers), computed once
+        """
+        if self._costs is None:
+            self._costs = np.sum(np.abs(self.numerators.astype(np.int64)) + self.denominators, axis=-1)
+            # batch may be shared (see search_cache.enable_memory_cache), so are its costs
+            self._costs.setflags(write=False)
+        return self._costs
+
+    def to_floats(self):
+        return self.numerators / self.denominators.astype(np.float64)
+
+    def append_power(self, numerator, denominator=1):
+        """
+        returns batch with additional power of one more quantity in every formula
+        """
+        return FormulaBatch(np.column_stack((self.numerators, np.full(len(self), numerator))),
+                            np.column_stack((self.denominators, np.full(len(self), denominator))))
+
+    def get_power_fractions(self, formula_indx):
+        """
+        powers of formula as tuple of fractions.Fraction
+        """
+        return tuple(Fraction(numerator, denominator) for numerator, denominator
+                     in zip(self.numerators[formula_indx].tolist(), self.denominators[formula_indx].tolist()))
+
+    def __len__(self):
+        return len(self.numerators)
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            import sympy as sp
+            return tuple(sp.Rational(numerator, denominator) for numerator, denominator
+                         in zip(self.numerators[key].tolist(), self.denominators[key].tolist()))
+        return FormulaBatch(self.numerators[key], self.denominators[key])
+
+    def __iter__(self):
+        for formula_indx in range(len(self)):
+            yield self[formula_indx]
+
+    def __eq__(self, other):
+        if isinstance(other, FormulaBatch):
+            return np.array_equal(self.numerators, other.numerators) and \
+                np.array_equal(self.denominators, other.denominators)
+        try:
+            return len(self) == len(other) and all(
+                tuple(formula) == tuple(other_formula) for formula, other_formula in zip(self, other))
+        except TypeError:
+            return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'FormulaBatch({} formulas of {} quantities)'.format(len(self), self.quantity_count)
+
+    def __getstate__(self):
+        return self.numerators, self.denominators
+
+    def __setstate__(self, state):
+        self.numerators, self.denominators = state
+        self._costs = None
@@ -1,5 +1,5 @@
 import numpy as np
-from common_tools import nearly_equal
+from common_tools import nearly_equal, nearly_equal_batch
 
 def make_increase_estimation(unknown_component_points):
     table_Y = unknown_component_points
@@ -10,3 +10,13 @@ def make_increase_estimation(unknown_component_points):
     return 1.0 if yn > y0 else 0.0
 
 
+def make_increase_estimation_batch(unknown_components_points):
+    """
+    same as make_increase_estimation for many curves at once (one row per curve)
+    """
+    table_Y = np.atleast_2d(unknown_components_points)
+
+    y0, yn = table_Y[:, 0], table_Y[:, -1]
+    estimations = np.where(yn > y0, 1.0, 0.0)
+    estimations[nearly_equal_batch(y0, yn)] = 0.5
+    return estimations
@@ -1,6 +1,7 @@
 import common_tools as ct
+import profiling
+from curve_batch import CurveBatch
 import numpy as np
-from scipy.interpolate import UnivariateSpline
 
 
 def make_linearity_estimation(param, unknown_component_points, dbg_figname=None):
@@ -24,6 +25,8 @@ def make_linearity_estimation(param, unknown_component_points, dbg_figname=None)
             for y in Y_normalized:
                 print(y, file=ys_log)
 
+    from scipy.interpolate import UnivariateSpline
+    profiling.count('spline fits')
     spline = UnivariateSpline(table_X, Y_normalized, k=4, s=0)
 
     segment_count = 20
@@ -57,4 +60,34 @@ def make_linearity_estimation(param, unknown_component_points, dbg_figname=None)
 
     total_linearity = sum(segments_linearity) / segment_count
 
-    return total_linearity
\ No newline at end of file
+    return total_linearity
+
+
+def make_linearity_estimation_batch(param, unknown_components_points, curves=None):
+    """
+    same as make_linearity_estimation, but for many curves at once (one row per curve)
+    curves is CurveBatch of the same points (its splines are reused)
+    """
+    if curves is None:
+        curves = CurveBatch(param, unknown_components_points)
+    domain = curves.domain
+
+    segment_count = 20
+    step = 1.0 / segment_count
+    segment_center_xs = domain[0] + (domain[1] - domain[0]) * (step * np.arange(segment_count) + step * 0.5)
+    segment_center_xs = np.clip(segment_center_xs, domain[0], domain[1])
+    segment_corner_xs = domain[0] + (domain[1] - domain[0]) * (step * np.arange(segment_count + 1))
+    segment_center_ys = curves.evaluate(segment_center_xs)
+    segment_corner_ys = curves.evaluate(segment_corner_xs)
+
+    left_dirs_x = segment_corner_xs[:-1] - segment_center_xs
+    left_dirs_y = segment_corner_ys[:, :-1] - segment_center_ys
+    right_dirs_x = segment_corner_xs[1:] - segment_center_xs
+    right_dirs_y = segment_corner_ys[:, 1:] - segment_center_ys
+    left_norms = np.hypot(left_dirs_x, left_dirs_y)
+    right_norms = np.hypot(right_dirs_x, right_dirs_y)
+    angle_cos = (left_dirs_x * right_dirs_x + left_dirs_y * right_dirs_y) / (left_norms * right_norms)
+
+    total_linearity = np.mean(0.5 - angle_cos*0.5, axis=-1)
+    total_linearity[curves.constant_curves] = 1.0
+    return total_linearity
@@ -9,4 +9,21 @@ def make_avg_derivative_magnitude_estimation(param, evaluated_unknown_points):
     table_X, table_Y = param, evaluated_unknown_points
 
     dxdy_avg = (table_Y[-1] - table_Y[0]) / (table_X[-1] - table_X[0])
-    return abs(dxdy_avg)
\ No newline at end of file
+    return abs(dxdy_avg)
+
+
+def make_magnitude_penalty_batch(evaluated_unknown_points):
+    """
+    same as make_magnitude_penalty for many curves at once (one row per curve)
+    """
+    return np.max(np.abs(np.atleast_2d(evaluated_unknown_points)), axis=-1)
+
+
+def make_avg_derivative_magnitude_estimation_batch(param, evaluated_unknown_points):
+    """
+    same as make_avg_derivative_magnitude_estimation for many curves at once (one row per curve)
+    """
+    table_X, table_Y = param, np.atleast_2d(evaluated_unknown_points)
+
+    dxdy_avg = (table_Y[:, -1] - table_Y[:, 0]) / (table_X[-1] - table_X[0])
+    return np.abs(dxdy_avg)
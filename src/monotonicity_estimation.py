@@ -1,6 +1,5 @@
 import common_tools as ct
 import numpy as np
-from scipy.interpolate import UnivariateSpline
 
 def make_non_monothonicity_estimation(param, unknown_component_points, dbg_figname=None):
     table_X, table_Y = param, unknown_component_points
@@ -26,4 +25,28 @@ def make_non_monothonicity_estimation(param, unknown_component_points, dbg_figna
 
     estimation = abs(min(sum_negative, sum_positive))
 
-    return estimation
\ No newline at end of file
+    return estimation
+
+
+def make_non_monothonicity_estimation_batch(param, unknown_components_points):
+    """
+    same as make_non_monothonicity_estimation for many curves at once (one row per curve)
+    """
+    table_X, table_Y = np.asarray(param), np.atleast_2d(unknown_components_points)
+    min_y = np.min(table_Y, axis=-1, keepdims=True)
+    max_y = np.max(table_Y, axis=-1, keepdims=True)
+
+    X_normalized = table_X
+    # constant curves have no derivatives (as nan derivatives in make_non_monothonicity_estimation)
+    Y_normalized = (table_Y - min_y) / np.where(min_y == max_y, np.inf, max_y - min_y)
+
+    dx = np.diff(X_normalized)
+    assert np.all(dx != 0)
+    derivatives = np.diff(Y_normalized, axis=-1) / dx
+
+    sum_positive = np.sum(np.where(derivatives > 0, derivatives, 0.0), axis=-1)
+    sum_negative = np.sum(np.where(derivatives < 0, derivatives, 0.0), axis=-1)
+
+    estimation = np.abs(np.minimum(sum_negative, sum_positive))
+
+    return estimation
@@ -1,5 +1,5 @@
-import sympy
 from enum import Enum
+from fractions import Fraction
 import re
 from collections import OrderedDict
 
@@ -25,9 +25,9 @@ class MultiplicationParser(object):
             raise Exception("Empty unit name while parsing '{}'".format(self.str_expr))
         if name[0] in ('0', '1', '2', '3', '4', '5', '6', '7', '8', '9'):
             raise Exception("Unit names starting with digits are not allowed (while parsing '{}')".format(self.str_expr))
-        power_rational = sympy.Rational(power[0], power[1])
-        if power_rational == sympy.nan:
+        if power[1] == 0:
             raise Exception("Unexpected power value (while parsing '{}')".format(self.str_expr))
+        power_rational = Fraction(power[0], power[1])
         self.units.append((name, power_rational))
 
     def __reset_current_unit(self):
@@ -1,6 +1,7 @@
 import common_tools as ct
+import profiling
+from curve_batch import CurveBatch
 import numpy as np
-from scipy.interpolate import UnivariateSpline
 
 
 def are_function_segments_equal(function, segment1_domain, segment2_domain, accuracy):
@@ -42,7 +43,7 @@ def split_domain_on_segments(domain, segment_length, accuracy):
     return segments_domains
 
 
-def make_periodicity_estimation(table_X, table_Y, dbg_figname=None):
+def make_periodicity_estimation(table_X, table_Y, dbg_figname=None, spline=None):
     '''
     взять стартовую точку
     найти все y совпадающие с данной в пределах точности
@@ -54,6 +55,7 @@ def make_periodicity_estimation(table_X, table_Y, dbg_figname=None):
     если 2 сравниваемых периода совпало, необходимо проверить все вмещающиеся в область определения периоды
     (включая возможно незавершенный период в конце области определения)
     если периоды совпали: оценка периодичности = 1 - accuracy
+    spline (optional) is interpolating spline of normalized curve, fitted if not given
     '''
     domain = np.min(table_X), np.max(table_X)
     min_y, max_y = np.min(table_Y), np.max(table_Y)
@@ -72,7 +74,10 @@ def make_periodicity_estimation(table_X, table_Y, dbg_figname=None):
             for y in Y_normalized:
                 print(y, file=ys_log)
 
-    spline = UnivariateSpline(table_X, Y_normalized, k=4, s=0)
+    if spline is None:
+        from scipy.interpolate import UnivariateSpline
+        profiling.count('spline fits')
+        spline = UnivariateSpline(table_X, Y_normalized, k=4, s=0)
 
     step = 0.01
     accuracy = 0.0
@@ -99,3 +104,52 @@ def make_periodicity_estimation(table_X, table_Y, dbg_figname=None):
     if not periodicity_found:
         return 0.0
     return ct.clamp(0.0, 1.0, 1.0 - accuracy)
+
+
+def make_periodicity_estimation_batch(table_X, unknown_components_points, resample_count=None, curves=None):
+    '''
+    periodicity of many curves at once (one row per curve) based on autocorrelation
+    curves are normalized, resampled on uniform grid by interpolating spline and linear trend is removed
+    autocorrelation is calculated by fft, estimation is the highest autocorrelation after its first zero crossing
+    (lags up to half of domain are considered, so at least two periods should fit in domain)
+    curves is CurveBatch of the same points (its splines and resamples are reused)
+    '''
+    if curves is None:
+        curves = CurveBatch(table_X, unknown_components_points)
+    if resample_count is None:
+        resample_count = curves.normalized.shape[-1]
+
+    estimations = np.zeros(len(curves))
+    estimations[curves.constant_curves] = 1.0
+    max_lag = resample_count // 2
+    if max_lag < 2:
+        return estimations
+
+    xs, ys = curves.resample(resample_count)
+
+    # least squares line of every curve, computed row by row (unlike polyfit),
+    # so estimation of a curve doesn't depend on other curves of batch
+    xs_centered = xs - np.mean(xs)
+    ys_mean = np.mean(ys, axis=-1, keepdims=True)
+    slopes = np.sum((ys - ys_mean) * xs_centered, axis=-1, keepdims=True) / np.sum(xs_centered * xs_centered)
+    ys = ys - ys_mean - slopes * xs_centered
+
+    fft_size = 1 << int(np.ceil(np.log2(2 * resample_count)))
+    spectrum = np.fft.rfft(ys, fft_size, axis=-1)
+    autocorrelation = np.fft.irfft(spectrum * np.conj(spectrum), fft_size, axis=-1)[:, :max_lag+1]
+    # unbiased autocorrelation, normalized to 1 at zero lag
+    autocorrelation /= (resample_count - np.arange(max_lag+1))
+    zero_lag = autocorrelation[:, :1]
+    # nothing but linear trend (curves are normalized, so absolute threshold is fine)
+    linear_curves = zero_lag[:, 0] <= 1e-10
+    autocorrelation /= np.where(zero_lag > 0.0, zero_lag, 1.0)
+
+    negative = autocorrelation < 0.0
+    has_zero_crossing = np.any(negative, axis=-1)
+    first_zero_crossing = np.argmax(negative, axis=-1)
+    after_zero_crossing = np.arange(max_lag+1)[np.newaxis, :] >= first_zero_crossing[:, np.newaxis]
+    highest_autocorrelation = np.max(np.where(after_zero_crossing, autocorrelation, -np.inf), axis=-1)
+
+    periodic_curves = has_zero_crossing & np.logical_not(curves.constant_curves) & np.logical_not(linear_curves)
+    estimations[periodic_curves] = np.clip(highest_autocorrelation[periodic_curves], 0.0, 1.0)
+    return estimations
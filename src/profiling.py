@@ -0,0 +1,142 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# profiler of current process, None when profiling is disabled
+# (then stages and counters cost one global lookup)
+active_profiler = None
+
+
+class Profiler(object):
+    """
+    collects timed stages and counters of current process
+    (stages of worker processes are not collected, their time is included in enclosing stages)
+    """
+    def __init__(self):
+        self.start_time = time.perf_counter()
+        # (name, category, start seconds, duration seconds, thread id)
+        self.events = []
+        # (name, seconds since start, counter value)
+        self.counter_events = []
+        self.counters = OrderedDict()
+
+    def add_stage(self, name, category, start_time, end_time):
+        self.events.append((name, category, start_time - self.start_time, end_time - start_time,
+                            threading.get_ident()))
+
+    def count(self, name, value):
+        total = self.counters.get(name, 0) + value
+        self.counters[name] = total
+        self.counter_events.append((name, time.perf_counter() - self.start_time, total))
+
+    def make_summary(self):
+        """
+        calls, total and max seconds per stage (in order of first call) and counters totals
+        """
+        stages = OrderedDict()
+        for name, category, _, duration, _ in self.events:
+            if name not in stages:
+                stages[name] = OrderedDict((('category', category), ('calls', 0), ('seconds', 0.0),
+                                            ('max seconds', 0.0)))
+            stage_summary = stages[name]
+            stage_summary['calls'] += 1
+            stage_summary['seconds'] += duration
+            stage_summary['max seconds'] = max(stage_summary['max seconds'], duration)
+        return OrderedDict((('seconds', time.perf_counter() - self.start_time),
+                            ('stages', stages),
+                            ('counters', self.counters)))
+
+    def make_chrome_trace(self):
+        """
+        trace in chrome trace event format (chrome://tracing, perfetto), times are in microseconds
+        """
+        process_id = os.getpid()
+        trace_events = [{'name': name, 'cat': category, 'ph': 'X', 'ts': start * 1e6, 'dur': duration * 1e6,
+                         'pid': process_id, 'tid': thread_id}
+                        for name, category, start, duration, thread_id in self.events]
+        trace_events += [{'name': name, 'ph': 'C', 'ts': timestamp * 1e6, 'pid': process_id, 'tid': 0,
+                          'args': {name: value}}
+                         for name, timestamp, value in self.counter_events]
+        return {'traceEvents': trace_events, 'displayTimeUnit': 'ms'}
+
+    def write(self, summary_path):
+        """
+        writes json summary to summary_path and chrome trace next to it (summary_name.trace.json)
+        """
+        with open(summary_path, 'w') as summary_file:
+            json.dump(self.make_summary(), summary_file, indent=2)
+        with open(get_trace_path(summary_path), 'w') as trace_file:
+            json.dump(self.make_chrome_trace(), trace_file)
+
+
+class ProfiledStage(object):
+    __slots__ = ('profiler', 'name', 'category', 'start_time')
+
+    def __init__(self, profiler, name, category):
+        self.profiler = profiler
+        self.name = name
+        self.category = category
+        self.start_time = None
+
+    def __enter__(self):
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profiler.add_stage(self.name, self.category, self.start_time, time.perf_counter())
+        return False
+
+
+class NullStage(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NULL_STAGE = NullStage()
+
+
+def get_trace_path(summary_path):
+    return os.path.splitext(summary_path)[0] + '.trace.json'
+
+
+def stage(name, category='stage'):
+    """
+    context manager timing a stage, does nothing if profiling is disabled
+    """
+    if active_profiler is None:
+        return NULL_STAGE
+    return ProfiledStage(active_profiler, name, category)
+
+
+def count(name, value=1):
+    """
+    adds value to counter, does nothing if profiling is disabled
+    """
+    if active_profiler is not None:
+        active_profiler.count(name, value)
+
+
+def enable():
+    """
+    starts profiling of current process, returns new profiler
+    """
+    global active_profiler
+    active_profiler = Profiler()
+    return active_profiler
+
+
+def disable():
+    """
+    stops profiling, returns profiler collected stages (or None if profiling was not enabled)
+    """
+    global active_profiler
+    profiler = active_profiler
+    active_profiler = None
+    return profiler
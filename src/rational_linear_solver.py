@@ -0,0 +1,113 @@
+from fractions import Fraction
+from math import gcd
+
+
+def to_fraction(x):
+    # sympy.Rational exposes numerator/denominator as p/q
+    if hasattr(x, 'p') and hasattr(x, 'q'):
+        return Fraction(int(x.p), int(x.q))
+    return Fraction(x)
+
+
+def lcm(a, b):
+    return a * b // gcd(a, b)
+
+
+def make_integer_row(fractions_row):
+    denominators_lcm = 1
+    for x in fractions_row:
+        denominators_lcm = lcm(denominators_lcm, x.denominator)
+    return [int(x * denominators_lcm) for x in fractions_row]
+
+
+def reduce_integer_row(row):
+    row_gcd = 0
+    for x in row:
+        row_gcd = gcd(row_gcd, x)
+    if row_gcd <= 1:
+        return row
+    return [x // row_gcd for x in row]
+
+
+def integer_echelon_form(augmented_rows, variable_count):
+    """
+    fraction-free gaussian elimination
+    rows are processed in given order, if current row has no pivot in current column
+    pivot is searched in the next columns of the same row and columns are swapped
+    (same pivoting as sympy.solve_linear_system, so dependent variables are chosen the same way)
+    every row is kept integer and divided by gcd of its elements after each step
+    returns upper triangular rows, permuted column order and rank
+    raises ValueError if system is inconsistent
+    """
+    rows = [list(row) for row in augmented_rows]
+    columns_order = list(range(variable_count))
+    i = 0
+    while i < len(rows):
+        if i == variable_count:
+            if any(row[-1] != 0 for row in rows[i:]):
+                raise ValueError('System of equations is inconsistent')
+            del rows[i:]
+            break
+        row = rows[i]
+        if row[columns_order[i]] == 0:
+            pivot_position = None
+            for k in range(i + 1, variable_count):
+                if row[columns_order[k]] != 0:
+                    pivot_position = k
+                    break
+            if pivot_position is None:
+                if row[-1] != 0:
+                    raise ValueError('System of equations is inconsistent')
+                # zero row or linear combination of previous rows
+                del rows[i]
+                continue
+            columns_order[i], columns_order[pivot_position] = columns_order[pivot_position], columns_order[i]
+        pivot_col = columns_order[i]
+        pivot = row[pivot_col]
+        for k in range(i + 1, len(rows)):
+            factor = rows[k][pivot_col]
+            if factor == 0:
+                continue
+            rows[k] = reduce_integer_row([pivot * x - factor * p for x, p in zip(rows[k], row)])
+        i += 1
+    return rows, columns_order, len(rows)
+
+
+def solve_rational_system(coefficient_rows, right_side):
+    """
+    solves A*x = b exactly (A given as rows of rationals)
+    returns pivot (dependent) variable indices, free (independent) variable indices,
+    particular solution (free variables set to zero) and
+    nullspace basis (one vector per free variable)
+    raises ValueError if system is inconsistent
+    """
+    assert len(coefficient_rows) == len(right_side)
+    variable_count = len(coefficient_rows[0]) if len(coefficient_rows) > 0 else 0
+    augmented_rows = [reduce_integer_row(make_integer_row([to_fraction(x) for x in row] + [to_fraction(b)]))
+                      for row, b in zip(coefficient_rows, right_side)]
+
+    rows, columns_order, rank = integer_echelon_form(augmented_rows, variable_count)
+    pivot_columns = columns_order[:rank]
+    free_columns = sorted(columns_order[rank:])
+
+    # back substitution, pivot variables are expressed through free ones:
+    # x = particular_solution + sum(free_x * nullspace_vector)
+    particular_solution = [Fraction(0)] * variable_count
+    nullspace_basis = [[Fraction(0)] * variable_count for _ in free_columns]
+    for basis_vector, free_col in zip(nullspace_basis, free_columns):
+        basis_vector[free_col] = Fraction(1)
+    for k in reversed(range(rank)):
+        row = rows[k]
+        pivot_col = pivot_columns[k]
+        pivot = row[pivot_col]
+        value = Fraction(row[-1])
+        for solved_col in pivot_columns[k+1:]:
+            value -= row[solved_col] * particular_solution[solved_col]
+        particular_solution[pivot_col] = value / pivot
+        for basis_vector in nullspace_basis:
+            value = Fraction(0)
+            for col in columns_order[k+1:]:
+                value -= row[col] * basis_vector[col]
+            basis_vector[pivot_col] = value / pivot
+
+    return pivot_columns, free_columns, particular_solution, nullspace_basis
@@ -1,15 +1,29 @@
-import pylatex as pl
-from sympy import fraction
+import csv
+import json
 import os.path
 import urllib.parse
+from collections import OrderedDict
+from itertools import islice
+
+import profiling
+from rational_linear_solver import to_fraction
+
+# rows written to parquet at once
+PARQUET_ROWS_PER_GROUP = 65536
+# power columns of machine-readable reports are prefixed,
+# so quantities named like other columns (e.g. N or total) don't overwrite them
+POWER_COLUMN_PREFIX = 'power_'
 
 
 def gen_latex_formula(quantity_names, powers):
+    import pylatex as pl
+
     positive_powers = [i for i in range(len(powers)) if powers[i] > 0]
     negative_powers = [i for i in range(len(powers)) if powers[i] < 0]
 
     def quantity_with_power_to_latex(name, power):
-        numerator, denominator = fraction(power)
+        power = to_fraction(power)
+        numerator, denominator = power.numerator, power.denominator
         assert numerator != 0
         # negative powers are processed separately
         numerator, denumerator = abs(numerator), abs(denominator)
@@ -42,6 +56,100 @@ def gen_latex_formula(quantity_names, powers):
 
 
 def print_report(report_table, columns_ordered, quantity_names_ordered, out_path):
+    """
+    writes ranked rows (any iterable, rows are written as they come, except pdf)
+    in format chosen by out_path extension
+    """
+    get_report_writer(out_path)(report_table, columns_ordered, quantity_names_ordered, out_path)
+
+
+def get_report_writer(out_path):
+    """
+    returns report writer for out_path extension, raises ValueError if there is no such writer
+    """
+    path_and_ext = os.path.splitext(out_path)
+    if len(path_and_ext) != 2:
+        raise ValueError('Wrong output path: "{}"'.format(out_path))
+    ext = path_and_ext[1].lower()
+    if ext not in REPORT_WRITERS:
+        raise ValueError('Unsupported report extension "{}", supported ones are {}'.format(
+            ext, ', '.join(sorted(REPORT_WRITERS.keys()))))
+    return REPORT_WRITERS[ext]
+
+
+def make_report_record_columns(columns_ordered, quantity_names_ordered):
+    """
+    columns of machine-readable reports: rank, power of every quantity, heuristics and total
+    """
+    heuristic_columns = [col_name for col_name in columns_ordered if col_name not in ('formula', 'total')]
+    return ['N'] + make_power_columns(quantity_names_ordered) + heuristic_columns + ['total']
+
+
+def make_power_columns(quantity_names_ordered):
+    return [POWER_COLUMN_PREFIX + quantity_name for quantity_name in quantity_names_ordered]
+
+
+def iterate_report_records(report_table, columns_ordered, quantity_names_ordered):
+    """
+    lazily converts report rows to flat records (powers as exact fraction strings)
+    """
+    heuristic_columns = [col_name for col_name in columns_ordered if col_name not in ('formula', 'total')]
+    power_columns = make_power_columns(quantity_names_ordered)
+    for row_indx, row in enumerate(report_table):
+        record = OrderedDict()
+        record['N'] = row_indx + 1
+        for power_column, power in zip(power_columns, row['formula']):
+            record[power_column] = str(to_fraction(power))
+        for col_name in heuristic_columns:
+            record[col_name] = float(row[col_name])
+        record['total'] = float(row['total'])
+        yield record
+
+
+def print_report_csv(report_table, columns_ordered, quantity_names_ordered, out_path):
+    with open(out_path, 'w', newline='') as out_file:
+        writer = csv.writer(out_file, dialect='excel')
+        writer.writerow(make_report_record_columns(columns_ordered, quantity_names_ordered))
+        for record in iterate_report_records(report_table, columns_ordered, quantity_names_ordered):
+            writer.writerow(record.values())
+
+
+def print_report_ndjson(report_table, columns_ordered, quantity_names_ordered, out_path):
+    with open(out_path, 'w') as out_file:
+        for record in iterate_report_records(report_table, columns_ordered, quantity_names_ordered):
+            out_file.write(json.dumps(record) + '\n')
+
+
+def print_report_parquet(report_table, columns_ordered, quantity_names_ordered, out_path,
+                         rows_per_group=PARQUET_ROWS_PER_GROUP):
+    # optional dependency, needed only for parquet reports
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ValueError('pyarrow is required to write parquet reports')
+
+    record_columns = make_report_record_columns(columns_ordered, quantity_names_ordered)
+    power_columns = make_power_columns(quantity_names_ordered)
+    schema = pa.schema([(col_name, pa.int64() if col_name == 'N'
+                         else pa.string() if col_name in power_columns
+                         else pa.float64())
+                        for col_name in record_columns])
+    with pq.ParquetWriter(out_path, schema) as writer:
+        records = iterate_report_records(report_table, columns_ordered, quantity_names_ordered)
+        while True:
+            group = list(islice(records, rows_per_group))
+            if len(group) == 0:
+                break
+            writer.write_table(pa.Table.from_pydict(
+                {col_name: [record[col_name] for record in group] for col_name in record_columns},
+                schema=schema))
+
+
+def print_report_pdf(report_table, columns_ordered, quantity_names_ordered, out_path):
+    # pylatex (and latex) are needed only for pdf reports
+    import pylatex as pl
+
     doc = pl.Document()
     doc.documentclass = pl.Command(
         'documentclass',
@@ -89,12 +197,14 @@ def print_report(report_table, columns_ordered, quantity_names_ordered, out_path
                 row_ordered = [row_indx + 1] + row_ordered
                 summaries_table.add_row(row_ordered)
 
-    path_and_ext = os.path.splitext(out_path)
-    if len(path_and_ext) != 2:
-        raise ValueError('Wrong output path: "{}"'.format(out_path))
-    ext = path_and_ext[1].lower()
-    if ext != '.pdf':
-        raise ValueError('Only pdf files are supported')
-
-    doc.generate_pdf(out_path)
+    with profiling.stage('latex compile', 'report'):
+        doc.generate_pdf(out_path)
     doc.generate_tex(out_path + '.tex')
+
+
+REPORT_WRITERS = {
+    '.csv': print_report_csv,
+    '.ndjson': print_report_ndjson,
+    '.jsonl': print_report_ndjson,
+    '.parquet': print_report_parquet,
+    '.pdf': print_report_pdf}
@@ -0,0 +1,153 @@
+import hashlib
+import json
+import os
+import tempfile
+from collections import OrderedDict
+from fractions import Fraction
+
+import profiling
+from formula_batch import FormulaBatch
+from rational_linear_solver import to_fraction
+
+# formulas found for the same units and search parameters don't depend on measurements,
+# so they are stored on disk (in directory given by user) by hash of units and search parameters
+CACHE_FORMAT_VERSION = 1
+DEFAULT_MAX_CACHE_BYTES = 64 * 1024 * 1024
+CACHE_FILE_EXTENSION = '.json'
+MAX_MEMORY_CACHE_ENTRIES = 256
+
+# (cache dir, search key) -> read-only FormulaBatch, least recently used first,
+# it is enabled by processes performing many searches (batch and server workers)
+memory_cache = OrderedDict()
+max_memory_cache_entries = 0
+
+
+def enable_memory_cache(max_entries=MAX_MEMORY_CACHE_ENTRIES):
+    """
+    keeps up to max_entries recently used formulas in memory of current process (0 disables memory cache)
+    """
+    global max_memory_cache_entries
+    max_memory_cache_entries = max_entries
+    memory_cache.clear()
+
+
+def canonical_units(units_vector):
+    return [str(to_fraction(unit_power)) for unit_power in units_vector]
+
+
+def make_canonical_formulas(formulas):
+    formula_batch = FormulaBatch.from_formulas(formulas)
+    return [['{}/{}'.format(numerator, denominator) if denominator != 1 else str(numerator)
+             for numerator, denominator in zip(numerators, denominators)]
+            for numerators, denominators in zip(formula_batch.numerators.tolist(),
+                                                formula_batch.denominators.tolist())]
+
+
+def make_search_key(required_units, quantities_units, search_params):
+    """
+    sha256 of canonical representation of target units vector,
+    units matrix of influencing quantities (in given order) and search parameters dict
+    """
+    canonical_search = {
+        'version': CACHE_FORMAT_VERSION,
+        'required_units': canonical_units(required_units),
+        'quantities_units': [canonical_units(units_vector) for units_vector in quantities_units],
+        'search_params': search_params}
+    canonical_str = json.dumps(canonical_search, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical_str.encode('utf-8')).hexdigest()
+
+
+def get_cache_file_path(cache_dir, key):
+    return os.path.join(cache_dir, key + CACHE_FILE_EXTENSION)
+
+
+def load_formulas(cache_dir, key):
+    """
+    returns cached formulas (FormulaBatch) or None if there are no ones
+    loaded entry becomes most recently used
+    """
+    cache_file_path = get_cache_file_path(cache_dir, key)
+    try:
+        with open(cache_file_path, 'r') as cache_file:
+            formulas = FormulaBatch.from_formulas([[Fraction(power) for power in formula]
+                                                   for formula in json.load(cache_file)])
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, TypeError):
+        # broken entry, it will be rewritten
+        return None
+    try:
+        os.utime(cache_file_path)
+    except OSError:
+        pass
+    return formulas
+
+
+def store_formulas(cache_dir, key, formulas, max_cache_bytes=DEFAULT_MAX_CACHE_BYTES):
+    """
+    stores formulas and evicts least recently used entries if cache exceeds max_cache_bytes
+    cache is optional, so file system errors are ignored
+    """
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        # write to temporary file first, so other processes never read partial entries
+        file_descriptor, temp_file_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(file_descriptor, 'w') as temp_file:
+                json.dump(make_canonical_formulas(formulas), temp_file)
+            os.replace(temp_file_path, get_cache_file_path(cache_dir, key))
+        except BaseException:
+            os.remove(temp_file_path)
+            raise
+        evict_least_recently_used(cache_dir, max_cache_bytes)
+    except OSError:
+        pass
+
+
+def evict_least_recently_used(cache_dir, max_cache_bytes):
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.is_file() and entry.name.endswith(CACHE_FILE_EXTENSION):
+            entry_stat = entry.stat()
+            entries.append((entry_stat.st_mtime, entry_stat.st_size, entry.path))
+    total_bytes = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total_bytes <= max_cache_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total_bytes -= size
+
+
+def search_formulas_cached(search, required_units, quantities_units, search_params,
+                           cache_dir=None, max_cache_bytes=DEFAULT_MAX_CACHE_BYTES):
+    """
+    returns cached formulas if the same search was performed before,
+    otherwise calls search() and caches its result (on disk if cache_dir is given)
+    recently used formulas are also kept in memory of current process if it is enabled (see enable_memory_cache),
+    such formulas are shared, so their arrays are read-only
+    formulas are returned as FormulaBatch
+    """
+    key = make_search_key(required_units, quantities_units, search_params)
+    memory_key = (None if cache_dir is None else os.path.abspath(cache_dir), key)
+    if memory_key in memory_cache:
+        profiling.count('search cache hits')
+        memory_cache.move_to_end(memory_key)
+        return memory_cache[memory_key]
+    formulas = load_formulas(cache_dir, key) if cache_dir is not None else None
+    if formulas is not None:
+        profiling.count('search cache hits')
+    else:
+        profiling.count('search cache misses')
+        formulas = FormulaBatch.from_formulas(list(search()), len(quantities_units))
+        if cache_dir is not None:
+            store_formulas(cache_dir, key, formulas, max_cache_bytes)
+    if max_memory_cache_entries > 0:
+        formulas.numerators.setflags(write=False)
+        formulas.denominators.setflags(write=False)
+        memory_cache[memory_key] = formulas
+        while len(memory_cache) > max_memory_cache_entries:
+            memory_cache.popitem(last=False)
+    return formulas
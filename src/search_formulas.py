@@ -1,9 +1,63 @@
+import heapq
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from itertools import islice
+from math import gcd
+
+import numpy as np
 import sympy as sp
 
+import profiling
+import rational_linear_solver
+from formula_batch import FormulaBatch
+
 
 class DimensionalFormulaSearch(object):
+    SOLVERS = ('exact', 'sympy')
+    # candidates evaluated by one matrix product
+    BATCH_SIZE = 4096
+
+    @staticmethod
+    def find_powers_equations(required_quantity_units, influencing_quantities_units, solver='exact'):
+        if solver == 'exact':
+            with profiling.stage('find_powers_equations (exact)', 'search'):
+                return DimensionalFormulaSearch.find_powers_equations_exact(
+                    required_quantity_units, influencing_quantities_units)
+        elif solver == 'sympy':
+            with profiling.stage('find_powers_equations (sympy)', 'search'):
+                return DimensionalFormulaSearch.find_powers_equations_sympy(
+                    required_quantity_units, influencing_quantities_units)
+        raise ValueError('Unknown solver "{}"'.format(solver))
+
+    @staticmethod
+    def find_powers_equations_exact(required_quantity_units, influencing_quantities_units):
+        num_rows = len(influencing_quantities_units)
+        assert num_rows > 0
+        num_cols = len(influencing_quantities_units[0])
+        assert num_cols == len(required_quantity_units)
+
+        # one equation per base unit: sum of quantity powers multiplied by unit powers
+        equations_rows = [[quantity_units[col] for quantity_units in influencing_quantities_units]
+                          for col in range(num_cols)]
+        try:
+            pivot_indices, free_indices, particular_solution, nullspace_basis = \
+                rational_linear_solver.solve_rational_system(equations_rows, required_quantity_units)
+        except ValueError:
+            raise ValueError('Required units cannot be derived from given quantities')
+
+        quantities_pow_variables = list(sp.symbols('x0:{}'.format(num_rows)))
+        # keep the same order of dependent variables as sympy.solve returns
+        pivot_indices = sorted(pivot_indices, key=lambda i: sp.default_sort_key(quantities_pow_variables[i]))
+        dependent_variables = tuple(quantities_pow_variables[i] for i in pivot_indices)
+        independent_variables = tuple(quantities_pow_variables[i] for i in free_indices)
+        solution = tuple(sp.Rational(particular_solution[i].numerator, particular_solution[i].denominator)
+                         + sum(sp.Rational(basis_vector[i].numerator, basis_vector[i].denominator) * variable
+                               for basis_vector, variable in zip(nullspace_basis, independent_variables))
+                         for i in pivot_indices)
+        return dependent_variables, independent_variables, solution, quantities_pow_variables
+
     @staticmethod
-    def find_powers_equations(required_quantity_units, influencing_quantities_units):
+    def find_powers_equations_sympy(required_quantity_units, influencing_quantities_units):
         num_rows = len(influencing_quantities_units)
         assert num_rows > 0
         num_cols = len(influencing_quantities_units[0])
@@ -29,48 +83,66 @@ class DimensionalFormulaSearch(object):
         return dependent_variables, independent_variables, solution, quantities_pow_variables
 
     @staticmethod
-    def generate_powers_for_weight(power_weight):
+    @lru_cache(maxsize=None)
+    def generate_power_fractions_for_weight(power_weight):
+        """
+        same as generate_powers_for_weight, but powers are (numerator, denominator) pairs of ints
+        """
         if power_weight == 0:
-            return (0,),
+            return ((0, 1),),
         elif power_weight == 1:
-            return (1,), (-1,)
+            return ((1, 1),), ((-1, 1),)
 
         powers = []
         numerator = power_weight
         denumerator = 1
         end = numerator + 1
         while denumerator != end:
-            power = sp.Rational(numerator, denumerator)
-            result_numerator = sp.fraction(power)[0]
-            # ones and other reduced fractions
-            if result_numerator != numerator:
-                numerator -= 1
-                denumerator += 1
-                continue
-            powers.extend([(power,), (-power,)])
+            # skip ones and other reducible fractions
+            if gcd(numerator, denumerator) == 1:
+                powers.extend([((numerator, denumerator),), ((-numerator, denumerator),)])
             numerator -= 1
             denumerator += 1
         return tuple(powers)
 
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def generate_powers_for_weight(power_weight):
+        if power_weight == 0:
+            return (0,),
+        elif power_weight == 1:
+            return (1,), (-1,)
+        return tuple((sp.Rational(numerator, denominator),)
+                     for ((numerator, denominator),)
+                     in DimensionalFormulaSearch.generate_power_fractions_for_weight(power_weight))
+
+    @staticmethod
+    def iterate_powers_for_n_independent_quantities(independent_quantity_count, power_weight,
+                                                    powers_for_weight=None):
+        """
+        lazily yields power tuples of given weight shell one by one,
+        the order is the same as in generate_powers_for_n_independent_quantities
+        powers_for_weight allows to yield (numerator, denominator) pairs
+        (generate_power_fractions_for_weight) instead of sympy rationals
+        """
+        if powers_for_weight is None:
+            powers_for_weight = DimensionalFormulaSearch.generate_powers_for_weight
+        if independent_quantity_count == 1:
+            yield from powers_for_weight(power_weight)
+            return
+        if power_weight == 0:
+            yield powers_for_weight(0)[0]*independent_quantity_count
+            return
+        for i in range(power_weight+1):
+            for cur_quantity_pow in powers_for_weight(i):
+                for next_quantities_pow in DimensionalFormulaSearch.iterate_powers_for_n_independent_quantities(
+                        independent_quantity_count-1, power_weight-i, powers_for_weight):
+                    yield cur_quantity_pow + next_quantities_pow
+
     @staticmethod
     def generate_powers_for_n_independent_quantities(independent_quantity_count, power_weight):
-        #todo: debug
-        def recursive_power_list_generation(left_weight, quantity_count):
-            if quantity_count == 1:
-                return DimensionalFormulaSearch.generate_powers_for_weight(left_weight)
-            if left_weight == 0:
-                return (0,)*quantity_count,
-            result_grid = []
-            for i in range(left_weight+1):
-                cur_quantity_powers = DimensionalFormulaSearch.generate_powers_for_weight(i)
-                next_quantities_powers = recursive_power_list_generation(left_weight-i, quantity_count-1)
-                cur_grid = [cur_quantity_pow + next_quantity_pow for cur_quantity_pow in cur_quantity_powers
-                               for next_quantity_pow in next_quantities_powers]
-                result_grid.extend(cur_grid)
-            return tuple(result_grid)
-
-        independent_power_grid = recursive_power_list_generation(power_weight, independent_quantity_count)
-        return independent_power_grid
+        return tuple(DimensionalFormulaSearch.iterate_powers_for_n_independent_quantities(
+            independent_quantity_count, power_weight))
 
     @staticmethod
     def power_cost(x):
@@ -82,20 +154,184 @@ class DimensionalFormulaSearch(object):
         return sum([DimensionalFormulaSearch.power_cost(power) for power in power_set])
 
     @staticmethod
-    def generate_quantities_powers_multiplies(max_formulas, max_downcycles, required_units, quantities_units):
+    def make_dependent_powers_affine_map(independent_power_variables, dependent_powers_equations):
+        """
+        dependent powers are affine in independent ones:
+        dependent = (matrix * independent + offset) / denominator
+        returns integer numpy matrix, offset and common denominator
+        """
+        matrix, right_side = sp.linear_eq_to_matrix(list(dependent_powers_equations),
+                                                    list(independent_power_variables))
+        # equations are treated as "expression = 0", so offset is negated right side
+        coefficients = list(matrix) + [-x for x in right_side]
+        denominator = 1
+        for x in coefficients:
+            denominator = rational_linear_solver.lcm(denominator, int(sp.fraction(x)[1]))
+        matrix_int = np.array([[int(x * denominator) for x in matrix.row(i)] for i in range(matrix.rows)],
+                              dtype=np.int64).reshape(matrix.rows, matrix.cols)
+        offset_int = np.array([int(-x * denominator) for x in right_side], dtype=np.int64)
+        return matrix_int, offset_int, denominator
+
+    @staticmethod
+    def eval_dependent_powers_batch(affine_map, independent_numerators, independent_denominators):
+        """
+        evaluates dependent powers for a batch of independent powers (one row per candidate)
+        returns reduced numerators and denominators of dependent powers
+        """
+        matrix_int, offset_int, denominator = affine_map
+        # scale every candidate row to integers
+        rows_lcm = np.lcm.reduce(independent_denominators, axis=1)
+        independent_int = independent_numerators * (rows_lcm[:, np.newaxis] // independent_denominators)
+        numerators = independent_int @ matrix_int.T + offset_int[np.newaxis, :] * rows_lcm[:, np.newaxis]
+        denominators = np.broadcast_to(denominator * rows_lcm[:, np.newaxis], numerators.shape)
+        divisors = np.gcd(numerators, denominators)
+        return numerators // divisors, denominators // divisors
+
+    @staticmethod
+    def make_rational_powers(power_fractions):
+        return tuple(sp.Rational(numerator, denominator) for numerator, denominator in power_fractions)
+
+    @staticmethod
+    def prepare_powers_search(required_units, quantities_units, solver='exact'):
+        """
+        solves powers equations and prepares everything needed to evaluate weight shells
+        returns dict with exact solution (if there are no independent powers)
+        or independent power count, indices of independent and dependent powers and affine map
+        """
         dependent_power_variables, independent_power_variables, dependent_powers_equations, all_power_vars_ordered = \
-            DimensionalFormulaSearch.find_powers_equations(required_units, quantities_units)
+            DimensionalFormulaSearch.find_powers_equations(required_units, quantities_units, solver)
 
         if len(independent_power_variables) == 0:
+            dependent_powers_by_vars = dict(zip(dependent_power_variables, dependent_powers_equations))
             exact_solution = []
             for var in all_power_vars_ordered:
-                var_solution = dependent_powers_equations[var]
+                var_solution = dependent_powers_by_vars[var]
                 assert var_solution.is_number
                 exact_solution.append(var_solution)
-            return [tuple(exact_solution)]
+            return {'exact_solution': tuple(exact_solution)}
+
+        return {
+            'power_count': len(all_power_vars_ordered),
+            'independent_power_count': len(independent_power_variables),
+            'independent_indices': [all_power_vars_ordered.index(var) for var in independent_power_variables],
+            'dependent_indices': [all_power_vars_ordered.index(var) for var in dependent_power_variables],
+            'affine_map': DimensionalFormulaSearch.make_dependent_powers_affine_map(
+                independent_power_variables, dependent_powers_equations)}
+
+    @staticmethod
+    def split_power_shell(independent_power_count, power_weight):
+        """
+        splits weight shell of independent powers on parts by weight share of the first power
+        parts are returned in the same order as iterate_powers_for_n_independent_quantities yields powers,
+        None means whole shell
+        """
+        if independent_power_count == 1 or power_weight == 0:
+            return [None]
+        return list(range(power_weight+1))
+
+    @staticmethod
+    def iterate_power_shell_part(independent_power_count, power_weight, part):
+        if part is None:
+            yield from DimensionalFormulaSearch.iterate_powers_for_n_independent_quantities(
+                independent_power_count,
+                power_weight,
+                DimensionalFormulaSearch.generate_power_fractions_for_weight)
+            return
+        first_power_weight = part
+        for first_power in DimensionalFormulaSearch.generate_power_fractions_for_weight(first_power_weight):
+            for next_quantities_pow in DimensionalFormulaSearch.iterate_powers_for_n_independent_quantities(
+                    independent_power_count-1,
+                    power_weight-first_power_weight,
+                    DimensionalFormulaSearch.generate_power_fractions_for_weight):
+                yield first_power + next_quantities_pow
+
+    @staticmethod
+    def eval_power_shell_part_batches(search, power_weight, part=None, cost_limit=None):
+        """
+        yields numerators, denominators (one row per formula, powers of all quantities)
+        and formula costs for independent powers of given weight shell (or its part), batch by batch
+        formulas more expensive than cost_limit are dropped
+        """
+        generated_independent_powers = DimensionalFormulaSearch.iterate_power_shell_part(
+            search['independent_power_count'], power_weight, part)
+        while True:
+            batch = list(islice(generated_independent_powers, DimensionalFormulaSearch.BATCH_SIZE))
+            if len(batch) == 0:
+                break
+            batch = np.array(batch, dtype=np.int64)
+            assert batch.shape[1] == search['independent_power_count']
+            profiling.count('candidates generated', len(batch))
+            independent_numerators, independent_denominators = batch[:, :, 0], batch[:, :, 1]
+            dependent_numerators, dependent_denominators = DimensionalFormulaSearch.eval_dependent_powers_batch(
+                search['affine_map'], independent_numerators, independent_denominators)
+
+            all_numerators = np.empty((len(batch), search['power_count']), dtype=np.int64)
+            all_denominators = np.empty_like(all_numerators)
+            all_numerators[:, search['independent_indices']] = independent_numerators
+            all_denominators[:, search['independent_indices']] = independent_denominators
+            all_numerators[:, search['dependent_indices']] = dependent_numerators
+            all_denominators[:, search['dependent_indices']] = dependent_denominators
+
+            formula_costs = np.sum(np.abs(all_numerators) + np.abs(all_denominators), axis=-1)
+            assert np.all(formula_costs >= power_weight)
+            if cost_limit is not None:
+                accepted = formula_costs <= cost_limit
+                profiling.count('candidates rejected', len(accepted) - np.count_nonzero(accepted))
+                all_numerators = all_numerators[accepted]
+                all_denominators = all_denominators[accepted]
+                formula_costs = formula_costs[accepted]
+            yield all_numerators, all_denominators, formula_costs
+
+    @staticmethod
+    def eval_power_shell_part(search, power_weight, part, cost_limit):
+        """
+        evaluates the whole part of weight shell at once (process pool worker)
+        """
+        batches = list(DimensionalFormulaSearch.eval_power_shell_part_batches(
+            search, power_weight, part, cost_limit))
+        if len(batches) == 0:
+            return (np.empty((0, search['power_count']), dtype=np.int64),
+                    np.empty((0, search['power_count']), dtype=np.int64),
+                    np.empty((0,), dtype=np.int64))
+        return tuple(np.concatenate(arrays) for arrays in zip(*batches))
 
-        independent_power_count = len(independent_power_variables)
+    @staticmethod
+    def eval_power_shell_batches(search, power_weight, cost_limit=None, executor=None):
+        """
+        yields batches of formulas of given weight shell in the order of serial enumeration
+        if executor is given, shell is split on parts which are evaluated in parallel
+        """
+        if executor is None:
+            yield from DimensionalFormulaSearch.eval_power_shell_part_batches(
+                search, power_weight, None, cost_limit)
+            return
+        parts = DimensionalFormulaSearch.split_power_shell(search['independent_power_count'], power_weight)
+        # map yields results in order of parts, so merged result is the same as serial
+        yield from executor.map(DimensionalFormulaSearch.eval_power_shell_part,
+                                [search]*len(parts),
+                                [power_weight]*len(parts),
+                                parts,
+                                [cost_limit]*len(parts))
+
+    @staticmethod
+    def generate_quantities_powers_multiplies(max_formulas, max_downcycles, required_units, quantities_units,
+                                              solver='exact', jobs=1):
+        search = DimensionalFormulaSearch.prepare_powers_search(required_units, quantities_units, solver)
+        if 'exact_solution' in search:
+            return FormulaBatch.from_formulas([search['exact_solution']])
+
+        with profiling.stage('power enumeration', 'search'):
+            if jobs > 1:
+                with ProcessPoolExecutor(jobs) as executor:
+                    return DimensionalFormulaSearch.sweep_quantities_powers_multiplies(
+                        search, max_formulas, max_downcycles, executor)
+            return DimensionalFormulaSearch.sweep_quantities_powers_multiplies(search, max_formulas, max_downcycles)
 
+    @staticmethod
+    def sweep_quantities_powers_multiplies(search, max_formulas, max_downcycles, executor=None):
+        """
+        returns found formulas as FormulaBatch (powers are never converted to sympy)
+        """
         found_formulas = []
 
         downcycle_count = -1
@@ -103,34 +339,26 @@ class DimensionalFormulaSearch(object):
         future_powers = dict()
         while len(found_formulas) < max_formulas and downcycle_count < max_downcycles:
             found_formula = False
-            generated_independent_powers = DimensionalFormulaSearch.generate_powers_for_n_independent_quantities(
-                independent_power_count,
-                current_weight)
-            for generated_indep_pows in generated_independent_powers:
-                assert len(generated_indep_pows) == independent_power_count
-                indep_powers_by_vars ={indep_pow_var: power
-                                            for indep_pow_var, power
-                                            in zip(independent_power_variables, generated_indep_pows)}
-                dependent_powers_by_vars = {power: power_equation.subs(indep_powers_by_vars)
-                                              for power, power_equation
-                                            in zip(dependent_power_variables, dependent_powers_equations)}
-                all_powers_by_vars = {**indep_powers_by_vars, **dependent_powers_by_vars}
-                all_powers_ordered = tuple(all_powers_by_vars[var] for var in all_power_vars_ordered)
-
-                formula_cost = DimensionalFormulaSearch.power_set_cost(all_powers_ordered)
-                assert formula_cost >= current_weight
-                if formula_cost > current_weight:
-                    if formula_cost in future_powers.keys():
-                        future_powers[formula_cost].append(all_powers_ordered)
+            for all_numerators, all_denominators, formula_costs \
+                    in DimensionalFormulaSearch.eval_power_shell_batches(search, current_weight,
+                                                                         executor=executor):
+                for numerators, denominators, formula_cost in zip(all_numerators.tolist(),
+                                                                  all_denominators.tolist(),
+                                                                  formula_costs.tolist()):
+                    power_fractions = tuple(zip(numerators, denominators))
+                    if formula_cost > current_weight:
+                        if formula_cost in future_powers.keys():
+                            future_powers[formula_cost].append(power_fractions)
+                        else:
+                            future_powers[formula_cost] = [power_fractions]
                     else:
-                        future_powers[formula_cost] = [all_powers_ordered]
-                else:
-                    found_formula = True
-                    found_formulas.append(all_powers_ordered)
+                        found_formula = True
+                        found_formulas.append(power_fractions)
 
             if current_weight in future_powers.keys():
-                assert DimensionalFormulaSearch.power_set_cost(future_powers[current_weight][0]) == current_weight
                 found_formulas.extend(future_powers[current_weight])
+                assert sum(abs(numerator) + abs(denominator)
+                           for numerator, denominator in found_formulas[-1]) == current_weight
                 del future_powers[current_weight]
                 found_formula = True
 
@@ -140,4 +368,80 @@ class DimensionalFormulaSearch(object):
                 downcycle_count += 1
             current_weight += 1
 
-        return found_formulas
+        # formulas of the next weights are never used
+        profiling.count('candidates rejected', sum(len(powers) for powers in future_powers.values()))
+        return FormulaBatch.from_power_fractions(found_formulas, search['power_count'])
+
+    @staticmethod
+    def iterate_quantities_powers_multiplies(required_units, quantities_units, solver='exact', max_formulas=None,
+                                             jobs=1):
+        """
+        best-first search: lazily yields formulas in nondecreasing cost order
+        (formulas of equal cost come in the same order as in generate_quantities_powers_multiplies)
+        weight shells are evaluated one by one, every formula of shell w costs at least w,
+        so queued formulas cheaper than next shell weight can be yielded
+        if max_formulas is given, only that many best formulas are kept in queue and
+        search stops as soon as the rest of formulas cannot be better than queued ones
+        """
+        search = DimensionalFormulaSearch.prepare_powers_search(required_units, quantities_units, solver)
+        if 'exact_solution' in search:
+            yield search['exact_solution']
+            return
+
+        if jobs > 1:
+            with ProcessPoolExecutor(jobs) as executor:
+                yield from DimensionalFormulaSearch.best_first_quantities_powers_multiplies(
+                    search, max_formulas, executor)
+        else:
+            yield from DimensionalFormulaSearch.best_first_quantities_powers_multiplies(search, max_formulas)
+
+    @staticmethod
+    def best_first_quantities_powers_multiplies(search, max_formulas, executor=None):
+        left_formulas = max_formulas
+        # once queue holds enough formulas, formulas more expensive than queued ones are never needed
+        cost_limit = None
+        queue = []
+        sequence_number = 0
+        current_weight = 0
+        while left_formulas is None or left_formulas > 0:
+            if cost_limit is not None and cost_limit < current_weight:
+                # formulas of current and next shells can't get into the queue
+                break
+            # shell is evaluated between yields, so consumer time is not included
+            with profiling.stage('power enumeration', 'search'):
+                for all_numerators, all_denominators, formula_costs \
+                        in DimensionalFormulaSearch.eval_power_shell_batches(search, current_weight,
+                                                                             cost_limit, executor):
+                    # cost limit could become lower since shell evaluation was started
+                    if cost_limit is not None:
+                        accepted = formula_costs <= cost_limit
+                        profiling.count('candidates rejected', len(accepted) - np.count_nonzero(accepted))
+                        all_numerators = all_numerators[accepted]
+                        all_denominators = all_denominators[accepted]
+                        formula_costs = formula_costs[accepted]
+                    for numerators, denominators, formula_cost in zip(all_numerators.tolist(),
+                                                                      all_denominators.tolist(),
+                                                                      formula_costs.tolist()):
+                        # formulas of the current shell go before formulas of the same cost from previous shells
+                        from_previous_shell = 0 if formula_cost == current_weight else 1
+                        heapq.heappush(queue, (formula_cost, from_previous_shell, sequence_number,
+                                               tuple(zip(numerators, denominators))))
+                        sequence_number += 1
+                    if left_formulas is not None and len(queue) >= left_formulas:
+                        profiling.count('candidates rejected', len(queue) - left_formulas)
+                        # sorted list is a valid heap
+                        queue = heapq.nsmallest(left_formulas, queue)
+                        cost_limit = queue[-1][0]
+
+            # formulas of the next shells cost more than current weight
+            while len(queue) > 0 and queue[0][0] <= current_weight:
+                _, _, _, power_fractions = heapq.heappop(queue)
+                yield DimensionalFormulaSearch.make_rational_powers(power_fractions)
+                if left_formulas is not None:
+                    left_formulas -= 1
+                    if left_formulas == 0:
+                        return
+            current_weight += 1
+
+        for _, _, _, power_fractions in sorted(queue):
+            yield DimensionalFormulaSearch.make_rational_powers(power_fractions)
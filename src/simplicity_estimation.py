@@ -5,3 +5,10 @@ def make_simplicity_estimation(powers_list):
     power_costs = [power_cost(power) for power in powers_list]
     total_cost = sum(power_costs)
     return float(total_cost)
+
+
+def make_simplicity_estimation_batch(formula_batch):
+    """
+    same as make_simplicity_estimation for every formula of FormulaBatch
+    """
+    return formula_batch.costs().astype(float)
@@ -1,4 +1,14 @@
+import asyncio
+import csv
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import tracemalloc
 import unittest
+from fractions import Fraction
 import numpy as np
 import common_tools
 
@@ -7,6 +17,17 @@ import periodicity_estimation
 import monotonicity_estimation
 import magnitude_estimation
 import increase_estimation
+import estimate_formulas
+import search_cache
+import dim_cli
+import dim_batch
+import dim_server
+import dim_benchmark
+import report_printing
+import profiling
+from search_formulas import DimensionalFormulaSearch
+from formula_batch import FormulaBatch
+from curve_batch import CurveBatch
 
 
 def create_line_func(slope, offset):
@@ -40,6 +61,17 @@ class TestEstimations(unittest.TestCase):
         periodic_estim = linearity_estimation.make_linearity_estimation(periodic_x, periodic_y)
         assert pow_estim > periodic_estim
 
+    def test_linearity_batch(self):
+        line_x, line_y = create_line_func(2.0, 3.0)
+        _, pow_y = create_power_func(1.0, 3)
+        _, periodic_y = create_periodic_func(2.0, 0.0)
+        _, const_y = create_line_func(0.0, 3.0)
+        curves = np.array([line_y, pow_y, periodic_y, const_y])
+        batch_estims = linearity_estimation.make_linearity_estimation_batch(line_x, curves)
+        single_estims = [linearity_estimation.make_linearity_estimation(line_x, y) for y in curves]
+        assert np.allclose(batch_estims, np.array(single_estims, dtype=float))
+        assert batch_estims[0] > batch_estims[1] > batch_estims[2]
+
     def test_periodicity(self):
         line_x, line_y = create_line_func(2.0, 3.0)
         line_estim = periodicity_estimation.make_periodicity_estimation(line_x, line_y)
@@ -47,6 +79,30 @@ class TestEstimations(unittest.TestCase):
         periodic_estim = periodicity_estimation.make_periodicity_estimation(periodic_x, periodic_y)
         assert periodic_estim > line_estim
 
+    def test_periodicity_autocorrelation(self):
+        X = np.arange(0.0, 1.0, 0.01)
+        curves = np.array([np.sin(X*30.0), np.sin(X*30.0) + X*0.5, np.sin(X*12.0), X*2.0 + 3.0, X**2])
+        estims = periodicity_estimation.make_periodicity_estimation_batch(X, curves)
+        assert np.all((estims >= 0.0) & (estims <= 1.0))
+        assert estims[0] > estims[2] > estims[3]
+        assert estims[1] > estims[4]
+
+    def test_curve_batch(self):
+        X = np.arange(0.0, 1.0, 0.01)
+        curves = np.array([np.sin(X*30.0), X**2, X*0.0 + 3.0])
+        shared_curves = CurveBatch(X, curves)
+        profiler = profiling.enable()
+        try:
+            linearity = linearity_estimation.make_linearity_estimation_batch(X, curves, shared_curves)
+            periodicity = periodicity_estimation.make_periodicity_estimation_batch(X, curves, curves=shared_curves)
+        finally:
+            profiling.disable()
+        assert profiler.counters['spline fits'] == len(curves)
+        assert np.array_equal(linearity, linearity_estimation.make_linearity_estimation_batch(X, curves))
+        assert np.array_equal(periodicity, periodicity_estimation.make_periodicity_estimation_batch(X, curves))
+        assert shared_curves.resample(50) is shared_curves.resample(50)
+        assert np.allclose(shared_curves.evaluate(X, order=1)[1], 2.0 * X / 0.99**2)
+
     def test_monotonicity(self):
         line_x, line_y = create_line_func(2.0, 3.0)
         non_monotonicity_line = periodicity_estimation.make_periodicity_estimation(line_x, line_y)
@@ -85,6 +141,583 @@ class TestEstimations(unittest.TestCase):
         decreasing_estim = increase_estimation.make_increase_estimation(decreasing_line_y)
         assert const_estim > decreasing_estim
 
+    def test_batch_estimations(self):
+        line_x, line_y = create_line_func(2.0, 3.0)
+        _, decreasing_line_y = create_line_func(-2.0, 3.0)
+        _, const_y = create_line_func(0.0, 3.0)
+        _, periodic_y = create_periodic_func(2.0, 3.0)
+        curves = np.array([line_y, decreasing_line_y, const_y, periodic_y])
+        assert np.allclose(
+            monotonicity_estimation.make_non_monothonicity_estimation_batch(line_x, curves),
+            [monotonicity_estimation.make_non_monothonicity_estimation(line_x, y) for y in curves])
+        assert np.allclose(
+            magnitude_estimation.make_magnitude_penalty_batch(curves),
+            [magnitude_estimation.make_magnitude_penalty(y) for y in curves])
+        assert np.allclose(
+            magnitude_estimation.make_avg_derivative_magnitude_estimation_batch(line_x, curves),
+            [magnitude_estimation.make_avg_derivative_magnitude_estimation(line_x, y) for y in curves])
+        assert np.array_equal(
+            increase_estimation.make_increase_estimation_batch(curves),
+            [increase_estimation.make_increase_estimation(y) for y in curves])
+
+    def test_eval_unknown_components_points_batch(self):
+        # columns a, b, c are measured, y is searched, b has one negative and c one zero measurement
+        table = np.array([[1.0, 2.0, 1.0, 1.0],
+                          [2.0, -3.0, 0.0, 1.0],
+                          [3.0, 4.0, 2.0, 1.0],
+                          [4.0, 5.0, 3.0, 1.0]])
+        knowns_mask = [True, True, True, False]
+        formulas = [(1, 0, 0, -1), (Fraction(1, 2), Fraction(-3, 2), 1, -1), (0, 2, 0, -1), (0, 1, 0, -1),
+                    (1, 0, 1, -1), (0, 0, -1, -1), (Fraction(-3, 2), 0, 0, 1), (0, Fraction(1, 3), 0, 1)]
+        points, invalid = estimate_formulas.eval_unknown_components_points_batch(formulas, table, knowns_mask)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            expected_points = np.array([estimate_formulas.eval_unknown_component_points(formula, table, knowns_mask)
+                                        for formula in formulas])
+        expected_invalid = np.logical_not(np.all(np.isfinite(expected_points), axis=-1))
+        assert np.array_equal(invalid, expected_invalid)
+        assert list(np.flatnonzero(invalid)) == [1, 5, 7]
+        assert np.allclose(points[np.logical_not(invalid)], expected_points[np.logical_not(invalid)])
+        # negative base in fractional power invalidates its point only
+        assert list(np.flatnonzero(np.logical_not(np.isfinite(points[1])))) == [1]
+        assert np.allclose(points[1][[0, 2, 3]], expected_points[1][[0, 2, 3]])
+        # zero base gives zero in positive power and infinity in negative one
+        assert points[4][1] == 0.0 and points[5][1] == np.inf
+
+    def test_normalize_80_column(self):
+        column = np.array([5.0, np.nan, 0.0, 1.0, 2.0, 3.0, 4.0, 6.0, 7.0, 8.0, 9.0, 100.0])
+        normalized = common_tools.normalize_80_column(column)
+        assert np.isnan(normalized[1])
+        assert normalized[0] == 0.5
+        assert normalized[2] == -0.125 and normalized[-1] == 1.2
+        reverted = common_tools.normalize_80_column(column, revert=True)
+        assert reverted[0] == 0.5
+        assert reverted[2] == 1.125 and reverted[-1] == -0.2
+
+    def test_parallel_estimation(self):
+        required_units = (1, 1, -2)
+        quantities_units = ((1, 0, 0), (1, 0, 0), (0, 1, 0), (0, 0, 1))
+        formulas = DimensionalFormulaSearch.generate_quantities_powers_multiplies(
+            20, 10, required_units, quantities_units)
+        X = np.arange(0.0, 1.0, 0.05)
+        quantities_table = {
+            'm_1': {'measurements': 1.0 + X},
+            'm_2': {'measurements': 2.0 + np.sin(X*4.0)},
+            'r': {'measurements': 1.0 + X*X},
+            't': {'measurements': 0.5 + X},
+            'F': {}}
+        for periodicity_mode in estimate_formulas.PERIODICITY_MODES:
+            serial = estimate_formulas.make_formulas_estimation_table(
+                formulas, quantities_table, 'F', ('m_1', 'm_2', 'r', 't'),
+                True, True, True, periodicity_mode)
+            parallel = estimate_formulas.make_formulas_estimation_table(
+                formulas, quantities_table, 'F', ('m_1', 'm_2', 'r', 't'),
+                True, True, True, periodicity_mode, jobs=2)
+            assert np.array_equal(serial['valid'], parallel['valid'])
+            assert np.array_equal(serial['unknowns_points'], parallel['unknowns_points'])
+            for heuristic in estimate_formulas.HEURISTICS:
+                assert np.array_equal(serial['raw'][heuristic], parallel['raw'][heuristic], equal_nan=True)
+                assert np.array_equal(serial['normalized'][heuristic], parallel['normalized'][heuristic],
+                                      equal_nan=True)
+
+    def test_chunked_estimation(self):
+        required_units = (1, 1, -2)
+        quantities_units = ((1, 0, 0), (1, 0, 0), (0, 1, 0), (0, 0, 1))
+        formulas = DimensionalFormulaSearch.generate_quantities_powers_multiplies(
+            20, 10, required_units, quantities_units)
+        X = np.arange(0.0, 1.0, 0.05)
+        quantities_table = {
+            'm_1': {'measurements': 1.0 + X},
+            'm_2': {'measurements': 2.0 + np.sin(X*4.0)},
+            'r': {'measurements': 1.0 + X*X},
+            't': {'measurements': 0.5 + X},
+            'F': {}}
+        whole = estimate_formulas.make_formulas_estimation_table(
+            formulas, quantities_table, 'F', ('m_1', 'm_2', 'r', 't'), True, True, True)
+        chunked = estimate_formulas.make_formulas_estimation_table(
+            formulas, quantities_table, 'F', ('m_1', 'm_2', 'r', 't'), True, True, True, chunk_rows=3)
+        assert np.array_equal(whole['valid'], chunked['valid'])
+        assert np.array_equal(whole['unknowns_points'], chunked['unknowns_points'])
+        for heuristic in estimate_formulas.HEURISTICS:
+            assert np.allclose(whole['raw'][heuristic], chunked['raw'][heuristic], equal_nan=True)
+
+        resampled = estimate_formulas.make_formulas_estimation_table(
+            formulas, quantities_table, 'F', ('m_1', 'm_2', 'r', 't'), True, True, True,
+            chunk_rows=3, resample_count=10)
+        assert resampled['unknowns_points'].shape == (len(formulas), 10)
+        assert resampled['parameter_points'][0] == whole['parameter_points'][0]
+        assert resampled['parameter_points'][-1] == whole['parameter_points'][-1]
+        assert np.array_equal(resampled['raw']['magnitude'], whole['raw']['magnitude'], equal_nan=True)
+        with self.assertRaises(ValueError):
+            estimate_formulas.make_formulas_estimation_table(
+                formulas, quantities_table, 'F', ('m_1', 'm_2', 'r', 't'), True, True, True, chunk_rows=0)
+
+    def test_incremental_estimation(self):
+        required_units = (1, 1, -2)
+        quantities_units = ((1, 0, 0), (1, 0, 0), (0, 1, 0), (0, 0, 1))
+        formulas = DimensionalFormulaSearch.generate_quantities_powers_multiplies(
+            20, 10, required_units, quantities_units)
+        X = np.arange(0.0, 1.0, 0.05)
+
+        def make_quantities_table(row_count):
+            return {
+                'm_1': {'measurements': (1.0 + X)[:row_count]},
+                'm_2': {'measurements': (2.0 + np.sin(X*4.0))[:row_count]},
+                'r': {'measurements': (1.0 + X*X)[:row_count]},
+                't': {'measurements': (0.5 + X)[:row_count]},
+                'F': {}}
+
+        whole = estimate_formulas.make_formulas_estimation_table(
+            formulas, make_quantities_table(len(X)), 'F', ('m_1', 'm_2', 'r', 't'), True, True, True)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            state_path = os.path.join(temp_dir, 'state.npz')
+            profiler = profiling.enable()
+            try:
+                for row_count in (7, 15, len(X), len(X)):
+                    incremental = estimate_formulas.make_incremental_formulas_estimation_table(
+                        formulas, make_quantities_table(row_count), 'F', ('m_1', 'm_2', 'r', 't'),
+                        True, True, True, state_path)
+            finally:
+                profiling.disable()
+            # appended rows only are evaluated
+            assert profiler.counters['rows evaluated'] == len(X)
+            assert np.array_equal(whole['valid'], incremental['valid'])
+            assert np.array_equal(whole['unknowns_points'], incremental['unknowns_points'])
+            for heuristic in estimate_formulas.HEURISTICS:
+                assert np.allclose(whole['raw'][heuristic], incremental['raw'][heuristic], equal_nan=True)
+
+            # curves heuristics of kept curves are estimated by processes
+            parallel = estimate_formulas.make_incremental_formulas_estimation_table(
+                formulas, make_quantities_table(len(X)), 'F', ('m_1', 'm_2', 'r', 't'),
+                True, True, True, state_path, jobs=2)
+            for heuristic in estimate_formulas.HEURISTICS:
+                assert np.array_equal(incremental['raw'][heuristic], parallel['raw'][heuristic], equal_nan=True)
+
+            # changed rows invalidate state
+            changed_table = make_quantities_table(len(X))
+            changed_table['t']['measurements'] = changed_table['t']['measurements'] + 1.0
+            changed = estimate_formulas.make_incremental_formulas_estimation_table(
+                formulas, changed_table, 'F', ('m_1', 'm_2', 'r', 't'), True, True, True, state_path,
+                heuristics=('magnitude', ))
+            assert list(changed['raw'].keys()) == ['magnitude']
+            assert np.array_equal(changed['raw']['magnitude'], estimate_formulas.make_formulas_estimation_table(
+                formulas, changed_table, 'F', ('m_1', 'm_2', 'r', 't'), True, True, True,
+                heuristics=('magnitude', ))['raw']['magnitude'], equal_nan=True)
+
+    def test_estimator_planner(self):
+        assert estimate_formulas.plan_heuristics({'simplicity': 1.0, 'periodicity': 0.0}, ('linearity',)) == \
+            ('simplicity', 'linearity')
+        with self.assertRaises(ValueError):
+            estimate_formulas.plan_heuristics({'unknown': 1.0})
+
+        formulas = DimensionalFormulaSearch.generate_quantities_powers_multiplies(
+            10, 10, (1, 1), ((1, 0), (0, 1), (1, 1)))
+        X = np.arange(0.0, 1.0, 0.05)
+        quantities_table = {'a': {'measurements': 1.0 + X}, 'b': {'measurements': 2.0 - X},
+                            'c': {'measurements': 1.0 + X*X}, 'y': {}}
+        estimate_formulas.register_estimator('range',
+                                             lambda param, points, formulas, settings: np.ptp(points, axis=-1))
+        try:
+            table = estimate_formulas.make_formulas_estimation_table(
+                formulas, quantities_table, 'y', ('a', 'b', 'c'), True, True, True,
+                heuristics=('range', 'simplicity'))
+            assert list(table['raw'].keys()) == ['simplicity', 'range']
+            report = dim_cli.DimensionalFormulaSearchCli.prepare_report_table(formulas, table, 0, 0, 0, 0, 0, 0, 0,
+                                                                             {'range': 1.0})
+            assert 'range' in dim_cli.DimensionalFormulaSearchCli.get_report_columns()
+        finally:
+            del estimate_formulas.ESTIMATORS['range']
+        ranges = [row['range'] for row in report]
+        assert ranges == sorted(ranges, reverse=True) and ranges[0] >= 1.0
+        with self.assertRaises(ValueError):
+            dim_cli.DimensionalFormulaSearchCli.prepare_report_table(formulas, table, 0, 0, 1, 0, 0, 0, 0)
+
+    def test_top_formulas_pruning(self):
+        formulas = DimensionalFormulaSearch.generate_quantities_powers_multiplies(
+            20, 10, (1, 1), ((1, 0), (0, 1), (1, 1)))
+        X = np.arange(0.0, 1.0, 0.05)
+        quantities_table = {'a': {'measurements': 1.0 + X}, 'b': {'measurements': 2.0 - X},
+                            'c': {'measurements': 1.0 + X*X}, 'y': {}}
+        weights = {'simplicity': 5.0, 'magnitude': 5.0, 'linearity': 1.0, 'periodicity': 0.0,
+                   'monotonicity': 0.0, 'change magnitude': 0.0, 'change sign': 0.0}
+        full = estimate_formulas.make_formulas_estimation_table(
+            formulas, quantities_table, 'y', ('a', 'b', 'c'), True, True, True,
+            heuristics=estimate_formulas.plan_heuristics(weights))
+        full_report = list(dim_cli.DimensionalFormulaSearchCli.prepare_report_table(formulas, full, 5, 5, 1,
+                                                                                    0, 0, 0, 0))
+        # nothing is pruned if all formulas fit in top
+        top = estimate_formulas.make_top_formulas_estimation_table(
+            formulas, quantities_table, 'y', ('a', 'b', 'c'), True, True, True, weights, len(formulas))
+        assert not np.any(top['pruned'])
+        assert np.array_equal(top['normalized']['linearity'], full['normalized']['linearity'], equal_nan=True)
+
+        # all valid formulas fit in normalization sample, so top is exactly the same as full ranking gives
+        top = estimate_formulas.make_top_formulas_estimation_table(
+            formulas, quantities_table, 'y', ('a', 'b', 'c'), True, True, True, weights, 3)
+        assert np.any(top['pruned'])
+        top_report = list(dim_cli.DimensionalFormulaSearchCli.prepare_report_table(formulas, top, 5, 5, 1,
+                                                                                   0, 0, 0, 0))
+        assert len(top_report) == np.count_nonzero(top['valid'] & np.logical_not(top['pruned']))
+        assert [(row['formula'], row['total']) for row in top_report[:3]] == \
+            [(row['formula'], row['total']) for row in full_report[:3]]
+
+        sampled = estimate_formulas.make_top_formulas_estimation_table(
+            formulas, quantities_table, 'y', ('a', 'b', 'c'), True, True, True, weights, 3, sample_count=5)
+        assert np.any(np.isnan(sampled['raw']['linearity'][sampled['pruned']]))
+        assert np.count_nonzero(np.isfinite(sampled['raw']['linearity'])) < np.count_nonzero(sampled['valid'])
+        with self.assertRaises(ValueError):
+            estimate_formulas.make_top_formulas_estimation_table(
+                formulas, quantities_table, 'y', ('a', 'b', 'c'), True, True, True, weights, 0)
+
+
+class TestFormulaSearch(unittest.TestCase):
+    def test_exact_solver_matches_sympy(self):
+        # F = G*m_1*m_2/r^2, units ordered as (kg, m, s)
+        required_units = (1, 1, -2)
+        quantities_units = ((-1, 3, -2), (1, 0, 0), (1, 0, 0), (0, 1, 0), (0, 0, 1))
+        exact = DimensionalFormulaSearch.find_powers_equations(required_units, quantities_units, 'exact')
+        reference = DimensionalFormulaSearch.find_powers_equations(required_units, quantities_units, 'sympy')
+        assert exact[0] == reference[0]
+        assert exact[1] == reference[1]
+        for exact_eq, reference_eq in zip(exact[2], reference[2]):
+            assert (exact_eq - reference_eq).expand() == 0
+
+    def test_found_formulas_units(self):
+        required_units = (1, 1, -2)
+        quantities_units = ((-1, 3, -2), (1, 0, 0), (1, 0, 0), (0, 1, 0), (0, 0, 1))
+        formulas = DimensionalFormulaSearch.generate_quantities_powers_multiplies(
+            20, 10, required_units, quantities_units)
+        assert len(formulas) >= 20
+        costs = [DimensionalFormulaSearch.power_set_cost(formula) for formula in formulas]
+        assert costs == sorted(costs)
+        for formula in formulas:
+            for unit_indx, required_unit_power in enumerate(required_units):
+                unit_power = sum(power * quantity_units[unit_indx]
+                                 for power, quantity_units in zip(formula, quantities_units))
+                assert unit_power == required_unit_power
+
+    def test_best_first_search(self):
+        required_units = (1, 1, -2)
+        quantities_units = ((-1, 3, -2), (1, 0, 0), (1, 0, 0), (0, 1, 0), (0, 0, 1))
+        swept_formulas = DimensionalFormulaSearch.generate_quantities_powers_multiplies(
+            20, 10, required_units, quantities_units)
+        best_formulas = list(DimensionalFormulaSearch.iterate_quantities_powers_multiplies(
+            required_units, quantities_units, max_formulas=20))
+        assert len(best_formulas) == 20
+        assert best_formulas == swept_formulas[:20]
+
+    def test_parallel_search(self):
+        required_units = (1, 1, -2)
+        quantities_units = ((-1, 3, -2), (1, 0, 0), (1, 0, 0), (0, 1, 0), (0, 0, 1))
+        serial_formulas = DimensionalFormulaSearch.generate_quantities_powers_multiplies(
+            20, 10, required_units, quantities_units)
+        parallel_formulas = DimensionalFormulaSearch.generate_quantities_powers_multiplies(
+            20, 10, required_units, quantities_units, jobs=2)
+        assert parallel_formulas == serial_formulas
+        best_formulas = list(DimensionalFormulaSearch.iterate_quantities_powers_multiplies(
+            required_units, quantities_units, max_formulas=20, jobs=2))
+        assert best_formulas == serial_formulas[:20]
+
+    def test_exact_solver_inconsistent(self):
+        with self.assertRaises(ValueError):
+            DimensionalFormulaSearch.find_powers_equations((1, 0), ((0, 1), (0, 2)), 'exact')
+
+    def test_formula_batch(self):
+        required_units = (1, 1, -2)
+        quantities_units = ((-1, 3, -2), (1, 0, 0), (1, 0, 0), (0, 1, 0), (0, 0, 1))
+        formulas = DimensionalFormulaSearch.generate_quantities_powers_multiplies(
+            20, 10, required_units, quantities_units)
+        assert isinstance(formulas, FormulaBatch)
+        formulas_list = list(formulas)
+        assert FormulaBatch.from_formulas(formulas_list) == formulas
+        assert np.array_equal(formulas.costs(),
+                              [DimensionalFormulaSearch.power_set_cost(formula) for formula in formulas_list])
+        assert np.array_equal(formulas.to_floats(),
+                              [[float(power) for power in formula] for formula in formulas_list])
+        assert formulas[2:5] == formulas_list[2:5]
+        extended = formulas.append_power(-1)
+        assert extended[3] == formulas_list[3] + (-1,)
+
+    def test_search_cache(self):
+        required_units = (1, 1, -2)
+        quantities_units = ((-1, 3, -2), (1, 0, 0), (1, 0, 0), (0, 1, 0), (0, 0, 1))
+        searches = []
+
+        def search():
+            searches.append(None)
+            return DimensionalFormulaSearch.generate_quantities_powers_multiplies(
+                20, 10, required_units, quantities_units)
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            found = search_cache.search_formulas_cached(
+                search, required_units, quantities_units, {'max_formulas': 20}, cache_dir)
+            cached = search_cache.search_formulas_cached(
+                search, required_units, quantities_units, {'max_formulas': 20}, cache_dir)
+            assert cached == found and len(searches) == 1
+            search_cache.search_formulas_cached(
+                search, required_units, quantities_units, {'max_formulas': 10}, cache_dir)
+            assert len(searches) == 2
+
+            # only the most recently used entry fits
+            entry_size = max(entry.stat().st_size for entry in os.scandir(cache_dir))
+            search_cache.evict_least_recently_used(cache_dir, entry_size)
+            assert len(os.listdir(cache_dir)) == 1
+
+        # formulas are not cached without cache dir (unless memory cache is enabled)
+        search_cache.search_formulas_cached(search, required_units, quantities_units, {'max_formulas': 20})
+        assert len(searches) == 3
+
+        # memory cache is opt-in, its entries are per cache dir and read-only
+        search_cache.enable_memory_cache()
+        try:
+            with tempfile.TemporaryDirectory() as cache_dir, tempfile.TemporaryDirectory() as other_cache_dir:
+                found = search_cache.search_formulas_cached(
+                    search, required_units, quantities_units, {'max_formulas': 20}, cache_dir)
+                os.remove(search_cache.get_cache_file_path(cache_dir, next(iter(search_cache.memory_cache))[1]))
+                assert search_cache.search_formulas_cached(
+                    search, required_units, quantities_units, {'max_formulas': 20}, cache_dir) is found
+                assert len(searches) == 4
+                search_cache.search_formulas_cached(
+                    search, required_units, quantities_units, {'max_formulas': 20}, other_cache_dir)
+                assert len(searches) == 5
+                assert not found.numerators.flags.writeable and not found.costs().flags.writeable
+        finally:
+            search_cache.enable_memory_cache(0)
+
+
+class TestCli(unittest.TestCase):
+    def tearDown(self):
+        # batch and server workers enable memory cache of searches
+        search_cache.enable_memory_cache(0)
+
+    def test_solvers(self):
+        assert dim_cli.SOLVERS == DimensionalFormulaSearch.SOLVERS
+
+    def test_lazy_scipy_import(self):
+        # scipy.interpolate is imported only when splines are fitted
+        src_dir = os.path.dirname(os.path.abspath(__file__))
+        code = 'import sys, dim, dim_cli; print(any(m.startswith("scipy") for m in sys.modules))'
+        output = subprocess.run([sys.executable, '-c', code], cwd=src_dir, check=True, capture_output=True, text=True)
+        assert output.stdout.strip() == 'False'
+
+    def test_load_measurements_csv(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            csv_path = os.path.join(temp_dir, 'measurements.csv')
+            with open(csv_path, 'w') as csv_file:
+                csv_file.write('g[m//s^2],h[m],t[s]\n9.81,1,\n9.81,2,\n9.81,3,\n\n')
+            quantities = dim_cli.DimensionalFormulaSearchCli.load_measurements_csv(csv_path)
+            assert list(quantities.keys()) == ['g', 'h', 't']
+            assert np.array_equal(quantities['h']['measurements'], [1.0, 2.0, 3.0])
+            assert 'measurements' not in quantities['t']
+            assert quantities['g']['units'] == {'m': 1, 's': -2}
+
+            with open(csv_path, 'w') as csv_file:
+                csv_file.write('g[m//s^2],h[m]\n9.81,1\n,2\n')
+            with self.assertRaises(ValueError):
+                dim_cli.DimensionalFormulaSearchCli.load_measurements_csv(csv_path)
+
+            # quoted numbers are measurements, whitespace-only cells are unspecified
+            with open(csv_path, 'w') as csv_file:
+                csv_file.write('g[m//s^2],h[m],t[s]\n"9.81", 1 ,  \n"9.81",2," "\n')
+            quantities = dim_cli.DimensionalFormulaSearchCli.load_measurements_csv(csv_path)
+            assert np.array_equal(quantities['g']['measurements'], [9.81, 9.81])
+            assert np.array_equal(quantities['h']['measurements'], [1.0, 2.0])
+            assert 'measurements' not in quantities['t']
+
+            # blocks parsed in bulk are cut at line breaks, rest of file after quotes is read by csv reader
+            with open(csv_path, 'w') as csv_file:
+                csv_file.write('g[m//s^2],h[m],t[s]\n9.81,1,\n9.81,2,\n,,\n"9.81",3,\n9.81,4')
+            block_chars = dim_cli.MEASUREMENTS_BLOCK_CHARS
+            dim_cli.MEASUREMENTS_BLOCK_CHARS = 5
+            try:
+                quantities = dim_cli.DimensionalFormulaSearchCli.load_measurements_csv(csv_path)
+            finally:
+                dim_cli.MEASUREMENTS_BLOCK_CHARS = block_chars
+            assert np.array_equal(quantities['h']['measurements'], [1.0, 2.0, 3.0, 4.0])
+            assert 'measurements' not in quantities['t']
+
+            # literal nan is not an unspecified measurement
+            with open(csv_path, 'w') as csv_file:
+                csv_file.write('g[m//s^2],h[m],t[s]\n9.81,1,nan\n9.81,2,nan\n')
+            with self.assertRaises(ValueError):
+                dim_cli.DimensionalFormulaSearchCli.load_measurements_csv(csv_path)
+
+    def test_out_of_core_measurements(self):
+        # with --chunk-rows measurements are memory mapped and evaluated by blocks,
+        # so traced memory doesn't grow with rows
+        block_chars = dim_cli.MEASUREMENTS_BLOCK_CHARS
+        dim_cli.MEASUREMENTS_BLOCK_CHARS = 64 * 1024
+        try:
+            with tempfile.TemporaryDirectory() as temp_dir:
+                def run_chunked(row_count):
+                    csv_path = os.path.join(temp_dir, 'measurements.csv')
+                    with open(csv_path, 'w') as csv_file:
+                        csv_file.write(dim_benchmark.make_synthetic_csv(4, 3, 1, row_count))
+                    args = dim_batch.make_dim_parser().parse_args(
+                        ['-f', '5', '-s', '1', '-l', '1', '-m', '1', '--chunk-rows', '1000',
+                         '--', csv_path, 'y', os.path.join(temp_dir, 'report.csv')])
+                    tracemalloc.start()
+                    try:
+                        dim_cli.DimensionalFormulaSearchCli.run(args)
+                        return tracemalloc.get_traced_memory()[1]
+                    finally:
+                        tracemalloc.stop()
+
+                # the first run imports modules
+                run_chunked(1000)
+                peak_bytes = run_chunked(10000)
+                # parsed measurements alone are 40 bytes per row
+                assert run_chunked(40000) - peak_bytes < 30000 * 8
+
+                quantities = dim_cli.DimensionalFormulaSearchCli.load_measurements_csv(
+                    os.path.join(temp_dir, 'measurements.csv'), out_of_core=True)
+                assert isinstance(quantities['q0']['measurements'].base, np.memmap)
+                assert np.array_equal(quantities['q0']['measurements'], dim_cli.DimensionalFormulaSearchCli
+                                      .load_measurements_csv(os.path.join(temp_dir, 'measurements.csv'))['q0']
+                                      ['measurements'])
+        finally:
+            dim_cli.MEASUREMENTS_BLOCK_CHARS = block_chars
+
+    def test_batch(self):
+        test_data_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'test_data')
+        with tempfile.TemporaryDirectory() as temp_dir:
+            common_argv = ['--search-cache-dir', temp_dir, '-s', '1']
+            jobs = dim_batch.make_glob_jobs(os.path.join(test_data_dir, 'jump.csv'), 'p', temp_dir, '.ndjson',
+                                            common_argv)
+            jobs += dim_batch.make_glob_jobs(os.path.join(test_data_dir, 'jump.csv'), 'unknown', temp_dir, '.csv',
+                                             common_argv)
+            summary_path = os.path.join(temp_dir, 'summary.csv')
+            search_cache.enable_memory_cache(5)
+            assert dim_batch.run_batch(jobs, summary_path) == 1
+            # serial batch runs in this process and leaves its cache settings as they were
+            assert search_cache.max_memory_cache_entries == 5 and dim_batch.worker_parser is None
+            with open(summary_path, newline='') as summary_file:
+                summary = list(csv.DictReader(summary_file))
+            assert [job_summary['status'] for job_summary in summary] == ['ok', 'error']
+            assert os.path.exists(os.path.join(temp_dir, 'jump.ndjson'))
+
+    def test_profile(self):
+        test_data_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'test_data')
+        assert profiling.stage('disabled') is profiling.NULL_STAGE
+        with tempfile.TemporaryDirectory() as temp_dir:
+            profile_path = os.path.join(temp_dir, 'profile.json')
+            args = dim_batch.make_dim_parser().parse_args(
+                ['--search-cache-size', '0', '--periodicity-mode', 'autocorrelation', '-l', '1', '-p', '1',
+                 '--profile', profile_path,
+                 os.path.join(test_data_dir, 'jump.csv'), 'p', os.path.join(temp_dir, 'report.csv')])
+            dim_cli.DimensionalFormulaSearchCli.run(args)
+            assert profiling.active_profiler is None
+            with open(profile_path) as profile_file:
+                summary = json.load(profile_file)
+            with open(profiling.get_trace_path(profile_path)) as trace_file:
+                trace = json.load(trace_file)
+        assert summary['stages']['find_powers_equations (exact)']['calls'] == 1
+        assert summary['stages']['estimator: periodicity']['seconds'] <= summary['stages']['estimation']['seconds']
+        assert summary['counters']['candidates generated'] >= 20
+        # linearity and autocorrelation periodicity share splines of 20 curves
+        assert summary['counters']['spline fits'] == 20
+        assert any(event['name'] == 'dim' and event['ph'] == 'X' for event in trace['traceEvents'])
+
+    def test_server(self):
+        test_data_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'test_data')
+        with open(os.path.join(test_data_dir, 'jump.csv')) as csv_file:
+            csv_text = csv_file.read()
+
+        async def post_rank(port, request):
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            body = json.dumps(request).encode('utf-8')
+            writer.write('POST /rank HTTP/1.1\r\nContent-Length: {}\r\n\r\n'.format(len(body)).encode('ascii') + body)
+            await writer.drain()
+            status_line = (await reader.readline()).decode('ascii')
+            response = await reader.read()
+            writer.close()
+            return int(status_line.split()[1]), json.loads(response.split(b'\r\n\r\n', 1)[1])
+
+        async def run_requests(executor, temp_dir):
+            server = await dim_server.start_server(executor, port=0)
+            port = server.sockets[0].getsockname()[1]
+            async with server:
+                options = {'simplicity-weight': 1}
+                return await asyncio.gather(
+                    post_rank(port, {'csv': csv_text, 'searched_quantity': 'p', 'options': options, 'max_rows': 3}),
+                    post_rank(port, {'csv': csv_text, 'searched_quantity': 'p', 'options': options}),
+                    post_rank(port, {'csv': csv_text, 'searched_quantity': 'unknown', 'options': options}),
+                    post_rank(port, {'csv': csv_text, 'searched_quantity': 'p',
+                                     'options': {'estimators-module': os.path.join(temp_dir, 'estimators.py'),
+                                                 'incremental-state': os.path.join(temp_dir, 'state.npz')}}))
+
+        # the same worker process as in serve(), errors of requests are pickled back from it
+        with tempfile.TemporaryDirectory() as temp_dir, \
+                dim_server.make_server_executor(1, common_argv=('--search-cache-dir', temp_dir)) as executor:
+            responses = asyncio.run(run_requests(executor, temp_dir))
+        (top_status, top), (all_status, all_rows), (error_status, error), (module_status, module_error) = responses
+        assert top_status == 200 and all_status == 200 and error_status == 400
+        assert module_status == 400 and 'estimators-module' in module_error['error']
+        assert 'incremental-state' in module_error['error']
+        assert top['columns'][0] == 'N' and top['columns'][1] == 'power_S' and top['columns'][-1] == 'total'
+        assert len(top['rows']) == 3 and top['rows'] == all_rows['rows'][:3]
+        assert 'unknown' in error['error']
+
+
+
+class TestBenchmark(unittest.TestCase):
+    def test_synthetic_workload(self):
+        csv_text = dim_benchmark.make_synthetic_csv(5, 3, 2, 50)
+        quantities_table = dim_cli.DimensionalFormulaSearchCli.parse_measurements_csv(io.StringIO(csv_text),
+                                                                                      'synthetic')
+        assert len(quantities_table['q0']['measurements']) == 50
+        assert 'measurements' not in quantities_table['y']
+        workload = dim_benchmark.run_workload(csv_text, 'y', repeat=1, max_formulas=3)
+        assert workload['rows'] == 50 and workload['formulas'] >= 3
+        assert all(seconds >= 0.0 for seconds in workload['stages'].values())
+        units_by_name, _ = dim_cli.DimensionalFormulaSearchCli.make_quantities_base_units_vectors(quantities_table)
+        _, independent_variables, _, _ = DimensionalFormulaSearch.find_powers_equations(
+            units_by_name['y'], [units_by_name['q{}'.format(i)] for i in range(5)])
+        assert len(independent_variables) == 2
+
+    def test_loader_workload(self):
+        workload = dim_benchmark.run_loader_workload(100, repeat=1)
+        assert workload['rows'] == 100 and workload['file megabytes'] > 0.0
+        assert list(workload['stages'].keys()) == ['load_measurements_csv', 'load_measurements_csv (cell by cell)']
+
+    def test_compare_results(self):
+        baseline = {'workloads': [{'name': 'a', 'stages': {'fast': 0.0001, 'slow': 1.0, 'same': 1.0}}]}
+        current = {'workloads': [{'name': 'a', 'stages': {'fast': 0.0005, 'slow': 2.0, 'same': 1.0, 'new': 1.0}}]}
+        regressions = [(stage_name, is_regression) for _, stage_name, _, _, _, is_regression
+                       in dim_benchmark.compare_results(baseline, current)]
+        assert regressions == [('fast', False), ('slow', True), ('same', False)]
+
+
+class TestReport(unittest.TestCase):
+    report_table = [
+        {'formula': (1, -2, 0), 'simplicity': 0.5, 'linearity': 0.25, 'total': 0.75},
+        {'formula': (Fraction(1, 2), 0, -1), 'simplicity': 0.25, 'linearity': 0.0, 'total': 0.25}]
+
+    def test_csv_report(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            out_path = os.path.join(temp_dir, 'report.csv')
+            report_printing.print_report(iter(self.report_table), ('formula', 'simplicity', 'linearity'),
+                                         ('a', 'b', 'c'), out_path)
+            with open(out_path, newline='') as report_file:
+                rows = list(csv.reader(report_file))
+        assert rows[0] == ['N', 'power_a', 'power_b', 'power_c', 'simplicity', 'linearity', 'total']
+        assert rows[2] == ['2', '1/2', '0', '-1', '0.25', '0.0', '0.25']
+
+    def test_ndjson_report(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            out_path = os.path.join(temp_dir, 'report.ndjson')
+            # quantities named like other columns don't overwrite them
+            report_printing.print_report(iter(self.report_table), ('formula', 'simplicity', 'linearity'),
+                                         ('N', 'simplicity', 'total'), out_path)
+            with open(out_path) as report_file:
+                records = [json.loads(line) for line in report_file]
+        assert len(records) == 2
+        assert records[0] == {'N': 1, 'power_N': '1', 'power_simplicity': '-2', 'power_total': '0',
+                              'simplicity': 0.5, 'linearity': 0.25, 'total': 0.75}
+
+    def test_unsupported_report(self):
+        with self.assertRaises(ValueError):
+            report_printing.get_report_writer('report.txt')
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file